@@ -8,24 +8,168 @@ from functools import lru_cache
 class Settings(BaseSettings):
     # WhatsApp Cloud API
     whatsapp_token: str = ""
+    whatsapp_api_url: str = "https://graph.facebook.com/v21.0"
     whatsapp_phone_number_id: str = ""  # Acepta WHATSAPP_PHONE_NUMBER_ID
     whatsapp_phone_id: str = ""  # Acepta WHATSAPP_PHONE_ID (alias)
     webhook_verify_token: str = "loopera-verify-token-2024"
+    whatsapp_app_secret: str = ""  # Si está definido, se valida X-Hub-Signature-256
 
     @property
     def phone_id(self) -> str:
         """Retorna el phone_id desde cualquiera de las dos variables"""
         return self.whatsapp_phone_number_id or self.whatsapp_phone_id
     
+    # Pool HTTP hacia Graph API (una instancia compartida por worker)
+    whatsapp_http2: bool = True
+    whatsapp_max_connections: int = 100
+    whatsapp_max_keepalive_connections: int = 20
+    whatsapp_keepalive_expiry: float = 30.0
+    whatsapp_connect_timeout: float = 5.0
+    whatsapp_read_timeout: float = 15.0
+    whatsapp_pool_timeout: float = 5.0
+
     # Groq API (Whisper + LLM)
     groq_api_key: str = ""
+    groq_base_url: str = ""  # Vacío = API pública de Groq
+    groq_chat_concurrency: int = 32  # Llamadas LLM simultáneas por worker
+    groq_transcribe_concurrency: int = 8  # Transcripciones simultáneas por worker
+
+    # Resiliencia de Groq: deadline, reintentos, circuit breaker y fallback
+    groq_deadline: float = 20.0  # Segundos totales por llamada (con reintentos)
+    groq_attempt_timeout: float = 10.0  # Por intento (hasta el primer fragmento en streaming)
+    groq_max_retries: int = 2
+    groq_backoff_base: float = 0.3
+    groq_backoff_max: float = 2.0
+    groq_hedge_after: float = 3.0  # Segundos antes de lanzar el modelo de respaldo (0 = solo si falla)
+    groq_fallback_model: str = "llama-3.1-8b-instant"  # Vacío desactiva el fallback
+    groq_circuit_threshold: int = 5  # Fallos seguidos que abren el circuito
+    groq_circuit_reset_timeout: float = 30.0
+
+    # Ruteo de turnos: plantilla, modelo chico o el modelo del tenant
+    router_enabled: bool = True  # False: todo va al modelo del tenant
+    router_templates_enabled: bool = True  # Saludos, gracias, despedidas, stickers sin LLM
+    router_small_model: str = "llama-3.1-8b-instant"  # Vacío: los turnos simples van al modelo del tenant
+    router_small_max_tokens: int = 200
+    router_large_threshold: float = 0.5  # Score del clasificador desde el que se usa el modelo grande
     
+    # Transcodificación de audio (ffmpeg en memoria)
+    audio_ffmpeg_concurrency: int = 4
+    audio_ffmpeg_timeout: float = 30.0
+    audio_passthrough_formats: str = "mp3,m4a,wav,webm,flac"  # Agregar "ogg" para enviar notas de voz sin convertir
+
+    # Preparación del audio para Whisper (recorte de silencios, bajo bitrate, troceo)
+    audio_preprocess: bool = True  # False: solo la transcodificación de arriba
+    audio_silence_threshold_db: float = -45.0  # Por debajo de esto se considera silencio
+    audio_max_pause: float = 0.6  # Pausas más largas se acortan...
+    audio_keep_pause: float = 0.3  # ...a esta duración
+    audio_min_speech_seconds: float = 0.3  # Menos voz que esto: no se llama a Whisper
+    audio_output_format: str = "ogg"  # ogg (Opus) o mp3
+    audio_bitrate: str = "16k"
+    audio_chunk_seconds: float = 60.0  # Notas más largas se transcriben en partes en paralelo (0 = nunca)
+    audio_max_chunks: int = 8
+    whisper_model: str = "whisper-large-v3-turbo"
+    whisper_language: str = "es"  # Vacío = detección automática
+
     # Redis (Railway provee esta variable automáticamente)
     redis_url: str = "redis://localhost:6379"
+    redis_max_connections: int = 50  # Por pool compartido del proceso (uno binario y uno de texto)
+    redis_socket_timeout: float = 5.0
+    redis_connect_timeout: float = 2.0
+    redis_health_check_interval: int = 30
+
+    # Sesiones
+    session_ttl: int = 86400  # 24 horas
+    session_max_messages: int = 40  # Tope duro; el presupuesto de tokens manda antes
+    history_token_budget: int = 1500  # Tokens de historial que van al LLM
+    summary_model: str = "llama-3.1-8b-instant"
+    summary_max_tokens: int = 300
+    session_cache_size: int = 10000  # Sesiones en el L1 en memoria (0 desactiva)
+    session_cache_ttl: int = 300  # Segundos que una sesión leída de Redis se sirve del L1
+    session_reconnect_interval: float = 5.0  # Reintento de Redis caído (sesiones)
+    session_compress_min_bytes: int = 512  # Mensajes más largos se guardan con zlib (0 desactiva)
+    
+    # Servidor web (python -m app.serve)
+    web_concurrency: int = 0  # Procesos uvicorn (0 = según las CPUs disponibles)
+    web_max_concurrency: int = 8  # Tope del modo automático
+    warmup_timeout: float = 10.0  # Segundos por chequeo de warm-up
+    shutdown_drain_timeout: float = 20.0  # Espera al apagar por los mensajes procesándose en el web
     
-    # Configuración del bot
+    # Control de admisión (por proceso)
+    admission_max_inflight: int = 64  # Mensajes procesándose a la vez
+    admission_audio_max_inflight: int = 16  # De esos, audios (ffmpeg + Whisper)
+    admission_queue_size: int = 500  # Mensajes esperando turno; más allá se descartan
+    admission_busy_after: float = 8.0  # Espera tras la que se avisa "te respondemos en breve"
+    admission_max_queue_age: float = 120.0  # Mensajes más viejos se descartan
+    admission_busy_cooldown: float = 300.0  # Un aviso de demora por conversación en este lapso
+    admission_active_window: int = 1800  # Conversación activa (prioritaria): último intercambio hace menos de esto
+    
+    # Cola de trabajo (Redis Streams)
+    queue_enabled: bool = True
+    queue_shards: int = 16  # Particiones por teléfono (orden garantizado por shard)
+    queue_max_length: int = 100000
+    queue_lease_ttl_ms: int = 15000
+    queue_claim_idle_ms: int = 60000
+    worker_concurrency: int = 32  # Mensajes leídos por encima de ADMISSION_MAX_INFLIGHT (esperan turno por prioridad)
+    worker_metrics_port: int = 9100  # /metrics de cada worker (0 desactiva)
+    worker_block_ms: int = 2000
+
+    # Idempotencia por message_id
+    dedup_ttl: int = 86400  # Meta reintenta durante horas; 24h cubre los reintentos normales
+    dedup_local_size: int = 10000
+
+    # Agrupación de mensajes seguidos (0 desactiva)
+    coalesce_window_ms: int = 1500  # Silencio que cierra el turno
+    coalesce_max_wait_ms: int = 5000  # Tope de espera desde el primer mensaje
+
+    # Indicador "escribiendo..." junto con el visto
+    typing_indicator: bool = True
+
+    # Respuestas en streaming (varios mensajes mientras el LLM genera)
+    stream_replies: bool = True
+    stream_first_chunk_chars: int = 80  # El primer mensaje sale en el primer fin de oración después de esto
+    stream_min_chunk_chars: int = 200  # Los siguientes cortan en fin de párrafo después de esto
+    stream_max_chunk_chars: int = 700  # Sin párrafo a la vista, cortar en fin de oración
+
+    # Caché de respuestas para preguntas repetidas
+    answer_cache_enabled: bool = True
+    answer_cache_ttl: int = 604800  # 7 días
+    answer_cache_max_entries: int = 2000
+    answer_cache_similarity: float = 0.7  # Jaccard de trigramas para casi-duplicados
+    answer_cache_max_history: int = 0  # Mensajes previos permitidos (0 = solo primer turno)
+    answer_cache_max_question_chars: int = 200
+    answer_cache_index_refresh: float = 60.0  # Segundos entre recargas del índice local
+
+    # Logging (JSON en cola, redactado y muestreado)
+    log_level: str = "INFO"
+    log_format: str = "json"  # json | text
+    log_queue_size: int = 10000  # Si se llena, los logs se descartan (nunca bloquean)
+    log_sample_rates: str = "webhook_received=0.01,webhook_empty=0.01"  # evento=tasa
+    log_debug_token: str = ""  # Header X-Debug-Log para DEBUG en una petición
+    log_debug_phones: str = ""  # Números (coma) con logs DEBUG
+
+    # Configuración del bot (negocio por defecto)
     business_name: str = "Loopera"
     business_description: str = "Desarrollo de Agentes AI para empresas"
+
+    # Caché de transcripciones (por SHA-256 del audio y por media_id)
+    transcription_cache_enabled: bool = True
+    transcription_cache_ttl: int = 2592000  # 30 días
+    transcription_cache_local_size: int = 1000  # Entradas en memoria por worker
+
+    # Multi-tenant: negocios adicionales por phone_number_id
+    tenants_file: str = ""  # JSON con una lista de tenants
+    tenants_redis_key: str = ""  # Hash de Redis phone_number_id -> JSON
+    tenants_reload_interval: float = 30.0
+
+    # Rate limiting saliente (token buckets compartidos en Redis)
+    rate_limit_enabled: bool = True
+    rate_limit_max_wait: float = 10.0  # Segundos máximos esperando turno
+    rate_limit_max_retries: int = 2  # Reintentos ante 429 / throttling
+    whatsapp_sends_per_second: float = 80.0  # Por phone_number_id
+    groq_requests_per_minute: float = 1000.0  # Por modelo
+    groq_tokens_per_minute: float = 300000.0  # Por modelo
+    whisper_audio_seconds_per_hour: float = 100000.0
+    audio_bytes_per_second: float = 2000.0  # Estimación de duración (opus ~16 kbps)
     
     class Config:
         env_file = ".env"
@@ -0,0 +1,195 @@
+"""
+Logging estructurado sin bloquear el event loop
+
+Los handlers solo encolan el record (sin formatear); un hilo aparte lo
+formatea como JSON, redacta teléfonos y tokens y lo escribe. Las líneas de
+alto volumen se muestrean por evento (`extra={"event": ...}`) y el nivel
+DEBUG se puede activar solo para una petición o un número.
+"""
+import atexit
+import contextvars
+import logging
+import queue
+import random
+import re
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+import orjson
+
+from app.config import get_settings
+
+# Debug activado para la petición / mensaje en curso
+debug_context: contextvars.ContextVar[bool] = contextvars.ContextVar("debug_context", default=False)
+
+# Atributos estándar de LogRecord (el resto son campos de `extra`)
+RESERVED_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+# Números de 10 a 15 dígitos: corridos ("573001112233"), internacionales con
+# separadores ("+57 300 111 2233", "+1 (555) 123-4567") o locales 3-3-4
+# ("300-111-2233"). Fechas y horas no calzan con ninguna de las formas.
+PHONE_PATTERN = re.compile(
+    r"(?<![\w.+])(?:"
+    r"\+?\d{10,15}"
+    r"|\+\d{1,3}(?:[ \-]?\(?\d{1,4}\)?){1,4}[ \-]?\d{2,4}"
+    r"|\(?\d{3}\)?[ \-]\d{3}[ \-]\d{4}"
+    r")(?!\w)"
+)
+SECRET_PATTERNS = [
+    re.compile(r"(Bearer\s+)[\w\-.~+/]+=*", re.IGNORECASE),
+    re.compile(r"((?:access_token|api_key|token)[\"']?\s*[=:]\s*[\"']?)[\w\-.]+", re.IGNORECASE),
+    re.compile(r"()\bgsk_[A-Za-z0-9]{8,}"),  # Groq
+    re.compile(r"()\bEAA[A-Za-z0-9]{20,}"),  # Meta
+]
+
+
+def redact(text: str) -> str:
+    """Enmascarar teléfonos (quedan los últimos 4 dígitos) y credenciales"""
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(r"\1[REDACTED]", text)
+    return PHONE_PATTERN.sub(_mask_phone, text)
+
+
+def _mask_phone(match: re.Match) -> str:
+    digits = re.sub(r"\D", "", match.group())
+    if not 10 <= len(digits) <= 15:
+        return match.group()
+    return "***" + digits[-4:]
+
+
+def parse_sample_rates(value: str) -> Dict[str, float]:
+    """'webhook_received=0.1,send_response=0.01' -> {evento: tasa}"""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        event, _, rate = item.partition("=")
+        rates[event.strip()] = float(rate)
+    return rates
+
+
+@contextmanager
+def debug_logging(enabled: bool = True):
+    """Activar DEBUG solo dentro de este bloque (y las tareas que cree)"""
+    token = debug_context.set(enabled)
+    try:
+        yield
+    finally:
+        debug_context.reset(token)
+
+
+def debug_enabled_for(phone: Optional[str]) -> bool:
+    """Números configurados para loguear en DEBUG"""
+    phones = get_settings().log_debug_phones
+    return bool(phone and phones) and phone in {p.strip() for p in phones.split(",")}
+
+
+class ContextFilter(logging.Filter):
+    """
+    Corre en el hilo que loguea, así que debe ser barato: descarta DEBUG fuera
+    del modo debug y muestrea eventos de alto volumen.
+    """
+
+    def __init__(self, level: int, sample_rates: Dict[str, float]):
+        super().__init__()
+        self.level = level
+        self.sample_rates = sample_rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        debug = debug_context.get()
+        if record.levelno < self.level and not debug:
+            return False
+        rate = self.sample_rates.get(getattr(record, "event", None), 1.0)
+        if rate < 1.0 and not debug and random.random() >= rate:
+            return False
+        if debug:
+            record.debug = True
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Encola el record sin formatearlo; si la cola está llena, lo descarta"""
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # El formateo (msg % args, traceback) lo hace el hilo del listener
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Una línea JSON por record, con los campos de `extra` y redacción"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS:
+                entry[key] = redact(value) if isinstance(value, str) else value
+        if record.exc_info:
+            entry["exc"] = redact(self.formatException(record.exc_info))
+        return orjson.dumps(entry, default=str).decode()
+
+
+class RedactingFormatter(logging.Formatter):
+    """Formato de texto plano (desarrollo local), también redactado"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return redact(super().format(record))
+
+
+def setup_logging() -> QueueListener:
+    """
+    Configurar el logging del proceso (web o worker)
+
+    Returns:
+        El listener que escribe los logs (se detiene solo al salir)
+    """
+    settings = get_settings()
+
+    if settings.log_format == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = RedactingFormatter("%(levelname)s:%(name)s:%(message)s")
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(formatter)
+
+    level = logging.getLevelName(settings.log_level.upper())
+    log_queue: queue.Queue = queue.Queue(maxsize=settings.log_queue_size)
+    handler = NonBlockingQueueHandler(log_queue)
+    handler.addFilter(ContextFilter(level, parse_sample_rates(settings.log_sample_rates)))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    # Datos del record que no usamos y cuestan en cada llamada
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+
+    # Solo si hay modo debug configurado los loggers de la app emiten DEBUG
+    # (el filtro lo deja pasar únicamente dentro de una petición en debug)
+    if settings.log_debug_token or settings.log_debug_phones:
+        logging.getLogger("app").setLevel(logging.DEBUG)
+    # httpx loguea cada request a INFO: ruido en el camino caliente
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
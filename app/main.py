@@ -1,44 +1,131 @@
 """
 Loopera WhatsApp Bot - Aplicación Principal
 """
-import hmac
-import hashlib
+import asyncio
 import logging
+import time
 from contextlib import asynccontextmanager
+from functools import partial
 
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import PlainTextResponse
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 
 from app.config import get_settings
-from app.services import session_manager, whatsapp_service, groq_service
+from app.logging_config import debug_logging, setup_logging
+from app.metrics import CONTENT_TYPE_LATEST, WEBHOOK_ACK_SECONDS, process_exited, render
+from app.services import (
+    session_manager,
+    whatsapp_service,
+    message_queue,
+    message_deduplicator,
+    answer_cache,
+    transcription_cache,
+    tenant_registry,
+    rate_limiter,
+    close_redis_pools,
+)
+from app.pipeline import PhoneChain, process_message
+from app.warmup import readiness, warm_up
+from app.webhook import verify_signature, parse_body, extract_messages
 
 # Configurar logging
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
+# Mensajes procesándose en este proceso (sin cola), en orden por teléfono
+local_chain = PhoneChain()
+
+
+def dispatch_local(job: dict) -> asyncio.Task:
+    """Procesar un mensaje en su propia tarea, detrás del anterior del mismo número"""
+    return local_chain.dispatch(job.get("phone") or "", partial(_process_local, job))
+
+
+async def _process_local(job: dict, ingested: asyncio.Event):
+    await process_message(**job, ingested=ingested)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Gestión del ciclo de vida de la aplicación"""
+    settings = get_settings()
+
     # Startup
     logger.info("🚀 Iniciando Loopera WhatsApp Bot...")
 
+    # Pool HTTP compartido hacia Graph API
+    await whatsapp_service.start()
+
+    # Varios procesos web (y los workers, si la cola falla) pueden atender el
+    # mismo número: sin dueño por shard, las sesiones se leen siempre de Redis
+    session_manager.cache_reads = False
+
     # Conexión a Redis no bloqueante
     try:
         await session_manager.connect()
         logger.info("✅ Conectado a Redis")
     except Exception as e:
-        logger.warning(f"⚠️ No se pudo conectar a Redis: {e}")
-        logger.warning("El bot funcionará sin persistencia de sesiones")
+        logger.warning("⚠️ No se pudo conectar a Redis: %s", e)
+        logger.warning("Sesiones solo en memoria hasta que Redis vuelva")
+        session_manager.start_recovery()
+
+    # Idempotencia por message_id
+    try:
+        await message_deduplicator.connect()
+    except Exception as e:
+        logger.warning("⚠️ Dedup solo en memoria: %s", e)
+
+    # Tenants por phone_number_id (con recarga en caliente)
+    await tenant_registry.start()
+
+    # Transcripciones de audios repetidos / reenviados
+    if settings.transcription_cache_enabled:
+        await transcription_cache.connect()
+
+    # Cuotas de Meta y Groq compartidas entre procesos
+    await rate_limiter.connect()
+
+    # Caché de respuestas (versionada por system prompt de cada tenant)
+    if settings.answer_cache_enabled:
+        await answer_cache.connect()
+
+    # Cola durable (los workers consumen con `python -m app.worker`)
+    if settings.queue_enabled:
+        try:
+            await message_queue.connect()
+            await message_queue.ensure_groups()
+            logger.info("✅ Cola de mensajes lista")
+        except Exception as e:
+            await message_queue.disconnect()
+            logger.warning("⚠️ Cola no disponible, procesando en el proceso web: %s", e)
+
+    # Warm-up en background: el puerto abre ya (liveness) y /health pasa a
+    # listo al terminar. Groq solo hace falta si se procesa en este proceso.
+    warmup = asyncio.create_task(warm_up(readiness, groq=message_queue.redis is None))
 
     yield
 
     # Shutdown
+    readiness.state = "stopping"
+    warmup.cancel()
+    if local_chain.tasks:
+        # Terminar lo que ya se le confirmó a Meta antes de cerrar conexiones
+        logger.info("⏳ Esperando %d mensaje(s) en proceso...", len(local_chain.tasks))
+        await asyncio.wait(list(local_chain.tasks), timeout=settings.shutdown_drain_timeout)
     logger.info("👋 Cerrando conexiones...")
     try:
         await session_manager.disconnect()
     except Exception:
         pass
+    await whatsapp_service.close()
+    await message_queue.disconnect()
+    await message_deduplicator.disconnect()
+    await answer_cache.disconnect()
+    await tenant_registry.stop()
+    await rate_limiter.disconnect()
+    await transcription_cache.disconnect()
+    await close_redis_pools()
+    process_exited()
 
 
 app = FastAPI(
@@ -61,8 +148,42 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check para Railway"""
-    return {"status": "healthy"}
+    """Readiness (healthcheck de Railway/Render): 503 hasta terminar el warm-up y al apagar"""
+    return JSONResponse(readiness.report(), status_code=200 if readiness.ready else 503)
+
+
+@app.get("/health/live")
+async def liveness():
+    """Liveness: el proceso responde (no depende de Redis, Meta ni Groq)"""
+    return {"status": "alive"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Métricas Prometheus (de todos los procesos web si hay varios)"""
+    return Response(render(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.middleware("http")
+async def request_debug_logging(request: Request, call_next):
+    """Logs DEBUG solo para esta petición con `X-Debug-Log: <LOG_DEBUG_TOKEN>`"""
+    token = get_settings().log_debug_token
+    if token and request.headers.get("X-Debug-Log") == token:
+        with debug_logging():
+            return await call_next(request)
+    return await call_next(request)
+
+
+@app.middleware("http")
+async def measure_webhook_ack(request: Request, call_next):
+    """Latencia hasta responder a Meta (sin contar el trabajo en background)"""
+    if request.method != "POST" or not request.url.path.startswith("/webhook"):
+        return await call_next(request)
+    started = time.perf_counter()
+    try:
+        return await call_next(request)
+    finally:
+        WEBHOOK_ACK_SECONDS.observe(time.perf_counter() - started)
 
 
 @app.get("/webhook")
@@ -87,167 +208,77 @@ async def verify_webhook(request: Request):
 
 @app.post("/webhook")
 @app.post("/webhook/whatsapp")
-async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
-    # PRIMER LOG - antes de todo
-    logger.info("🚨🚨🚨 POST RECIBIDO EN WEBHOOK 🚨🚨🚨")
+async def receive_webhook(request: Request):
+    # PRIMER LOG - antes de todo (muestreado: es la línea de más volumen)
+    logger.info("🚨 POST recibido en webhook", extra={"event": "webhook_received"})
 
-    try:
-        body = await request.json()
-        logger.info(f"📦 Body recibido: {str(body)[:500]}")
+    settings = get_settings()
+    raw_body = await request.body()
 
-        # Extraer información del mensaje
-        entry = body.get("entry", [{}])[0]
-        changes = entry.get("changes", [{}])[0]
-        value = changes.get("value", {})
+    # Validar firma de Meta (solo si hay App Secret configurado)
+    if settings.whatsapp_app_secret and not verify_signature(
+        raw_body,
+        request.headers.get("X-Hub-Signature-256"),
+        settings.whatsapp_app_secret
+    ):
+        logger.warning("❌ Firma X-Hub-Signature-256 inválida")
+        raise HTTPException(status_code=403, detail="Invalid signature")
 
-        # Verificar si hay mensajes
-        messages = value.get("messages", [])
+    try:
+        body = parse_body(raw_body)
+        messages = extract_messages(body)
 
         if not messages:
             # Puede ser una actualización de estado, ignorar
-            logger.info("ℹ️ Webhook sin mensajes (posible status update)")
+            logger.info("ℹ️ Webhook sin mensajes (posible status update)", extra={"event": "webhook_empty"})
             return {"status": "ok"}
-        
-        message = messages[0]
-        
-        # Extraer datos del mensaje
-        phone = message.get("from")
-        message_id = message.get("id")
-        message_type = message.get("type")
-        
-        logger.info(f"📩 Mensaje recibido de {phone} - Tipo: {message_type}")
-        
-        # Procesar en background para responder rápido a Meta
-        background_tasks.add_task(
-            process_message,
-            phone=phone,
-            message=message,
-            message_type=message_type,
-            message_id=message_id
-        )
-        
-        # Responder inmediatamente a Meta (< 3 segundos)
-        return {"status": "ok"}
-    
-    except Exception as e:
-        logger.error(f"Error procesando webhook: {e}")
-        # Aún así retornar 200 para evitar reintentos de Meta
-        return {"status": "ok"}
 
+        logger.info("📦 Webhook con %d mensaje(s)", len(messages), extra={"event": "webhook_batch"})
 
-async def process_message(
-    phone: str,
-    message: dict,
-    message_type: str,
-    message_id: str
-):
-    """
-    Procesar mensaje en background
-    """
-    try:
-        # Marcar como leído
-        await whatsapp_service.mark_as_read(message_id)
-        
-        # Extraer texto según el tipo de mensaje
-        user_text = await extract_message_content(message, message_type)
-        
-        if not user_text:
-            await whatsapp_service.send_text_message(
-                phone,
-                "Lo siento, no pude procesar ese tipo de mensaje. ¿Podrías escribirme o enviarme una nota de voz?"
-            )
-            return
-        
-        logger.info(f"💬 Texto extraído: {user_text[:100]}...")
-        
-        # Obtener historial de conversación
-        session = await session_manager.get_session(phone)
-        history = session.get("history", [])
-        
-        # Generar respuesta con LLM
-        response = await groq_service.chat(
-            user_message=user_text,
-            conversation_history=history
-        )
-        
-        logger.info(f"🤖 Respuesta generada: {response[:100]}...")
-        
-        # Enviar respuesta
-        await whatsapp_service.send_text_message(phone, response)
-        
-        # Actualizar sesión
-        await session_manager.update_session(
-            phone=phone,
-            user_message=user_text,
-            bot_response=response,
-            metadata={"last_message_type": message_type}
-        )
-        
-        logger.info(f"✅ Mensaje procesado para {phone}")
-    
-    except Exception as e:
-        logger.error(f"Error procesando mensaje de {phone}: {e}")
-        
-        # Intentar enviar mensaje de error al usuario
-        try:
-            await whatsapp_service.send_text_message(
-                phone,
-                "Disculpa, tuve un problema procesando tu mensaje. ¿Podrías intentar de nuevo?"
+        for message, metadata in messages:
+            # Extraer datos del mensaje
+            phone = message.get("from")
+            message_id = message.get("id")
+            message_type = message.get("type")
+
+            # Descartar reintentos de Meta antes de cualquier trabajo costoso
+            if not await message_deduplicator.claim(message_id):
+                logger.info("🔁 Mensaje duplicado ignorado: %s", message_id, extra={"event": "duplicate"})
+                continue
+
+            logger.info(
+                "📩 Mensaje recibido de %s - Tipo: %s", phone, message_type,
+                extra={"event": "message_received"}
             )
-        except:
-            pass
 
+            job = {
+                "phone": phone,
+                "message": message,
+                "message_type": message_type,
+                "message_id": message_id,
+                "phone_number_id": metadata.get("phone_number_id"),
+                "received_at": time.time()
+            }
 
-async def extract_message_content(message: dict, message_type: str) -> str:
-    """
-    Extraer contenido del mensaje según su tipo
-    """
-    if message_type == "text":
-        return message.get("text", {}).get("body", "")
-    
-    elif message_type == "audio":
-        # Transcribir nota de voz
-        audio_id = message.get("audio", {}).get("id")
-        
-        if not audio_id:
-            return None
-        
-        logger.info(f"🎤 Descargando audio {audio_id}...")
-        
-        # Descargar audio
-        audio_bytes = await whatsapp_service.download_media(audio_id)
-        
-        if not audio_bytes:
-            logger.error("No se pudo descargar el audio")
-            return None
-        
-        logger.info(f"🎤 Transcribiendo audio ({len(audio_bytes)} bytes)...")
-        
-        # Transcribir
-        transcription = await groq_service.transcribe_audio(audio_bytes)
-        
-        logger.info(f"🎤 Transcripción: {transcription[:100]}...")
-        
-        return transcription
-    
-    elif message_type == "image":
-        # Por ahora solo texto de caption si existe
-        return message.get("image", {}).get("caption", "[Imagen recibida]")
-    
-    elif message_type == "document":
-        return message.get("document", {}).get("caption", "[Documento recibido]")
-    
-    elif message_type == "sticker":
-        return "[Sticker recibido] 😊"
-    
-    elif message_type == "location":
-        return "[Ubicación compartida]"
-    
-    elif message_type == "contacts":
-        return "[Contacto compartido]"
-    
-    else:
-        return None
+            # Encolar para los workers; si la cola falla, procesar aquí mismo
+            if message_queue.redis:
+                try:
+                    await message_queue.enqueue(job)
+                    continue
+                except Exception as e:
+                    logger.error("Error encolando mensaje %s: %s", message_id, e)
+
+            # Procesar en background para responder rápido a Meta (en paralelo
+            # entre números; BackgroundTasks los correría de a uno)
+            dispatch_local(job)
+
+        # Responder inmediatamente a Meta (< 3 segundos)
+        return {"status": "ok"}
+
+    except Exception as e:
+        logger.error("Error procesando webhook: %s", e)
+        # Aún así retornar 200 para evitar reintentos de Meta
+        return {"status": "ok"}
 
 
 if __name__ == "__main__":
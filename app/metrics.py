@@ -0,0 +1,104 @@
+"""
+Métricas Prometheus (latencia por etapa, volumen y errores)
+
+Con varios procesos uvicorn (`app.serve`) cada uno escribe sus métricas en
+`PROMETHEUS_MULTIPROC_DIR` y `/metrics` las agrega todas.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# Buckets pensados para llamadas de red: de 5 ms a 30 s
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+STAGE_SECONDS = Histogram(
+    "loopera_stage_seconds",
+    "Duración de cada etapa del procesamiento",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "loopera_stage_errors_total",
+    "Errores por etapa y clase de excepción",
+    ["stage", "error"],
+)
+MESSAGES = Counter(
+    "loopera_messages_total",
+    "Mensajes entrantes por tipo",
+    ["message_type"],
+)
+INFLIGHT = Gauge(
+    "loopera_inflight_tasks",
+    "Tareas en curso",
+    ["task"],
+    multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "loopera_cache_lookups_total",
+    "Consultas a cachés por resultado",
+    ["cache", "result"],
+)
+ADMISSION = Counter(
+    "loopera_admission_total",
+    "Mensajes por resultado del control de admisión",
+    ["result"],
+)
+ADMISSION_QUEUE = Gauge(
+    "loopera_admission_queue",
+    "Mensajes esperando turno para procesarse",
+    multiprocess_mode="livesum",
+)
+ROUTES = Counter(
+    "loopera_model_routes_total",
+    "Turnos por nivel de respuesta (plantilla, modelo chico o grande) y motivo",
+    ["tier", "reason"],
+)
+WEBHOOK_ACK_SECONDS = Histogram(
+    "loopera_webhook_ack_seconds",
+    "Tiempo hasta responder el webhook a Meta",
+    buckets=LATENCY_BUCKETS,
+)
+
+
+def multiprocess_dir() -> str:
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR", "")
+
+
+def registry() -> CollectorRegistry:
+    """Registro a exponer: el de este proceso o el agregado de todos"""
+    if not multiprocess_dir():
+        return REGISTRY
+    collected = CollectorRegistry()
+    multiprocess.MultiProcessCollector(collected)
+    return collected
+
+
+def render() -> bytes:
+    return generate_latest(registry())
+
+
+def process_exited():
+    """Sacar los gauges de este proceso del agregado (al apagarse)"""
+    if multiprocess_dir():
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def record_error(stage: str, error: BaseException):
+    STAGE_ERRORS.labels(stage, type(error).__name__).inc()
+
+
+@contextmanager
+def track(stage: str):
+    """Medir la duración de una etapa y contar sus errores por clase"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        record_error(stage, e)
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
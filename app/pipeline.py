@@ -0,0 +1,443 @@
+"""
+Pipeline de procesamiento de mensajes (compartido por la web y los workers)
+"""
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+from app.config import get_settings
+from app.logging_config import debug_context, debug_enabled_for
+from app.metrics import ADMISSION, INFLIGHT, MESSAGES, record_error
+from app.services import (
+    session_manager,
+    whatsapp_service,
+    groq_service,
+    message_coalescer,
+    conversation_summarizer,
+    answer_cache,
+    transcription_cache,
+    tenant_registry,
+    admission_controller,
+    model_router,
+)
+from app.services.admission_service import Overloaded
+from app.services.coalesce_service import MessageBatch
+from app.services.history_service import fit_history, history_entry
+from app.services.streaming_service import stream_reply
+from app.services.tenant_service import Tenant
+
+logger = logging.getLogger(__name__)
+
+# Respuestas enlatadas bajo sobrecarga (no pasan por el LLM)
+BUSY_REPLY = "Estamos recibiendo muchos mensajes en este momento 🙏 Ya tenemos el tuyo y te respondemos en breve."
+SHED_REPLY = "Estamos con mucha demanda en este momento 🙏 ¿Podrías escribirnos de nuevo en unos minutos?"
+
+
+class StageGroup:
+    """
+    Etapas secundarias de un mensaje que corren en paralelo al camino crítico
+    (download → transcribe → LLM → send). Al salir del bloque se esperan; si el
+    bloque falló, se cancelan, salvo las marcadas `cancel=False` (escrituras de
+    algo que ya se le envió al usuario).
+    """
+
+    def __init__(self):
+        self._tasks: Set[asyncio.Task] = set()
+        self._keep: Set[asyncio.Task] = set()
+
+    def spawn(self, coro: Awaitable, name: str, cancel: bool = True) -> asyncio.Task:
+        return self.track(asyncio.ensure_future(coro), name, cancel)
+
+    def track(self, task: asyncio.Task, name: str, cancel: bool = True) -> asyncio.Task:
+        self._tasks.add(task)
+        if not cancel:
+            self._keep.add(task)
+        task.add_done_callback(partial(self._done, name))
+        return task
+
+    def _done(self, name: str, task: asyncio.Task):
+        self._tasks.discard(task)
+        self._keep.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("⚠️ Etapa %s falló: %s", name, task.exception())
+            record_error(name, task.exception())
+
+    async def __aenter__(self) -> "StageGroup":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for task in self._tasks - self._keep:
+                task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class PhoneChain:
+    """
+    Una tarea por mensaje, encadenadas por teléfono: el siguiente mensaje de
+    un número arranca cuando el anterior ya fue extraído y agrupado, así se
+    suman en orden a la misma ventana del coalescer (que ordena las
+    respuestas). La usan el worker y el proceso web sin cola.
+    """
+
+    def __init__(self):
+        self.tasks: Set[asyncio.Task] = set()
+        self._tails: Dict[str, asyncio.Event] = {}  # Último mensaje del teléfono
+
+    def dispatch(self, phone: str, run: Callable[[asyncio.Event], Awaitable[None]]) -> asyncio.Task:
+        """
+        Args:
+            phone: Teléfono del usuario (la clave del orden)
+            run: Procesa el mensaje; recibe el evento `ingested` que debe
+                marcar al terminar la extracción (process_message lo hace)
+        """
+        previous = self._tails.get(phone)
+        ingested = asyncio.Event()
+        self._tails[phone] = ingested
+
+        async def chained():
+            if previous is not None:
+                await previous.wait()
+            await run(ingested)
+
+        task = asyncio.create_task(chained())
+        self.tasks.add(task)
+
+        def done(t: asyncio.Task):
+            self.tasks.discard(t)
+            ingested.set()
+            if self._tails.get(phone) is ingested:
+                del self._tails[phone]
+
+        task.add_done_callback(done)
+        return task
+
+
+async def process_message(
+    phone: str,
+    message: dict,
+    message_type: str,
+    message_id: str,
+    phone_number_id: Optional[str] = None,
+    received_at: Optional[float] = None,
+    ingested: Optional[asyncio.Event] = None,
+    ack: Optional[Callable[[], Awaitable[None]]] = None
+):
+    """
+    Procesar mensaje en background
+
+    `phone_number_id` es el número del negocio que recibió el mensaje y
+    define el tenant. `received_at` (epoch del webhook) mide cuánto lleva
+    esperando para el control de admisión. `ingested` se marca apenas el
+    mensaje queda extraído y agrupado, para que el worker pueda liberar el
+    siguiente mensaje del mismo número. `ack` confirma el mensaje en la cola:
+    si se sumó a un turno, recién cuando ese turno se respondió.
+    """
+    tenant = tenant_registry.resolve(phone_number_id)
+    if tenant is None:
+        logger.warning(
+            "🏢 Mensaje %s para un número sin tenant (%s), se descarta", message_id, phone_number_id,
+            extra={"event": "unknown_tenant"}
+        )
+        _mark(ingested)
+        if ack is not None:
+            await _acknowledge(ack, message_id)
+        return
+    MESSAGES.labels(message_type).inc()
+    INFLIGHT.labels("process_message").inc()
+    # Logs DEBUG para los números configurados (o si la petición ya venía en debug)
+    debug_token = debug_context.set(debug_context.get() or debug_enabled_for(phone))
+    
+    settings = get_settings()
+    session_key = tenant.session_key(phone)
+    
+    try:
+        # Turno según presupuesto y prioridad; bajo sobrecarga, aviso enlatado
+        admission = admission_controller.admit(
+            message_type,
+            returning=partial(_is_active, session_key, settings.admission_active_window),
+            received_at=received_at,
+            on_busy=partial(_notify_overload, phone, tenant, session_key, BUSY_REPLY)
+        )
+        async with admission, StageGroup() as stages:
+            # Visto + "escribiendo..." en una sola llamada, sin frenar la extracción
+            stages.spawn(
+                whatsapp_service.mark_as_read(message_id, tenant, typing=settings.typing_indicator),
+                "mark_as_read"
+            )
+            
+            # Si este mensaje va a abrir un turno, traer la sesión mientras se
+            # descarga/transcribe y dura la ventana de agrupación
+            checkpoint = message_coalescer.checkpoint(session_key)
+            prefetch = None
+            if checkpoint is not None:
+                prefetch = stages.spawn(session_manager.get_session(session_key), "session_prefetch")
+            
+            # Extraer texto según el tipo de mensaje
+            user_text = await extract_message_content(message, message_type, tenant)
+            
+            if not user_text:
+                _mark(ingested)
+                if prefetch is not None:
+                    prefetch.cancel()
+                await whatsapp_service.send_text_message(
+                    phone,
+                    "Lo siento, no pude procesar ese tipo de mensaje. ¿Podrías escribirme o enviarme una nota de voz?",
+                    tenant
+                )
+                return
+            
+            logger.debug("💬 Texto extraído: %.100s", user_text)
+            
+            # Agrupar con mensajes seguidos del mismo número: un solo turno, una respuesta
+            batch = message_coalescer.add(session_key, user_text, message_type, ack=ack)
+            ack = None  # Queda a cargo del turno
+            _mark(ingested)
+            
+            # La sesión precargada solo vale si nadie respondió otro turno entretanto
+            if prefetch is not None and not (batch and message_coalescer.unchanged(checkpoint)):
+                prefetch.cancel()
+                prefetch = None
+            
+            if batch:
+                await message_coalescer.flush(
+                    batch, partial(respond, phone=phone, tenant=tenant, stages=stages, session=prefetch)
+                )
+    
+    except Overloaded as e:
+        logger.warning(
+            "🚦 Mensaje de %s descartado por sobrecarga: %s", phone, e,
+            extra={"event": "message_shed"}
+        )
+        await _notify_overload(phone, tenant, f"shed:{session_key}", SHED_REPLY)
+    
+    except Exception as e:
+        logger.error("Error procesando mensaje de %s: %s", phone, e)
+        record_error("process_message", e)
+        
+        # Intentar enviar mensaje de error al usuario
+        try:
+            await whatsapp_service.send_text_message(
+                phone,
+                "Disculpa, tuve un problema procesando tu mensaje. ¿Podrías intentar de nuevo?",
+                tenant
+            )
+        except:
+            pass
+    
+    except asyncio.CancelledError:
+        ack = None  # Sin confirmar: la cola lo vuelve a entregar
+        raise
+    
+    finally:
+        _mark(ingested)
+        if ack is not None:
+            await _acknowledge(ack, message_id)
+        INFLIGHT.labels("process_message").dec()
+        debug_context.reset(debug_token)
+
+
+async def respond(
+    batch: MessageBatch,
+    phone: str,
+    tenant: Tenant,
+    stages: Optional[StageGroup] = None,
+    session: Optional["asyncio.Future[dict]"] = None
+):
+    """
+    Generar y enviar la respuesta a un turno (uno o más mensajes agrupados)
+
+    `session` es la sesión precargada mientras se extraía el mensaje; lo que
+    va después del envío (guardar sesión, cachear) queda en `stages`.
+    """
+    with INFLIGHT.labels("respond").track_inprogress():
+        if stages is None:
+            async with StageGroup() as stages:
+                await _respond(batch, phone, tenant, stages, session)
+        else:
+            await _respond(batch, phone, tenant, stages, session)
+
+
+async def _respond(
+    batch: MessageBatch,
+    phone: str,
+    tenant: Tenant,
+    stages: StageGroup,
+    session: Optional["asyncio.Future[dict]"]
+):
+    settings = get_settings()
+    session_key = batch.key
+    user_text = batch.text
+    
+    # Obtener historial de conversación
+    session = await session if session is not None else await session_manager.get_session(session_key)
+    history, overflow = fit_history(session.get("history", []), settings.history_token_budget)
+    
+    # Intenciones triviales sin LLM; el resto, al modelo chico o al del tenant
+    route = model_router.route(user_text, tenant, session.get("history", []), session.get("summary"))
+    if route.reply is not None:
+        await whatsapp_service.send_text_message(phone, route.reply, tenant)
+        _save_turn(stages, batch, route.reply)
+        logger.info("✅ Mensaje procesado para %s (plantilla %s)", phone, route.reason, extra={"event": "message_processed"})
+        return
+    
+    # Preguntas frecuentes de primer turno: responder desde la caché
+    cacheable = answer_cache.eligible(user_text, session.get("history", []), session.get("summary"), route.tier)
+    if cacheable:
+        try:
+            cached = await answer_cache.lookup(user_text, tenant.prompt_version)
+        except Exception as e:
+            logger.warning("⚠️ Caché de respuestas no disponible: %s", e)
+            cacheable, cached = False, None
+        if cached:
+            await whatsapp_service.send_text_message(phone, cached, tenant)
+            _save_turn(stages, batch, cached)
+            logger.info("✅ Mensaje procesado para %s (desde caché)", phone, extra={"event": "message_processed"})
+            return
+    
+    # Generar respuesta con LLM (solo lo que entra en el presupuesto + resumen)
+    chat_args = dict(
+        user_message=user_text,
+        conversation_history=history,
+        system_prompt=tenant.system_prompt,
+        summary=session.get("summary"),
+        model=route.model,
+        temperature=tenant.temperature,
+        max_tokens=route.max_tokens
+    )
+    
+    if settings.stream_replies:
+        # Enviar por partes mientras se genera
+        response = await stream_reply(phone, groq_service.chat_stream(**chat_args), tenant)
+        logger.debug("🤖 Respuesta generada: %.100s", response)
+    else:
+        response = await groq_service.chat(**chat_args)
+        logger.debug("🤖 Respuesta generada: %.100s", response)
+        
+        # Enviar respuesta
+        await whatsapp_service.send_text_message(phone, response, tenant)
+    
+    # Actualizar sesión y caché sin demorar nada más (la respuesta ya salió)
+    _save_turn(stages, batch, response)
+    
+    if cacheable:
+        stages.spawn(answer_cache.store(user_text, response, tenant.prompt_version), "answer_cache")
+    
+    # Lo que ya no entra en el presupuesto se resume en background
+    if overflow or conversation_summarizer.needs_summary(
+        history + [history_entry("user", user_text), history_entry("assistant", response)]
+    ):
+        conversation_summarizer.schedule(session_key, tenant.business_name)
+    
+    logger.info(
+        "✅ Mensaje procesado para %s (%d mensaje(s) en el turno)", phone, len(batch.texts),
+        extra={"event": "message_processed"}
+    )
+
+
+def _save_turn(stages: StageGroup, batch: MessageBatch, response: str):
+    """Guardar el turno después de enviar; el próximo get_session espera esta escritura"""
+    stages.track(session_manager.update_session_later(
+        phone=batch.key,
+        user_message=batch.text,
+        bot_response=response,
+        metadata={"last_message_type": batch.message_type}
+    ), "redis_update", cancel=False)
+
+
+async def _is_active(session_key: str, window: int) -> bool:
+    """Conversación con un intercambio reciente (prioridad de admisión)"""
+    last = await session_manager.last_active(session_key)
+    return last is not None and time.time() - last < window
+
+
+async def _notify_overload(phone: str, tenant: Tenant, key: str, text: str):
+    """Respuesta enlatada (una por conversación cada tanto, nunca falla)"""
+    if not admission_controller.should_notify(key):
+        return
+    try:
+        await whatsapp_service.send_text_message(phone, text, tenant)
+        ADMISSION.labels("busy_reply" if text is BUSY_REPLY else "shed_reply").inc()
+    except Exception as e:
+        logger.warning("⚠️ No se pudo enviar el aviso de demora a %s: %s", phone, e)
+
+
+async def _acknowledge(ack: Callable[[], Awaitable[None]], message_id: str):
+    """Confirmar un mensaje que no llegó a un turno (descartado o sin contenido)"""
+    try:
+        await ack()
+    except Exception as e:
+        logger.error("Error confirmando el mensaje %s: %s", message_id, e)
+
+
+def _mark(event: Optional[asyncio.Event]):
+    if event is not None:
+        event.set()
+
+
+async def extract_message_content(message: dict, message_type: str, tenant: Optional[Tenant] = None) -> str:
+    """
+    Extraer contenido del mensaje según su tipo
+    """
+    if message_type == "text":
+        return message.get("text", {}).get("body", "")
+    
+    elif message_type == "audio":
+        # Transcribir nota de voz
+        audio = message.get("audio", {})
+        audio_id = audio.get("id")
+        
+        if not audio_id:
+            return None
+        
+        settings = get_settings()
+        
+        # El mismo media_id ya transcrito: ni siquiera hace falta descargarlo
+        if settings.transcription_cache_enabled:
+            transcription = await transcription_cache.lookup_media(audio_id)
+            if transcription is not None:
+                return transcription
+        
+        logger.debug("🎤 Descargando audio %s...", audio_id)
+        
+        # Descargar audio
+        audio_bytes = await whatsapp_service.download_media(audio_id, tenant)
+        
+        if not audio_bytes:
+            logger.error("No se pudo descargar el audio")
+            return None
+        
+        logger.info("🎤 Transcribiendo audio (%d bytes)...", len(audio_bytes))
+        
+        # Transcribir (un audio reenviado reutiliza la transcripción por su contenido)
+        transcribe = partial(groq_service.transcribe_audio, audio_bytes, mime_type=audio.get("mime_type"))
+        if settings.transcription_cache_enabled:
+            transcription = await transcription_cache.transcribe(audio_bytes, audio_id, transcribe)
+        else:
+            transcription = await transcribe()
+        
+        logger.debug("🎤 Transcripción: %.100s", transcription)
+        
+        return transcription
+    
+    elif message_type == "image":
+        # Por ahora solo texto de caption si existe
+        return message.get("image", {}).get("caption", "[Imagen recibida]")
+    
+    elif message_type == "document":
+        return message.get("document", {}).get("caption", "[Documento recibido]")
+    
+    elif message_type == "sticker":
+        return "[Sticker recibido] 😊"
+    
+    elif message_type == "location":
+        return "[Ubicación compartida]"
+    
+    elif message_type == "contacts":
+        return "[Contacto compartido]"
+    
+    else:
+        return None
@@ -0,0 +1,108 @@
+"""
+Servidor web de producción - uvicorn con varios procesos
+
+Uso: python -m app.serve (puerto en $PORT)
+"""
+import glob
+import logging
+import math
+import os
+import shutil
+import tempfile
+
+import uvicorn
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus() -> int:
+    """CPUs que puede usar el proceso: afinidad y cuota de cgroup (contenedores)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+
+    # cgroup v2 ("max 100000" o "200000 100000") y v1
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def worker_count() -> int:
+    """`WEB_CONCURRENCY` o, en 0, una por CPU disponible (con tope)"""
+    settings = get_settings()
+    if settings.web_concurrency > 0:
+        return settings.web_concurrency
+    return max(1, min(available_cpus(), settings.web_max_concurrency))
+
+
+def prepare_metrics_dir() -> str:
+    """
+    Métricas multiproceso: cada proceso uvicorn escribe las suyas en un
+    directorio compartido y `/metrics` las agrega. Se hereda por entorno,
+    así que tiene que existir antes de levantar los procesos.
+
+    Returns:
+        Directorio temporal creado aquí (a borrar al salir), o "" si ya venía configurado
+    """
+    configured = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if configured:
+        # Lo de una ejecución anterior se sumaría a los contadores
+        os.makedirs(configured, exist_ok=True)
+        for path in glob.glob(os.path.join(configured, "*.db")):
+            os.remove(path)
+        return ""
+    created = tempfile.mkdtemp(prefix="loopera-metrics-")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = created
+    return created
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:%(name)s:%(message)s")
+    settings = get_settings()
+    port = int(os.environ.get("PORT", 8080))
+    workers = worker_count()
+
+    if workers > 1 and not settings.queue_enabled:
+        # Sin cola, la agrupación y el orden por número son por proceso
+        logger.warning("⚠️ %d procesos web sin QUEUE_ENABLED: el orden por número no está garantizado", workers)
+    logger.info("🚀 Iniciando %d proceso(s) web en el puerto %d", workers, port)
+
+    metrics_dir = prepare_metrics_dir() if workers > 1 else ""
+    try:
+        uvicorn.run(
+            "app.main:app",
+            host="0.0.0.0",
+            port=port,
+            workers=workers,
+            proxy_headers=True,
+            forwarded_allow_ips="*",
+            log_level=settings.log_level.lower(),
+            access_log=False,
+        )
+    finally:
+        if metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,35 @@
 """
 Servicios del bot
 """
-from app.services.redis_service import session_manager
+from app.services.redis_service import close_redis_pools, session_manager
+from app.services.tenant_service import tenant_registry
+from app.services.rate_limit_service import rate_limiter
 from app.services.whatsapp_service import whatsapp_service
 from app.services.groq_service import groq_service
+from app.services.audio_service import audio_transcoder
+from app.services.queue_service import message_queue
+from app.services.dedup_service import message_deduplicator
+from app.services.coalesce_service import message_coalescer
+from app.services.summary_service import conversation_summarizer
+from app.services.answer_cache_service import answer_cache
+from app.services.transcription_cache_service import transcription_cache
+from app.services.admission_service import admission_controller
+from app.services.routing_service import model_router
 
-__all__ = ["session_manager", "whatsapp_service", "groq_service"]
+__all__ = [
+    "session_manager",
+    "close_redis_pools",
+    "whatsapp_service",
+    "groq_service",
+    "audio_transcoder",
+    "message_queue",
+    "message_deduplicator",
+    "message_coalescer",
+    "conversation_summarizer",
+    "answer_cache",
+    "tenant_registry",
+    "rate_limiter",
+    "transcription_cache",
+    "admission_controller",
+    "model_router",
+]
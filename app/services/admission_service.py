@@ -0,0 +1,214 @@
+"""
+Control de admisión: cuántos mensajes se procesan a la vez y cuáles esperan
+"""
+import asyncio
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Union
+
+from app.config import get_settings
+from app.metrics import ADMISSION, ADMISSION_QUEUE, STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    """El mensaje no se procesa: cola llena o esperó demasiado"""
+
+
+@dataclass(order=True)
+class _Waiter:
+    priority: int
+    seq: int
+    kind: str = field(compare=False)
+    received_at: float = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class AdmissionController:
+    """
+    Presupuesto de mensajes en curso (total y de audio, que ocupa ffmpeg y
+    Whisper) con una cola acotada por prioridad. Menor número = antes:
+    conversaciones activas antes que nuevas, texto antes que audio.
+
+    La sobrecarga se mide por la edad de lo que espera (desde que llegó el
+    webhook): pasado `busy_after` se avisa al usuario una vez, pasado
+    `max_queue_age` se descarta. Si la cola está llena, se descarta lo de
+    peor prioridad.
+    """
+
+    def __init__(self):
+        s = get_settings()
+        self.budgets = {"total": s.admission_max_inflight, "audio": s.admission_audio_max_inflight}
+        self.queue_size = s.admission_queue_size
+        self.busy_after = s.admission_busy_after
+        self.max_queue_age = s.admission_max_queue_age
+        self.busy_cooldown = s.admission_busy_cooldown
+        self._active: Dict[str, int] = {"total": 0, "audio": 0}
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._notified: Dict[str, float] = {}  # Último aviso de demora por conversación
+
+    @staticmethod
+    def priority(message_type: str, returning: bool) -> int:
+        return (0 if returning else 2) + (1 if message_type == "audio" else 0)
+
+    def queue_age(self) -> float:
+        """Segundos que lleva esperando el mensaje más viejo de la cola"""
+        if not self._waiters:
+            return 0.0
+        return time.time() - min(w.received_at for w in self._waiters)
+
+    def overloaded(self) -> bool:
+        return self.queue_age() > self.busy_after
+
+    def _fits(self, kind: str) -> bool:
+        if self._active["total"] >= self.budgets["total"]:
+            return False
+        return kind != "audio" or self._active["audio"] < self.budgets["audio"]
+
+    def _take(self, kind: str):
+        self._active["total"] += 1
+        if kind == "audio":
+            self._active["audio"] += 1
+
+    def _release(self, kind: str):
+        self._active["total"] -= 1
+        if kind == "audio":
+            self._active["audio"] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Dar cupo, en orden de prioridad, a los que entren en el presupuesto"""
+        for waiter in sorted(self._waiters):
+            if self._fits(waiter.kind):
+                self._remove(waiter)
+                self._take(waiter.kind)
+                waiter.future.set_result(None)
+                if not self._fits("text"):
+                    break
+
+    def _remove(self, waiter: _Waiter):
+        self._waiters.remove(waiter)
+        ADMISSION_QUEUE.set(len(self._waiters))
+
+    def should_notify(self, key: str) -> bool:
+        """Un solo aviso de demora por conversación cada `busy_cooldown`"""
+        now = time.monotonic()
+        if now - self._notified.get(key, float("-inf")) < self.busy_cooldown:
+            return False
+        self._notified[key] = now
+        if len(self._notified) > self.queue_size * 4:
+            self._notified = {k: t for k, t in self._notified.items() if now - t < self.busy_cooldown}
+        return True
+
+    @asynccontextmanager
+    async def admit(
+        self,
+        message_type: str,
+        returning: Union[bool, Callable[[], Awaitable[bool]]],
+        received_at: Optional[float] = None,
+        on_busy: Optional[Callable[[], Awaitable]] = None
+    ) -> AsyncIterator[None]:
+        """
+        Esperar turno para procesar un mensaje
+
+        Args:
+            message_type: "audio" usa además el presupuesto de audio
+            returning: La conversación tiene historial reciente (o cómo averiguarlo:
+                solo se consulta si el mensaje tiene que esperar)
+            received_at: Epoch en que llegó el webhook (incluye la espera en la cola de Redis)
+            on_busy: Aviso al usuario si la espera pasa de `busy_after`
+
+        Raises:
+            Overloaded: Si se descartó (cola llena o espera mayor a `max_queue_age`)
+        """
+        kind = "audio" if message_type == "audio" else "text"
+        received_at = received_at or time.time()
+        started = time.perf_counter()
+
+        if time.time() - received_at > self.max_queue_age:
+            ADMISSION.labels("expired").inc()
+            raise Overloaded(f"mensaje con {time.time() - received_at:.0f}s de antigüedad")
+
+        if not self._waiters and self._fits(kind):
+            self._take(kind)
+            ADMISSION.labels("admitted").inc()
+        else:
+            if callable(returning):
+                try:
+                    returning = await returning()
+                except Exception as e:
+                    logger.debug("Prioridad sin historial: %s", e)
+                    returning = False
+            await self._wait(kind, self.priority(message_type, returning), received_at, on_busy)
+            ADMISSION.labels("queued").inc()
+        STAGE_SECONDS.labels("admission_wait").observe(time.perf_counter() - started)
+
+        try:
+            yield
+        finally:
+            self._release(kind)
+
+    async def _wait(
+        self,
+        kind: str,
+        priority: int,
+        received_at: float,
+        on_busy: Optional[Callable[[], Awaitable]]
+    ):
+        if len(self._waiters) >= self.queue_size:
+            # Cola llena: sale el de peor prioridad (este mismo si no mejora a nadie)
+            worst = max(self._waiters)
+            if worst.priority <= priority:
+                ADMISSION.labels("shed").inc()
+                raise Overloaded("cola de admisión llena")
+            self._remove(worst)
+            worst.future.set_exception(Overloaded("desplazado por un mensaje de mayor prioridad"))
+            logger.warning("🚦 Cola de admisión llena: se descarta un mensaje de prioridad %d", worst.priority)
+
+        waiter = _Waiter(priority, next(self._seq), kind, received_at, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        ADMISSION_QUEUE.set(len(self._waiters))
+        # Puede haber cupo de texto aunque esperen audios
+        self._dispatch()
+
+        def granted() -> bool:
+            future = waiter.future
+            return future.done() and not future.cancelled() and future.exception() is None
+
+        try:
+            busy_in = received_at + self.busy_after - time.time()
+            if on_busy is not None and busy_in > 0:
+                await asyncio.wait([waiter.future], timeout=busy_in)
+            if not waiter.future.done():
+                if on_busy is not None:
+                    await on_busy()
+                remaining = received_at + self.max_queue_age - time.time()
+                await asyncio.wait_for(asyncio.shield(waiter.future), max(0.0, remaining))
+            else:
+                waiter.future.result()
+        except asyncio.TimeoutError:
+            if granted():
+                return  # El cupo llegó junto con el timeout
+            ADMISSION.labels("expired").inc()
+            raise Overloaded(f"esperó más de {self.max_queue_age:.0f}s")
+        except Overloaded:
+            ADMISSION.labels("shed").inc()
+            raise
+        except BaseException:
+            # Si el cupo llegó justo al cancelar, devolverlo
+            if granted():
+                self._release(kind)
+            raise
+        finally:
+            if waiter in self._waiters:
+                self._remove(waiter)
+                waiter.future.cancel()
+
+
+# Instancia global
+admission_controller = AdmissionController()
@@ -0,0 +1,204 @@
+"""
+Caché de respuestas para preguntas repetidas de prospectos
+"""
+import hashlib
+import logging
+import re
+import time
+import unicodedata
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+import redis.asyncio as redis
+
+from app.config import get_settings
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+NON_WORD = re.compile(r"[^a-z0-9ñ ]+")
+SPACES = re.compile(r"\s+")
+
+# Palabras que cambian el sentido pero casi no los n-gramas ("no quiero
+# agendar una demo" vs "quiero agendar una demo" da 0.88): un casi-duplicado
+# tiene que tener exactamente las mismas
+NEGATIONS = frozenset({
+    "no", "ni", "nunca", "jamas", "tampoco", "sin", "nada", "nadie", "ningun", "ninguna", "ninguno",
+})
+NUMBER_WORDS = frozenset({
+    "uno", "dos", "tres", "cuatro", "cinco", "seis", "siete", "ocho", "nueve", "diez",
+    "once", "doce", "quince", "veinte", "treinta", "cuarenta", "cincuenta", "cien", "ciento",
+    "doscientos", "trescientos", "quinientos", "mil", "millon", "millones",
+})
+
+# Datos de una persona: una respuesta que los contiene (o que responde a una
+# pregunta que los contiene) no se le puede servir a otro usuario
+PERSONAL_PATTERNS = [
+    re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"),  # Emails
+    re.compile(r"\d(?:[ -]?\d){6,}"),  # Teléfonos, documentos, pedidos (7+ dígitos)
+    re.compile(r"(?i:\b(?:me llamo|mi nombre es)\b)"),
+    re.compile(r"(?i:\b(?:soy|habla|hola|gracias|gusto)\b),?\s+[A-ZÁÉÍÓÚÑ][a-záéíóúñ]+"),  # "Soy Ana", "¡Hola Ana!"
+]
+
+
+def normalize_question(text: str) -> str:
+    """Minúsculas, sin tildes, sin signos ni emojis, espacios colapsados"""
+    text = unicodedata.normalize("NFKD", (text or "").lower().replace("ñ", "\0"))
+    text = "".join(c for c in text if not unicodedata.combining(c)).replace("\0", "ñ")
+    return SPACES.sub(" ", NON_WORD.sub(" ", text)).strip()
+
+
+def char_ngrams(text: str, n: int = 3) -> FrozenSet[str]:
+    """Conjunto de n-gramas de caracteres (con bordes para textos cortos)"""
+    padded = f" {text} "
+    if len(padded) <= n:
+        return frozenset([padded])
+    return frozenset(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def sense_tokens(normalized: str) -> FrozenSet[str]:
+    """Negaciones y cantidades de una pregunta normalizada"""
+    return frozenset(
+        word for word in normalized.split()
+        if word in NEGATIONS or word in NUMBER_WORDS or any(c.isdigit() for c in word)
+    )
+
+
+def question_shape(normalized: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """N-gramas (similitud) y negaciones/cantidades (deben coincidir)"""
+    return char_ngrams(normalized), sense_tokens(normalized)
+
+
+def is_personal(text: str) -> bool:
+    """Nombres, emails o cifras largas (texto original, sin normalizar)"""
+    return any(pattern.search(text or "") for pattern in PERSONAL_PATTERNS)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class AnswerCache:
+    """
+    Exacto: respuesta por hash del texto normalizado (Redis, con TTL).
+    Casi-duplicados: índice local de n-gramas de las preguntas cacheadas,
+    sincronizado desde Redis; solo valen con las mismas negaciones y cifras.
+    Todo va bajo la versión del system prompt (una por tenant), así un cambio
+    de prompt invalida sus respuestas.
+
+    La caché es compartida entre los usuarios del tenant: solo guarda
+    respuestas del modelo del tenant a preguntas de primer turno, y nunca
+    si la pregunta o la respuesta traen datos personales.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self._indexes: Dict[str, Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]]] = {}
+        self._loaded_at: Dict[str, float] = {}
+
+    async def connect(self):
+        """Conectar a Redis"""
+        self.redis = create_redis()
+
+    async def disconnect(self):
+        """Desconectar de Redis"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    @staticmethod
+    def _answer_key(version: str, key: str) -> str:
+        return f"answers:{version}:a:{key}"
+
+    @staticmethod
+    def _index_key(version: str) -> str:
+        return f"answers:{version}:index"
+
+    @staticmethod
+    def _questions_key(version: str) -> str:
+        return f"answers:{version}:questions"
+
+    def eligible(self, text: str, history: List[dict], summary: str = "", tier: str = "large") -> bool:
+        """Primeros turnos, modelo del tenant y preguntas cortas sin datos personales"""
+        return (
+            self.redis is not None
+            and tier == "large"
+            and not summary
+            and len(history) <= self.settings.answer_cache_max_history
+            and 0 < len(text) <= self.settings.answer_cache_max_question_chars
+            and not is_personal(text)
+        )
+
+    async def lookup(self, text: str, version: str) -> Optional[str]:
+        """Buscar respuesta exacta y, si no hay, la pregunta más parecida"""
+        normalized = normalize_question(text)
+        if not normalized:
+            return None
+
+        key = hashlib.sha1(normalized.encode()).hexdigest()
+        answer = await self.redis.get(self._answer_key(version, key))
+        if answer:
+            logger.info("💾 Respuesta cacheada (exacta): %s", normalized[:60])
+            return answer
+
+        index = await self._index_for(version)
+        grams, sense = question_shape(normalized)
+        best_key, best_score = None, 0.0
+        for candidate, (candidate_grams, candidate_sense) in index.items():
+            if candidate_sense != sense:
+                continue
+            score = jaccard(grams, candidate_grams)
+            if score > best_score:
+                best_key, best_score = candidate, score
+
+        if best_key and best_score >= self.settings.answer_cache_similarity:
+            answer = await self.redis.get(self._answer_key(version, best_key))
+            if answer:
+                logger.info("💾 Respuesta cacheada (similitud %.2f): %s", best_score, normalized[:60])
+                return answer
+            # Expiró por TTL: sacarla del índice local
+            index.pop(best_key, None)
+
+        return None
+
+    async def store(self, text: str, answer: str, version: str):
+        """Guardar respuesta con TTL y acotar el índice (las más viejas salen)"""
+        normalized = normalize_question(text)
+        if not normalized or not answer or is_personal(text) or is_personal(answer):
+            return
+
+        key = hashlib.sha1(normalized.encode()).hexdigest()
+        max_entries = self.settings.answer_cache_max_entries
+        index_key, questions_key = self._index_key(version), self._questions_key(version)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self._answer_key(version, key), answer, ex=self.settings.answer_cache_ttl)
+        pipe.hset(questions_key, key, normalized)
+        pipe.zadd(index_key, {key: time.time()})
+        pipe.zrange(index_key, 0, -max_entries - 1)
+        pipe.zremrangebyrank(index_key, 0, -max_entries - 1)
+        for k in (questions_key, index_key):
+            pipe.expire(k, self.settings.answer_cache_ttl)
+        *_, evicted, _, _, _ = await pipe.execute()
+
+        index = self._indexes.setdefault(version, {})
+        if evicted:
+            await self.redis.hdel(questions_key, *evicted)
+            for old in evicted:
+                index.pop(old, None)
+
+        index[key] = question_shape(normalized)
+
+    async def _index_for(self, version: str) -> Dict[str, Tuple[FrozenSet[str], FrozenSet[str]]]:
+        """Índice local de la versión, recargado desde Redis cada cierto tiempo"""
+        now = time.monotonic()
+        if now - self._loaded_at.get(version, 0.0) >= self.settings.answer_cache_index_refresh:
+            self._loaded_at[version] = now
+            questions = await self.redis.hgetall(self._questions_key(version))
+            self._indexes[version] = {key: question_shape(q) for key, q in questions.items()}
+        return self._indexes.setdefault(version, {})
+
+
+# Instancia global
+answer_cache = AnswerCache()
@@ -0,0 +1,298 @@
+"""
+Servicio de audio - preparación en memoria con ffmpeg
+
+Antes de Whisper cada nota de voz pasa por ffmpeg una vez: se recortan los
+silencios del principio y del final, las pausas largas se acortan y se
+recomprime a Opus de bajo bitrate (16 kHz mono). La misma pasada mide la
+duración resultante y dónde quedan las pausas, para trocear las notas largas
+en partes que se transcriben en paralelo.
+"""
+import asyncio
+import contextlib
+import logging
+import re
+import subprocess
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from app.config import get_settings
+from app.metrics import track
+
+logger = logging.getLogger(__name__)
+
+# Subtipos MIME -> extensión que entiende Whisper
+MIME_EXTENSIONS = {
+    "ogg": "ogg",
+    "opus": "ogg",
+    "mpeg": "mp3",
+    "mp3": "mp3",
+    "mp4": "m4a",
+    "m4a": "m4a",
+    "x-m4a": "m4a",
+    "wav": "wav",
+    "x-wav": "wav",
+    "webm": "webm",
+    "flac": "flac",
+    "aac": "aac",
+    "amr": "amr",
+}
+
+# Formato de salida del preprocesamiento -> argumentos del codificador
+OUTPUT_CODECS = {
+    "ogg": ["-c:a", "libopus", "-application", "voip"],
+    "mp3": ["-c:a", "libmp3lame"],
+}
+
+_SILENCE_START = re.compile(rb"silence_start: (-?[\d.]+)")
+_SILENCE_END = re.compile(rb"silence_end: (-?[\d.]+)")
+_TIME = re.compile(rb"time=(\d+):(\d+):([\d.]+)")
+_EMPTY = re.compile(rb"Output file is empty|audio:0Ki?B")
+
+
+@dataclass
+class PreparedAudio:
+    """Audio listo para subir a Whisper"""
+    filename: str
+    data: bytes
+    seconds: Optional[float] = None  # Duración después de recortar (None si no se midió)
+    pauses: List[float] = field(default_factory=list)  # Centro de cada pausa, en segundos
+
+
+def parse_ffmpeg_stats(stderr: bytes) -> Tuple[Optional[float], List[float]]:
+    """
+    Duración de la salida (último `time=` del progreso) y centro de las pausas
+    que reportó `silencedetect`, a partir del stderr de ffmpeg
+    """
+    seconds = None
+    times = _TIME.findall(stderr)
+    if times:
+        hours, minutes, secs = times[-1]
+        seconds = int(hours) * 3600 + int(minutes) * 60 + float(secs)
+    elif _EMPTY.search(stderr):
+        seconds = 0.0  # Todo era silencio
+
+    starts = [float(v) for v in _SILENCE_START.findall(stderr)]
+    ends = [float(v) for v in _SILENCE_END.findall(stderr)]
+    pauses = [max(0.0, (start + end) / 2) for start, end in zip(starts, ends)]
+    return seconds, pauses
+
+
+def plan_chunks(
+    seconds: float,
+    pauses: List[float],
+    chunk_seconds: float,
+    max_chunks: int
+) -> List[Tuple[float, Optional[float]]]:
+    """
+    Cortes (inicio, fin) para trocear un audio en partes de hasta
+    `chunk_seconds`, cortando en la última pausa de la segunda mitad de cada
+    parte para no partir palabras (o a la fuerza si no hay pausa). Con más de
+    `max_chunks` partes se alargan. La última parte va hasta el final (fin None).
+    """
+    if chunk_seconds <= 0 or max_chunks <= 1 or seconds <= chunk_seconds:
+        return [(0.0, None)]
+    chunk_seconds = max(chunk_seconds, seconds / max_chunks)
+
+    chunks: List[Tuple[float, Optional[float]]] = []
+    start = 0.0
+    while seconds - start > chunk_seconds and len(chunks) < max_chunks - 1:
+        limit = start + chunk_seconds
+        candidates = [p for p in pauses if start + chunk_seconds / 2 <= p <= limit]
+        end = max(candidates) if candidates else limit
+        chunks.append((start, end))
+        start = end
+    chunks.append((start, None))
+    return chunks
+
+
+class AudioTranscoder:
+    FFMPEG_ARGS = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-acodec", "libmp3lame",
+        "-ar", "16000",
+        "-ac", "1",
+        "-f", "mp3",
+        "pipe:1",
+    ]
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._slots = asyncio.Semaphore(self.settings.audio_ffmpeg_concurrency)
+        self.passthrough_formats = {
+            fmt.strip().lower()
+            for fmt in self.settings.audio_passthrough_formats.split(",")
+            if fmt.strip()
+        }
+        self.output_format = self.settings.audio_output_format.lower()
+        if self.output_format not in OUTPUT_CODECS:
+            logger.warning("⚠️ AUDIO_OUTPUT_FORMAT=%s no soportado, se usa ogg", self.output_format)
+            self.output_format = "ogg"
+
+    def _condition_args(self) -> List[str]:
+        """ffmpeg: recorte de silencios + detección de pausas + codificación a bajo bitrate"""
+        s = self.settings
+        threshold = f"{s.audio_silence_threshold_db}dB"
+        filters = ",".join([
+            # Silencio inicial, final y pausas de más de audio_max_pause (quedan en audio_keep_pause)
+            f"silenceremove=start_periods=1:start_threshold={threshold}:start_silence=0.1"
+            f":stop_periods=-1:stop_threshold={threshold}"
+            f":stop_duration={s.audio_max_pause}:stop_silence={s.audio_keep_pause}",
+            # Pausas que quedaron: puntos de corte para trocear
+            f"silencedetect=noise={threshold}:duration={min(s.audio_keep_pause, 0.25)}",
+        ])
+        return [
+            "ffmpeg", "-hide_banner", "-loglevel", "info", "-stats",
+            "-i", "pipe:0",
+            "-vn", "-af", filters,
+            "-ar", "16000",
+            "-ac", "1",
+            "-b:a", s.audio_bitrate,
+            *OUTPUT_CODECS[self.output_format],
+            "-f", self.output_format,
+            "pipe:1",
+        ]
+
+    @staticmethod
+    def extension_for(mime_type: Optional[str]) -> Optional[str]:
+        """Extensión de archivo a partir del MIME (ej. 'audio/ogg; codecs=opus' -> 'ogg')"""
+        if not mime_type:
+            return None
+        subtype = mime_type.split(";")[0].strip().lower().split("/")[-1]
+        return MIME_EXTENSIONS.get(subtype)
+
+    async def prepare(self, audio_bytes: bytes, mime_type: Optional[str] = None) -> Tuple[str, bytes]:
+        """
+        Dejar el audio listo para Whisper
+
+        Args:
+            audio_bytes: Bytes del audio original
+            mime_type: MIME reportado por WhatsApp (por defecto OGG/Opus)
+
+        Returns:
+            Tupla (nombre de archivo, bytes) lista para subir
+        """
+        ext = self.extension_for(mime_type or "audio/ogg")
+        if ext and ext in self.passthrough_formats:
+            return f"audio.{ext}", audio_bytes
+
+        return "audio.mp3", await self.to_mp3(audio_bytes)
+
+    async def condition(self, audio_bytes: bytes, mime_type: Optional[str] = None) -> PreparedAudio:
+        """
+        Recortar silencios y recomprimir a bajo bitrate. Si está desactivado
+        (AUDIO_PREPROCESS=false) o ffmpeg falla, se usa `prepare()` como antes.
+
+        Args:
+            audio_bytes: Bytes del audio original
+            mime_type: MIME reportado por WhatsApp (por defecto OGG/Opus)
+
+        Returns:
+            Audio preparado, con su duración y pausas si se pudieron medir
+        """
+        if self.settings.audio_preprocess:
+            try:
+                stdout, stderr = await self._run(self._condition_args(), audio_bytes, "audio_preprocess")
+            except (OSError, subprocess.CalledProcessError, asyncio.TimeoutError) as e:
+                logger.warning("⚠️ Preprocesamiento de audio falló, se envía sin recortar: %r", e)
+            else:
+                seconds, pauses = parse_ffmpeg_stats(stderr)
+                logger.info(
+                    "🎚️ Audio preparado: %d -> %d bytes%s",
+                    len(audio_bytes), len(stdout),
+                    f", {seconds:.1f}s de voz" if seconds is not None else ""
+                )
+                return PreparedAudio(f"audio.{self.output_format}", stdout, seconds, pauses)
+
+        filename, data = await self.prepare(audio_bytes, mime_type)
+        return PreparedAudio(filename, data)
+
+    async def split(self, audio: PreparedAudio) -> List[PreparedAudio]:
+        """
+        Trocear una nota larga en partes de ~AUDIO_CHUNK_SECONDS, cortando en
+        pausas (copia de stream, sin recodificar). Sin duración medida no se trocea.
+        """
+        if audio.seconds is None:
+            return [audio]
+        chunks = plan_chunks(
+            audio.seconds, audio.pauses,
+            self.settings.audio_chunk_seconds, self.settings.audio_max_chunks
+        )
+        if len(chunks) == 1:
+            return [audio]
+
+        def cut_args(start: float, end: Optional[float]) -> List[str]:
+            bounds = ["-ss", f"{start:.3f}"] + (["-to", f"{end:.3f}"] if end is not None else [])
+            return [
+                "ffmpeg", "-hide_banner", "-loglevel", "error",
+                "-i", "pipe:0",
+                *bounds,
+                "-map", "0:a", "-c", "copy",
+                "-f", self.output_format,
+                "pipe:1",
+            ]
+
+        parts = await asyncio.gather(*(
+            self._run(cut_args(start, end), audio.data, "audio_split") for start, end in chunks
+        ))
+        return [
+            PreparedAudio(audio.filename, stdout, (end if end is not None else audio.seconds) - start)
+            for (start, end), (stdout, _) in zip(chunks, parts)
+        ]
+
+    async def to_mp3(self, audio_bytes: bytes) -> bytes:
+        """Convertir a MP3 16 kHz mono vía stdin/stdout, sin tocar disco"""
+        stdout, _ = await self._run(self.FFMPEG_ARGS, audio_bytes, "transcode")
+        return stdout
+
+    async def _run(self, args: List[str], audio_bytes: bytes, stage: str) -> Tuple[bytes, bytes]:
+        """Correr ffmpeg con el audio por stdin; devuelve (stdout, stderr)"""
+        async with self._slots:
+            with track(stage):
+                process = await asyncio.create_subprocess_exec(
+                    *args,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+                try:
+                    stdout, stderr = await asyncio.wait_for(
+                        process.communicate(audio_bytes),
+                        timeout=self.settings.audio_ffmpeg_timeout
+                    )
+                except asyncio.TimeoutError:
+                    logger.error("❌ ffmpeg excedió %ss", self.settings.audio_ffmpeg_timeout)
+                    raise
+                finally:
+                    # Timeout o cancelación (descarte, shutdown, intento que
+                    # perdió el hedge): no dejar el proceso vivo ni sin reaper
+                    if process.returncode is None:
+                        with contextlib.suppress(ProcessLookupError):
+                            process.kill()
+                        await process.wait()
+
+                if process.returncode != 0:
+                    raise subprocess.CalledProcessError(
+                        process.returncode, args, output=stdout, stderr=stderr
+                    )
+
+        return stdout, stderr
+
+    async def warm_up(self) -> str:
+        """
+        Verificar que ffmpeg existe y dejar el binario en caché del SO
+        (sin ffmpeg solo fallan los audios que no son passthrough)
+        """
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-version",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+        stdout, _ = await process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg -version terminó con código {process.returncode}")
+        return stdout.split(b"\n", 1)[0].decode(errors="replace")
+
+
+# Instancia global
+audio_transcoder = AudioTranscoder()
@@ -0,0 +1,161 @@
+"""
+Agrupación de mensajes seguidos de un mismo número en un solo turno
+"""
+import asyncio
+import logging
+import time
+import weakref
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MessageBatch:
+    """Mensajes acumulados de una conversación durante la ventana"""
+    key: str
+    texts: List[str] = field(default_factory=list)
+    message_types: List[str] = field(default_factory=list)
+    started: float = field(default_factory=time.monotonic)
+    last: float = field(default_factory=time.monotonic)
+    # Confirmaciones de los mensajes del turno (XACK en el worker): se corren
+    # recién cuando el turno se respondió
+    acks: List[Callable[[], Awaitable[None]]] = field(default_factory=list)
+
+    def add(self, text: str, message_type: str, ack: Optional[Callable[[], Awaitable[None]]] = None):
+        self.texts.append(text)
+        self.message_types.append(message_type)
+        self.last = time.monotonic()
+        if ack is not None:
+            self.acks.append(ack)
+
+    async def acknowledge(self):
+        """Confirmar todos los mensajes del turno (una falla no frena al resto)"""
+        acks, self.acks = self.acks, []
+        for ack in acks:
+            try:
+                await ack()
+            except Exception as e:
+                logger.error("Error confirmando un mensaje del turno de %s: %s", self.key, e)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(self.texts)
+
+    @property
+    def message_type(self) -> str:
+        return self.message_types[-1] if self.message_types else ""
+
+
+class TurnLock(asyncio.Lock):
+    """Lock de una conversación que cuenta los turnos respondidos"""
+
+    def __init__(self):
+        super().__init__()
+        self.turns = 0
+
+
+class MessageCoalescer:
+    """
+    Debounce por teléfono: el primer mensaje abre una ventana, los que
+    llegan mientras está abierta se suman al mismo turno. Las respuestas
+    de un mismo número se generan de a una, en orden.
+    """
+
+    def __init__(self):
+        settings = get_settings()
+        self.window = settings.coalesce_window_ms / 1000
+        self.max_wait = settings.coalesce_max_wait_ms / 1000
+        self._open: Dict[str, MessageBatch] = {}
+        self._locks: "weakref.WeakValueDictionary[str, TurnLock]" = weakref.WeakValueDictionary()
+
+    def _lock_for(self, key: str) -> TurnLock:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = TurnLock()
+            self._locks[key] = lock
+        return lock
+
+    def checkpoint(self, key: str) -> Optional[Tuple[TurnLock, int]]:
+        """
+        Marca para saber si la conversación sigue quieta: None si hay un turno
+        abierto o respondiéndose (lo que se lea ahora de la sesión puede cambiar)
+        """
+        lock = self._lock_for(key)
+        if key in self._open or lock.locked():
+            return None
+        return lock, lock.turns
+
+    @staticmethod
+    def unchanged(checkpoint: Optional[Tuple[TurnLock, int]]) -> bool:
+        """Desde la marca no se respondió ni se está respondiendo ningún turno"""
+        if checkpoint is None:
+            return False
+        lock, turns = checkpoint
+        return lock.turns == turns and not lock.locked()
+
+    def add(
+        self,
+        key: str,
+        text: str,
+        message_type: str,
+        ack: Optional[Callable[[], Awaitable[None]]] = None
+    ) -> Optional[MessageBatch]:
+        """
+        Sumar un mensaje al turno abierto de la conversación o abrir uno nuevo
+
+        Args:
+            ack: Confirmación del mensaje, que queda a cargo del turno
+
+        Returns:
+            El turno nuevo si este mensaje lo abrió (quien llama debe
+            hacer `flush`), o None si se sumó a un turno ya abierto
+        """
+        batch = self._open.get(key)
+        if batch is not None:
+            batch.add(text, message_type, ack)
+            logger.info("🧩 Mensaje agrupado para %s (%d en ventana)", key, len(batch.texts))
+            return None
+
+        batch = MessageBatch(key=key)
+        batch.add(text, message_type, ack)
+        self._open[key] = batch
+        return batch
+
+    async def flush(self, batch: MessageBatch, handler: Callable[[MessageBatch], Awaitable[None]]):
+        """Cerrar la ventana del turno, responderlo en orden y confirmar sus mensajes"""
+        key = batch.key
+        lock = self._lock_for(key)
+        cancelled = False
+
+        try:
+            # Esperar hasta que pase la ventana sin mensajes nuevos (con tope)
+            while True:
+                deadline = min(batch.last + self.window, batch.started + self.max_wait)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(remaining)
+
+            # Esperar a que termine la respuesta anterior; mientras, se siguen sumando mensajes
+            async with lock:
+                lock.turns += 1
+                self._open.pop(key, None)
+                await handler(batch)
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            if self._open.get(key) is batch:
+                del self._open[key]
+            # También si la respuesta falló (como antes: sin reintentos infinitos);
+            # no si se canceló, así la cola lo vuelve a entregar
+            if not cancelled:
+                await batch.acknowledge()
+
+
+# Instancia global
+message_coalescer = MessageCoalescer()
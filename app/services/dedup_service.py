@@ -0,0 +1,69 @@
+"""
+Servicio de idempotencia - descarta reintentos de Meta por message_id
+"""
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+import redis.asyncio as redis
+
+from app.config import get_settings
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+
+class MessageDeduplicator:
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self.ttl = self.settings.dedup_ttl
+        # Caché local de IDs recientes (evita el round trip en reintentos rápidos)
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._recent_max = self.settings.dedup_local_size
+
+    async def connect(self):
+        """Conectar a Redis"""
+        self.redis = create_redis()
+
+    async def disconnect(self):
+        """Desconectar de Redis"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    def _remember(self, message_id: str):
+        self._recent[message_id] = None
+        if len(self._recent) > self._recent_max:
+            self._recent.popitem(last=False)
+
+    async def claim(self, message_id: str) -> bool:
+        """
+        Reclamar un message_id
+
+        Returns:
+            True si es la primera vez que se ve (hay que procesarlo),
+            False si es un duplicado
+        """
+        if not message_id:
+            return True
+
+        if message_id in self._recent:
+            self._recent.move_to_end(message_id)
+            return False
+
+        self._remember(message_id)
+
+        if not self.redis:
+            return True
+
+        try:
+            return bool(await self.redis.set(f"seen:{message_id}", 1, nx=True, ex=self.ttl))
+        except Exception as e:
+            # Si Redis falla, mejor procesar que perder el mensaje
+            logger.warning("⚠️ Dedup sin Redis para %s: %s", message_id, e)
+            return True
+
+
+# Instancia global
+message_deduplicator = MessageDeduplicator()
@@ -1,75 +1,187 @@
 """
 Servicio de Groq para transcripción de audio (Whisper) y LLM
 """
-import tempfile
+import asyncio
+import logging
 import subprocess
-from pathlib import Path
-from groq import Groq
+import time
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator, Tuple
 
 from app.config import get_settings
+from app.metrics import STAGE_SECONDS, track
+from app.prompts import LOOPERA_PROMPT_TEMPLATE, render_prompt
+from app.services.audio_service import PreparedAudio, audio_transcoder
+from app.services.history_service import estimate_tokens, to_chat_messages
+from app.services.rate_limit_service import rate_limiter
+from app.services.resilience_service import ResilientCaller, local_wait
+
+if TYPE_CHECKING:
+    from groq import AsyncGroq
+
+logger = logging.getLogger(__name__)
 
 
 class GroqService:
     def __init__(self):
         self.settings = get_settings()
         self.client = None
+        self._default_prompt = render_prompt(
+            LOOPERA_PROMPT_TEMPLATE,
+            self.settings.business_name,
+            self.settings.business_description
+        )
+        # Límites de concurrencia por operación (por worker)
+        self._chat_slots = asyncio.Semaphore(self.settings.groq_chat_concurrency)
+        self._transcribe_slots = asyncio.Semaphore(self.settings.groq_transcribe_concurrency)
+        # Deadline, reintentos, breaker y fallback de modelo
+        self._resilience = ResilientCaller()
     
-    def _get_client(self) -> Groq:
-        """Obtener cliente de Groq (lazy loading)"""
+    def _get_client(self) -> "AsyncGroq":
+        """Obtener cliente asíncrono de Groq (lazy loading, también del SDK)"""
         if not self.client:
-            self.client = Groq(api_key=self.settings.groq_api_key)
+            from groq import AsyncGroq
+            
+            # Los reintentos y timeouts los maneja ResilientCaller
+            self.client = AsyncGroq(
+                api_key=self.settings.groq_api_key,
+                base_url=self.settings.groq_base_url or None,
+                max_retries=0,
+                timeout=self.settings.groq_attempt_timeout
+            )
         return self.client
+
+    async def warm_up(self):
+        """
+        Crear el cliente antes del primer mensaje y abrir la conexión (DNS +
+        TLS) con una llamada barata, que además valida la API key
+        """
+        await self._get_client().models.list()
+
+    @asynccontextmanager
+    async def _slot(self, semaphore: asyncio.Semaphore, operation: str):
+        """Esperar un cupo de concurrencia y reportar el tiempo en cola"""
+        started = time.perf_counter()
+        async with semaphore:
+            waited_ms = (time.perf_counter() - started) * 1000
+            if waited_ms >= 50:
+                logger.info("⏳ Groq %s: %.0f ms en cola", operation, waited_ms)
+            else:
+                logger.debug("Groq %s: %.1f ms en cola", operation, waited_ms)
+            yield
     
-    async def transcribe_audio(self, audio_bytes: bytes) -> str:
+    async def _create_chat(self, model: str, messages: list, max_tokens: int, **kwargs):
+        """Chat completion respetando los buckets compartidos de RPM/TPM"""
+        cost = sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+        buckets = [(f"llm:requests:{model}", 1), (f"llm:tokens:{model}", cost)]
+        return await self._create_limited(
+            model, buckets,
+            lambda: self._get_client().chat.completions.with_raw_response.create(
+                model=model, messages=messages, max_tokens=max_tokens, **kwargs
+            )
+        )
+
+    async def _create_limited(self, model: str, buckets: list, create):
+        """
+        Esperar turno en los buckets, llamar y ajustar los buckets con los
+        headers. Un 429 pausa el bucket para todos los workers y se reintenta;
+        agotados los reintentos sale como RateLimitError, que ResilientCaller
+        no reintenta ni cuenta como falla del modelo. La espera en los buckets
+        es local: no cuenta para el timeout del intento, el hedge ni el breaker.
+        """
+        from groq import RateLimitError
+        
+        retries = self.settings.rate_limit_max_retries
+        for attempt in range(retries + 1):
+            with local_wait():
+                for bucket, cost in buckets:
+                    await rate_limiter.acquire(bucket, cost)
+            try:
+                raw = await create()
+            except RateLimitError as e:
+                await rate_limiter.observe_groq(model, e.response.headers)
+                if attempt >= retries:
+                    raise
+                logger.warning("🚦 Groq 429 en %s, reintento %s/%s", model, attempt + 1, retries)
+                continue
+            await rate_limiter.observe_groq(model, raw.headers)
+            return await raw.parse()
+    
+    async def transcribe_audio(self, audio_bytes: bytes, mime_type: str = None) -> str:
         """
         Transcribir audio usando Whisper de Groq
         
+        El audio se recorta y recomprime antes de subirlo; las notas largas se
+        transcriben en partes en paralelo y se unen en orden.
+        
         Args:
             audio_bytes: Bytes del archivo de audio (OGG/Opus de WhatsApp)
+            mime_type: MIME del audio, para decidir si hace falta convertirlo
         
         Returns:
-            Texto transcrito
+            Texto transcrito (vacío si la nota no tiene voz)
         """
-        client = self._get_client()
+        audio = await audio_transcoder.condition(audio_bytes, mime_type)
+        if audio.seconds is not None and audio.seconds < self.settings.audio_min_speech_seconds:
+            logger.info("🔇 Nota de voz sin voz (%.1fs después de recortar silencios)", audio.seconds)
+            return ""
         
-        # Guardar audio temporalmente
-        with tempfile.NamedTemporaryFile(suffix=".ogg", delete=False) as temp_ogg:
-            temp_ogg.write(audio_bytes)
-            temp_ogg_path = temp_ogg.name
+        try:
+            parts = await audio_transcoder.split(audio)
+        except (OSError, subprocess.CalledProcessError, asyncio.TimeoutError) as e:
+            logger.warning("⚠️ No se pudo trocear el audio, se transcribe entero: %r", e)
+            parts = [audio]
+        if len(parts) == 1:
+            return await self._transcribe_part(parts[0], len(audio_bytes))
         
+        logger.info("✂️ Audio de %.0fs en %d partes", audio.seconds, len(parts))
+        tasks = [asyncio.ensure_future(self._transcribe_part(part)) for part in parts]
         try:
-            # Convertir OGG a MP3 (mejor compatibilidad con Whisper)
-            temp_mp3_path = temp_ogg_path.replace(".ogg", ".mp3")
-            
-            subprocess.run([
-                "ffmpeg", "-i", temp_ogg_path,
-                "-acodec", "libmp3lame",
-                "-ar", "16000",
-                "-ac", "1",
-                temp_mp3_path,
-                "-y"
-            ], check=True, capture_output=True)
-            
-            # Transcribir con Whisper
-            with open(temp_mp3_path, "rb") as audio_file:
-                transcription = client.audio.transcriptions.create(
-                    model="whisper-large-v3-turbo",
-                    file=audio_file,
-                    language="es"
+            texts = await asyncio.gather(*tasks)
+        except BaseException:
+            # Si una parte falla el texto queda incompleto: cancelar el resto
+            for task in tasks:
+                task.cancel()
+            raise
+        return " ".join(text.strip() for text in texts if text.strip())
+    
+    async def _transcribe_part(self, audio: PreparedAudio, original_bytes: int = 0) -> str:
+        """Una llamada a Whisper, respetando los buckets de segundos de audio"""
+        client = self._get_client()
+        model = self.settings.whisper_model
+        language = {"language": self.settings.whisper_language} if self.settings.whisper_language else {}
+        
+        # Whisper cobra por segundos de audio (medidos por ffmpeg o estimados por tamaño del original)
+        audio_seconds = audio.seconds
+        if audio_seconds is None:
+            audio_seconds = (original_bytes or len(audio.data)) / self.settings.audio_bytes_per_second
+        buckets = [(f"llm:requests:{model}", 1), ("whisper:audio", max(1.0, audio_seconds))]
+        
+        async with self._slot(self._transcribe_slots, "transcribe"):
+            with track("whisper"):
+                transcription = await self._resilience.call(
+                    "transcribe", [model],
+                    lambda m: self._create_limited(
+                        m, buckets,
+                        lambda: client.audio.transcriptions.with_raw_response.create(
+                            model=m,
+                            file=(audio.filename, audio.data),
+                            **language
+                        )
+                    )
                 )
-            
-            return transcription.text
         
-        finally:
-            # Limpiar archivos temporales
-            Path(temp_ogg_path).unlink(missing_ok=True)
-            Path(temp_mp3_path).unlink(missing_ok=True)
+        return transcription.text
     
     async def chat(
         self, 
         user_message: str, 
         conversation_history: list = None,
-        system_prompt: str = None
+        system_prompt: str = None,
+        summary: str = None,
+        model: str = "llama-3.3-70b-versatile",
+        temperature: float = 0.7,
+        max_tokens: int = 500
     ) -> str:
         """
         Generar respuesta usando LLM de Groq
@@ -78,12 +190,91 @@ class GroqService:
             user_message: Mensaje del usuario
             conversation_history: Historial de conversación previo
             system_prompt: Prompt del sistema personalizado
+            summary: Resumen de la parte de la conversación que ya no va en el historial
+            model, temperature, max_tokens: Parámetros del modelo (por tenant)
         
         Returns:
             Respuesta del bot
         """
-        client = self._get_client()
+        messages = self._build_messages(user_message, conversation_history, system_prompt, summary)
         
+        # Generar respuesta (con el modelo de respaldo si el principal se degrada)
+        async with self._slot(self._chat_slots, "chat"):
+            with track("llm"):
+                completion = await self._resilience.call(
+                    "chat", [model, self.settings.groq_fallback_model],
+                    lambda m: self._create_chat(m, messages, max_tokens, temperature=temperature)
+                )
+        
+        return completion.choices[0].message.content
+    
+    async def chat_stream(
+        self,
+        user_message: str,
+        conversation_history: list = None,
+        system_prompt: str = None,
+        summary: str = None,
+        model: str = "llama-3.3-70b-versatile",
+        temperature: float = 0.7,
+        max_tokens: int = 500
+    ) -> AsyncIterator[str]:
+        """
+        Igual que `chat`, pero entrega la respuesta en fragmentos a medida que se genera
+        """
+        messages = self._build_messages(user_message, conversation_history, system_prompt, summary)
+        
+        # El presupuesto de latencia se mide hasta el primer fragmento
+        async with self._slot(self._chat_slots, "chat"):
+            with track("llm"):
+                started = time.perf_counter()
+                first, chunks = await self._resilience.call(
+                    "chat", [model, self.settings.groq_fallback_model],
+                    lambda m: self._open_stream(m, messages, max_tokens, temperature),
+                    discard=lambda opened: opened[1].aclose()
+                )
+                STAGE_SECONDS.labels("llm_first_token").observe(time.perf_counter() - started)
+                try:
+                    if first:
+                        yield first
+                    async for text in chunks:
+                        yield text
+                finally:
+                    await chunks.aclose()
+    
+    async def _open_stream(
+        self, model: str, messages: list, max_tokens: int, temperature: float
+    ) -> Tuple[str, AsyncIterator[str]]:
+        """Abrir el stream y esperar el primer fragmento con texto"""
+        stream = await self._create_chat(
+            model, messages, max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        chunks = self._stream_text(stream)
+        try:
+            first = await anext(chunks, "")
+        except BaseException:
+            await chunks.aclose()
+            raise
+        return first, chunks
+    
+    @staticmethod
+    async def _stream_text(stream) -> AsyncIterator[str]:
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+    
+    def _build_messages(
+        self,
+        user_message: str,
+        conversation_history: list = None,
+        system_prompt: str = None,
+        summary: str = None
+    ) -> list:
+        """Armar la lista de mensajes para la API de chat"""
         # System prompt por defecto para Loopera
         if not system_prompt:
             system_prompt = self._get_loopera_system_prompt()
@@ -91,52 +282,56 @@ class GroqService:
         # Construir mensajes
         messages = [{"role": "system", "content": system_prompt}]
         
+        if summary:
+            messages.append({"role": "system", "content": f"Resumen de la conversación previa: {summary}"})
+        
         # Agregar historial si existe
         if conversation_history:
-            messages.extend(conversation_history)
+            messages.extend(to_chat_messages(conversation_history))
         
         # Agregar mensaje actual
         messages.append({"role": "user", "content": user_message})
         
-        # Generar respuesta
-        completion = client.chat.completions.create(
-            model="llama-3.3-70b-versatile",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=500
+        return messages
+    
+    async def summarize(self, previous_summary: str, messages: list, business_name: str = None) -> str:
+        """
+        Incorporar mensajes viejos al resumen de la conversación
+        
+        Args:
+            previous_summary: Resumen acumulado hasta ahora (puede estar vacío)
+            messages: Mensajes que salen del historial
+            business_name: Negocio del tenant (por defecto el configurado)
+        
+        Returns:
+            Resumen actualizado
+        """
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = (
+            "Actualiza el resumen de esta conversación de WhatsApp entre un prospecto y el asistente de "
+            f"{business_name or self.settings.business_name}. Conserva datos del cliente (empresa, necesidad, volumen, "
+            "intención de agendar) en máximo 5 frases.\n\n"
+            f"Resumen actual: {previous_summary or '(vacío)'}\n\n"
+            f"Mensajes nuevos:\n{transcript}"
         )
         
-        return completion.choices[0].message.content
+        async with self._slot(self._chat_slots, "summary"):
+            with track("summary"):
+                completion = await self._resilience.call(
+                    "summary", [self.settings.summary_model],
+                    lambda m: self._create_chat(
+                        m,
+                        [{"role": "user", "content": prompt}],
+                        self.settings.summary_max_tokens,
+                        temperature=0.2
+                    )
+                )
+        
+        return completion.choices[0].message.content.strip()
     
     def _get_loopera_system_prompt(self) -> str:
-        """System prompt específico para Loopera"""
-        return f"""Eres el asistente virtual de {self.settings.business_name}, especializado en {self.settings.business_description}.
-
-SOBRE LOOPERA:
-- Somos una consultora especializada en desarrollo de Agentes AI para empresas
-- Ayudamos a empresas a automatizar su atención al cliente con bots inteligentes de WhatsApp
-- Nuestros servicios incluyen: diseño, desarrollo, implementación y mantenimiento de agentes AI
-- Trabajamos principalmente con empresas en Colombia y Latinoamérica
-
-REGLAS DE CONVERSACIÓN:
-1. SOLO respondes sobre: servicios de Loopera, agentes AI, automatización, precios, proceso de trabajo
-2. Si preguntan algo fuera de tu dominio, di: "Solo puedo ayudarte con temas relacionados a desarrollo de agentes AI. ¿Te gustaría saber cómo podemos ayudar a tu empresa?"
-3. NUNCA respondas sobre: política, deportes, noticias, conocimiento general, chismes
-4. Si no tienes información específica, ofrece conectar con un asesor humano
-5. Siempre identifícate como asistente virtual de Loopera
-6. Sé amable, profesional y conciso
-7. Usa español natural, como se habla en Colombia
-
-FLUJO DE CONVERSACIÓN:
-- Si es un prospecto nuevo: Pregunta sobre su empresa, qué problema quiere resolver, qué volumen de mensajes manejan
-- Si quiere información de precios: Explica que los precios varían según complejidad y ofrece agendar una llamada
-- Si es cliente existente: Pregunta cómo puedes ayudarlo y ofrece conectar con su asesor asignado
-
-CONTACTO:
-- Para agendar una llamada: "Te puedo conectar con nuestro equipo para agendar una demostración"
-- WhatsApp de soporte: Ofrece escalar a un humano si no puedes resolver
-
-Responde de forma natural y conversacional, sin usar markdown ni formatos especiales."""
+        """System prompt específico para Loopera (compilado una sola vez)"""
+        return self._default_prompt
 
 
 # Instancia global
@@ -0,0 +1,50 @@
+"""
+Historial de conversación con presupuesto de tokens
+"""
+from typing import List, Tuple
+
+# Aproximación sin tokenizer: ~4 caracteres por token en español
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD_TOKENS = 4  # Rol y separadores del formato de chat
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens para un texto"""
+    return len(text or "") // CHARS_PER_TOKEN + MESSAGE_OVERHEAD_TOKENS
+
+
+def history_entry(role: str, content: str) -> dict:
+    """Mensaje de historial con su conteo de tokens cacheado"""
+    return {"role": role, "content": content, "tokens": estimate_tokens(content)}
+
+
+def message_tokens(message: dict) -> int:
+    """Tokens de un mensaje guardado (los del formato anterior no traen conteo)"""
+    return message.get("tokens") or estimate_tokens(message.get("content", ""))
+
+
+def fit_history(history: List[dict], budget: int) -> Tuple[List[dict], List[dict]]:
+    """
+    Partir el historial según el presupuesto de tokens
+
+    Returns:
+        Tupla (mensajes que entran, mensajes más viejos que sobran)
+    """
+    total = 0
+    start = len(history)
+    for i in range(len(history) - 1, -1, -1):
+        total += message_tokens(history[i])
+        if total > budget:
+            break
+        start = i
+
+    # La ventana siempre arranca en un mensaje del usuario
+    while start < len(history) and history[start].get("role") != "user":
+        start += 1
+
+    return history[start:], history[:start]
+
+
+def to_chat_messages(history: List[dict]) -> List[dict]:
+    """Historial en el formato que espera la API de chat (sin campos extra)"""
+    return [{"role": m["role"], "content": m["content"]} for m in history]
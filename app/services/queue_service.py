@@ -0,0 +1,203 @@
+"""
+Cola de trabajo durable sobre Redis Streams
+"""
+import logging
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+import orjson
+import redis.asyncio as redis
+from redis.exceptions import ResponseError
+
+from app.config import get_settings
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+# Renovar un lease solo si sigue siendo nuestro (SET ... NX no sirve para renovar)
+RENEW_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LEASE_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class MessageQueue:
+    """
+    Cola particionada por teléfono: cada shard es un stream y cada shard
+    lo consume un solo worker a la vez (lease), así los mensajes de un
+    mismo número se procesan en orden.
+    """
+
+    GROUP = "workers"
+    WORKERS_KEY = "queue:workers"
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self.shards = self.settings.queue_shards
+        self._renew_lease = None
+        self._release_lease = None
+
+    async def connect(self):
+        """Conectar a Redis (bytes crudos, el payload va en orjson)"""
+        self.redis = create_redis(decode_responses=False)
+        self._renew_lease = self.redis.register_script(RENEW_LEASE_LUA)
+        self._release_lease = self.redis.register_script(RELEASE_LEASE_LUA)
+
+    async def disconnect(self):
+        """Desconectar de Redis"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    def shard_for(self, phone: str) -> int:
+        """Shard estable para un número (crc32 es estable entre procesos)"""
+        return zlib.crc32((phone or "").encode()) % self.shards
+
+    def stream_key(self, shard: int) -> str:
+        return f"queue:jobs:{shard}"
+
+    @staticmethod
+    def _lease_key(shard: int) -> str:
+        return f"queue:lease:{shard}"
+
+    # ---- Productor (webhook) ----
+
+    async def enqueue(self, job: dict) -> str:
+        """Encolar un mensaje (un solo XADD)"""
+        stream = self.stream_key(self.shard_for(job.get("phone")))
+        return await self.redis.xadd(
+            stream,
+            {"job": orjson.dumps(job)},
+            maxlen=self.settings.queue_max_length,
+            approximate=True
+        )
+
+    # ---- Consumidor (worker) ----
+
+    async def ensure_groups(self):
+        """Crear el consumer group en cada shard si no existe"""
+        for shard in range(self.shards):
+            try:
+                await self.redis.xgroup_create(self.stream_key(shard), self.GROUP, id="0", mkstream=True)
+            except ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def heartbeat(self, consumer: str) -> int:
+        """Registrar el worker como vivo y devolver cuántos hay"""
+        now = time.time()
+        ttl = self.settings.queue_lease_ttl_ms / 1000
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(self.WORKERS_KEY, {consumer: now})
+        pipe.zremrangebyscore(self.WORKERS_KEY, 0, now - ttl)
+        pipe.zcard(self.WORKERS_KEY)
+        _, _, alive = await pipe.execute()
+        return max(alive, 1)
+
+    async def leave(self, consumer: str, shards: List[int]):
+        """Liberar leases y salir del registro de workers"""
+        for shard in shards:
+            await self.release_shard(shard, consumer)
+        await self.redis.zrem(self.WORKERS_KEY, consumer)
+
+    async def acquire_shard(self, shard: int, consumer: str) -> bool:
+        """Tomar o renovar el lease de un shard"""
+        key = self._lease_key(shard)
+        ttl = self.settings.queue_lease_ttl_ms
+        if await self._renew_lease(keys=[key], args=[consumer, ttl]):
+            return True
+        return bool(await self.redis.set(key, consumer, nx=True, px=ttl))
+
+    async def release_shard(self, shard: int, consumer: str):
+        await self._release_lease(keys=[self._lease_key(shard)], args=[consumer])
+
+    async def read(
+        self, consumer: str, shards: List[int], count: int, block_ms: int
+    ) -> List[Tuple[str, str, dict]]:
+        """Leer mensajes nuevos de los shards propios"""
+        if not shards:
+            return []
+        streams = {self.stream_key(shard): ">" for shard in shards}
+        response = await self.redis.xreadgroup(
+            self.GROUP, consumer, streams, count=count, block=block_ms
+        )
+        return [
+            (stream.decode(), entry_id.decode(), orjson.loads(fields[b"job"]))
+            for stream, entries in response or ()
+            for entry_id, fields in entries
+            if fields
+        ]
+
+    async def claim_pending(
+        self, consumer: str, shard: int, min_idle_ms: int, count: Optional[int] = None
+    ) -> List[Tuple[str, str, dict]]:
+        """
+        Reclamar, en orden, los mensajes pendientes de otros consumidores con
+        al menos `min_idle_ms` sin confirmar. Los propios nunca: siguen en
+        proceso (esperando cupo, admisión o el turno de otro mensaje).
+
+        Args:
+            count: Tope de mensajes a reclamar (None = todos)
+        """
+        stream = self.stream_key(shard)
+        own = consumer.encode()
+        page = 500 if count is None else count
+        start = "-"
+        claimed: List[Tuple[str, str, dict]] = []
+
+        while count is None or len(claimed) < count:
+            pending = await self.redis.xpending_range(
+                stream, self.GROUP, min=start, max="+", count=page, idle=min_idle_ms or None
+            )
+            ids = [p["message_id"] for p in pending if p["consumer"] != own]
+            if count is not None:
+                ids = ids[:count - len(claimed)]
+            if ids:
+                entries = await self.redis.xclaim(stream, self.GROUP, consumer, min_idle_ms, ids)
+                claimed.extend(
+                    (stream, entry_id.decode(), orjson.loads(fields[b"job"]))
+                    for entry_id, fields in entries
+                    if fields
+                )
+                # Borrados del stream (MAXLEN) que quedaron en la lista de pendientes
+                deleted = [entry_id for entry_id, fields in entries if not fields]
+                if deleted:
+                    await self.redis.xack(stream, self.GROUP, *deleted)
+            if len(pending) < page:
+                break
+            start = b"(" + pending[-1]["message_id"]
+
+        return claimed
+
+    async def claim_stalled(self, consumer: str, shard: int, count: int) -> List[Tuple[str, str, dict]]:
+        """Reclamar mensajes colgados de workers caídos (pendientes hace `queue_claim_idle_ms`)"""
+        return await self.claim_pending(consumer, shard, self.settings.queue_claim_idle_ms, count)
+
+    async def take_over(self, consumer: str, shard: int) -> List[Tuple[str, str, dict]]:
+        """
+        Al tomar un shard, todo lo que el dueño anterior dejó sin confirmar:
+        su lease ya venció, y leer `>` antes rompería el orden por número
+        """
+        return await self.claim_pending(consumer, shard, 0)
+
+    async def ack(self, stream: str, entry_id: str):
+        """Confirmar y borrar un mensaje procesado"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.xack(stream, self.GROUP, entry_id)
+        pipe.xdel(stream, entry_id)
+        await pipe.execute()
+
+
+# Instancia global
+message_queue = MessageQueue()
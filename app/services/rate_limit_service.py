@@ -0,0 +1,181 @@
+"""
+Rate limiting compartido entre workers (token buckets en Redis)
+
+Buckets:
+- whatsapp:<phone_number_id>   mensajes por segundo hacia Meta
+- llm:requests:<modelo>        RPM de Groq
+- llm:tokens:<modelo>          TPM de Groq
+- whisper:audio                segundos de audio por hora de Whisper
+
+Los buckets se ajustan solos con Retry-After y los headers x-ratelimit-*.
+"""
+import asyncio
+import logging
+import random
+import re
+from dataclasses import dataclass
+from typing import Mapping, Optional
+
+import redis.asyncio as redis
+
+from app.config import get_settings
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+# Devuelve 0 si se concedió `cost`, o los ms a esperar (sin consumir nada)
+TOKEN_BUCKET_LUA = """
+local bucket_key, blocked_key = KEYS[1], KEYS[2]
+local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+
+local blocked = redis.call('PTTL', blocked_key)
+if blocked > 0 then
+    return blocked
+end
+
+local time = redis.call('TIME')
+local now = tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000)
+
+local state = redis.call('HMGET', bucket_key, 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) / 1000 * rate)
+
+cost = math.min(cost, capacity)
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    wait = math.ceil((cost - tokens) / rate * 1000)
+end
+
+redis.call('HSET', bucket_key, 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', bucket_key, math.ceil(capacity / rate * 1000) + 1000)
+return wait
+"""
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Segundos desde '7.66s', '2m59.56s', '120ms' o un número plano (Retry-After)"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+
+@dataclass(frozen=True)
+class BucketSpec:
+    rate: float  # Unidades por segundo
+    capacity: float  # Ráfaga máxima
+
+
+class RateLimiter:
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self._bucket_script = None
+
+    async def connect(self):
+        """Conectar a Redis"""
+        self.redis = create_redis()
+        self._bucket_script = self.redis.register_script(TOKEN_BUCKET_LUA)
+
+    async def disconnect(self):
+        """Desconectar de Redis"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    def spec_for(self, bucket: str) -> BucketSpec:
+        """Límites configurados según el tipo de bucket"""
+        s = self.settings
+        if bucket.startswith("whatsapp:"):
+            return BucketSpec(s.whatsapp_sends_per_second, s.whatsapp_sends_per_second)
+        if bucket.startswith("llm:requests:"):
+            return BucketSpec(s.groq_requests_per_minute / 60, max(1, s.groq_requests_per_minute / 6))
+        if bucket.startswith("llm:tokens:"):
+            return BucketSpec(s.groq_tokens_per_minute / 60, s.groq_tokens_per_minute / 6)
+        if bucket.startswith("whisper:"):
+            return BucketSpec(s.whisper_audio_seconds_per_hour / 3600, s.whisper_audio_seconds_per_hour / 6)
+        raise ValueError(f"Bucket desconocido: {bucket}")
+
+    async def acquire(self, bucket: str, cost: float = 1.0) -> float:
+        """
+        Esperar hasta tener `cost` unidades disponibles en el bucket
+
+        Returns:
+            Segundos esperados. Si Redis falla no se limita (fail open);
+            si se supera la espera máxima se sigue igual y el proveedor decide.
+        """
+        if not self.redis or not self.settings.rate_limit_enabled:
+            return 0.0
+
+        spec = self.spec_for(bucket)
+        max_wait = self.settings.rate_limit_max_wait
+        waited = 0.0
+
+        while True:
+            try:
+                wait_ms = await self._bucket_script(
+                    keys=[f"ratelimit:{bucket}", f"ratelimit:{bucket}:blocked"],
+                    args=[spec.rate, spec.capacity, cost]
+                )
+            except Exception as e:
+                logger.warning("⚠️ Rate limiter sin Redis (%s): %s", bucket, e)
+                return waited
+
+            if not wait_ms:
+                if waited:
+                    logger.info("🚦 %s: %.2fs de espera por rate limit", bucket, waited)
+                return waited
+
+            if waited >= max_wait:
+                logger.warning("🚦 %s: espera máxima (%ss) superada, se envía igual", bucket, max_wait)
+                return waited
+
+            # Jitter para que los workers no despierten todos a la vez
+            delay = min(wait_ms / 1000, max_wait - waited) * random.uniform(1.0, 1.2)
+            await asyncio.sleep(delay)
+            waited += delay
+
+    async def block(self, bucket: str, seconds: float):
+        """Pausar el bucket para todos los workers (Retry-After o cuota agotada)"""
+        if not self.redis or seconds <= 0:
+            return
+        try:
+            await self.redis.set(f"ratelimit:{bucket}:blocked", 1, px=int(seconds * 1000))
+            logger.warning("🚦 %s pausado %.1fs", bucket, seconds)
+        except Exception as e:
+            logger.warning("⚠️ No se pudo pausar %s: %s", bucket, e)
+
+    async def observe_groq(self, model: str, headers: Mapping[str, str]):
+        """Ajustar los buckets de Groq con los headers de la respuesta"""
+        retry_after = parse_duration(headers.get("retry-after"))
+        if retry_after:
+            await self.block(f"llm:requests:{model}", retry_after)
+            return
+
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            await self.block(
+                f"llm:requests:{model}",
+                parse_duration(headers.get("x-ratelimit-reset-requests")) or 1.0
+            )
+        if headers.get("x-ratelimit-remaining-tokens") == "0":
+            await self.block(
+                f"llm:tokens:{model}",
+                parse_duration(headers.get("x-ratelimit-reset-tokens")) or 1.0
+            )
+
+
+# Instancia global
+rate_limiter = RateLimiter()
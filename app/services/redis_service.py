@@ -1,90 +1,595 @@
 """
 Servicio de Redis para sesiones de conversación
 """
+import asyncio
 import json
+import logging
+import time
 import redis.asyncio as redis
-from typing import Optional
-from datetime import datetime
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Set
 
 from app.config import get_settings
+from app.metrics import CACHE_LOOKUPS, track
+from app.services.history_service import history_entry
+from app.services.session_codec import decode_message, encode_message, is_legacy, now_epoch, to_epoch
+
+logger = logging.getLogger(__name__)
+
+
+# Un pool por proceso y modo de decodificación: todos los servicios comparten
+# las mismas conexiones en lugar de abrir un pool cada uno
+_pools: Dict[bool, redis.ConnectionPool] = {}
+
+
+def create_redis(decode_responses: bool = True) -> redis.Redis:
+    """Cliente Redis sobre el pool compartido del proceso (dimensionado desde Settings)"""
+    pool = _pools.get(decode_responses)
+    if pool is None:
+        settings = get_settings()
+        pool = redis.ConnectionPool.from_url(
+            settings.redis_url,
+            max_connections=settings.redis_max_connections,
+            socket_timeout=settings.redis_socket_timeout,
+            socket_connect_timeout=settings.redis_connect_timeout,
+            socket_keepalive=True,
+            health_check_interval=settings.redis_health_check_interval,
+            decode_responses=decode_responses,
+        )
+        _pools[decode_responses] = pool
+    return redis.Redis(connection_pool=pool)
+
+
+async def close_redis_pools():
+    """Cerrar los pools compartidos (al final del shutdown, después de los servicios)"""
+    pools = list(_pools.values())
+    _pools.clear()
+    for pool in pools:
+        await pool.disconnect()
+
+
+# Agregar intercambio + recortar + metadata + TTL en un solo round trip atómico.
+# Si existe una sesión en el formato más viejo (JSON en un string), se pasa a
+# lista aquí; sus items JSON los convierte después MIGRATE_HISTORY_LUA.
+UPDATE_SESSION_LUA = """
+local history_key, meta_key, legacy_key = KEYS[1], KEYS[2], KEYS[3]
+local ttl, keep, now = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+
+if redis.call('EXISTS', history_key, meta_key) == 0 then
+    local old = redis.call('GET', legacy_key)
+    if old then
+        local ok, session = pcall(cjson.decode, old)
+        if ok and type(session) == 'table' then
+            for _, message in ipairs(session['history'] or {}) do
+                redis.call('RPUSH', history_key, cjson.encode(message))
+            end
+            if session['created_at'] then
+                redis.call('HSET', meta_key, 'created_at', session['created_at'])
+            end
+            if type(session['metadata']) == 'table' and next(session['metadata']) then
+                redis.call('HSET', meta_key, 'metadata', cjson.encode(session['metadata']))
+            end
+        end
+        redis.call('DEL', legacy_key)
+    end
+end
+
+for i = 5, #ARGV do
+    redis.call('RPUSH', history_key, ARGV[i])
+end
+redis.call('LTRIM', history_key, -keep, -1)
+
+redis.call('HSETNX', meta_key, 'created_at', now)
+redis.call('HSET', meta_key, 'updated_at', now)
+if ARGV[4] ~= '' then
+    local current = redis.call('HGET', meta_key, 'metadata')
+    local merged = current and cjson.decode(current) or {}
+    for k, v in pairs(cjson.decode(ARGV[4])) do
+        merged[k] = v
+    end
+    redis.call('HSET', meta_key, 'metadata', cjson.encode(merged))
+end
+
+redis.call('EXPIRE', history_key, ttl)
+redis.call('EXPIRE', meta_key, ttl)
+return redis.call('LLEN', history_key)
+"""
+
+
+# Reemplazar los mensajes más viejos por el resumen, solo si siguen siendo los
+# mismos que se resumieron (otro update pudo haber recortado la lista)
+APPLY_SUMMARY_LUA = """
+local history_key, meta_key = KEYS[1], KEYS[2]
+local folded = tonumber(ARGV[1])
+
+local head = redis.call('LINDEX', history_key, 0)
+if not head then
+    return 0
+end
+if string.sub(head, 1, 1) == '{' then
+    local first = cjson.decode(head)
+    if first['role'] ~= ARGV[2] or first['content'] ~= ARGV[3] then
+        return 0
+    end
+elseif head ~= ARGV[5] then
+    return 0
+end
+redis.call('LTRIM', history_key, folded, -1)
+redis.call('HSET', meta_key, 'summary', ARGV[4])
+return 1
+"""
+
+
+# Reescribir un historial con items JSON (v1) al formato compacto, solo si la
+# lista sigue exactamente igual a la que se leyó (conserva el TTL)
+MIGRATE_HISTORY_LUA = """
+local history_key, meta_key = KEYS[1], KEYS[2]
+local expected = tonumber(ARGV[3])
+
+local current = redis.call('LRANGE', history_key, 0, -1)
+if #current ~= expected then
+    return 0
+end
+for i = 1, expected do
+    if current[i] ~= ARGV[3 + i] then
+        return 0
+    end
+end
+
+local ttl = redis.call('PTTL', history_key)
+redis.call('DEL', history_key)
+for i = 4 + expected, #ARGV do
+    redis.call('RPUSH', history_key, ARGV[i])
+end
+if ttl > 0 then
+    redis.call('PEXPIRE', history_key, ttl)
+end
+if ARGV[1] ~= '' then
+    redis.call('HSET', meta_key, 'created_at', ARGV[1])
+end
+if ARGV[2] ~= '' then
+    redis.call('HSET', meta_key, 'updated_at', ARGV[2])
+end
+return 1
+"""
+
+
+class CachedSession:
+    """
+    Entrada del L1: la sesión ya decodificada, cuándo vence y los
+    intercambios que todavía no llegaron a Redis (`pending`)
+    """
+    __slots__ = ("history", "metadata", "summary", "created_at", "updated_at", "expires", "pending", "partial")
+
+    def __init__(self, session: dict, expires: float, partial: bool = False):
+        self.history: List[dict] = list(session.get("history") or [])
+        self.metadata: dict = dict(session.get("metadata") or {})
+        self.summary: str = session.get("summary") or ""
+        self.created_at: Optional[int] = session.get("created_at")
+        self.updated_at: Optional[int] = session.get("updated_at")
+        self.expires = expires
+        self.pending: List[tuple] = []
+        # Creada sin Redis: solo tiene lo ocurrido durante la caída
+        self.partial = partial
+
+    def append(self, user_message: str, bot_response: str, metadata: Optional[dict], now: int, keep: int):
+        self.history.append(history_entry("user", user_message))
+        self.history.append(history_entry("assistant", bot_response))
+        del self.history[:-keep]
+        if metadata:
+            self.metadata.update(metadata)
+        self.created_at = self.created_at or now
+        self.updated_at = now
+
+    def as_session(self) -> dict:
+        return {
+            "history": list(self.history),
+            "metadata": dict(self.metadata),
+            "summary": self.summary,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at
+        }
 
 
 class SessionManager:
+    """
+    Sesiones en Redis con un L1 en memoria (LRU + TTL) delante.
+
+    El L1 es write-through y, como los mensajes de un número los procesa un
+    solo worker a la vez (shards por teléfono), las conversaciones activas
+    no hacen round trip a Redis. Si Redis se cae, el L1 sigue respondiendo y
+    guarda lo no escrito; al volver Redis se reconecta y se rellena.
+
+    Sin esa exclusividad (procesos web) `cache_reads` va en False: las
+    lecturas van siempre a Redis y el L1 solo cubre las caídas.
+    """
+
     def __init__(self):
+        settings = get_settings()
         self.redis: Optional[redis.Redis] = None
-        self.ttl = 86400  # 24 horas
-    
+        self.ttl = settings.session_ttl  # 24 horas por defecto
+        self.max_messages = settings.session_max_messages
+        self.compress_min_bytes = settings.session_compress_min_bytes
+        self._update_script = None
+        self._summary_script = None
+        self._migrate_script = None
+        self._migrations: Set[asyncio.Task] = set()
+        # Escrituras en curso por conversación (write-behind)
+        self._writes: Dict[str, asyncio.Task] = {}
+        # L1 en memoria
+        self._local: "OrderedDict[str, CachedSession]" = OrderedDict()
+        self._local_max = settings.session_cache_size
+        self._local_ttl = settings.session_cache_ttl
+        self.cache_reads = True  # Servir lecturas del L1 (solo si este proceso es dueño del número)
+        self._loading: Dict[str, object] = {}  # Lecturas de Redis en curso (para no cachear algo viejo)
+        self._reconnect_interval = settings.session_reconnect_interval
+        self._recovery: Optional[asyncio.Task] = None
+
     async def connect(self):
         """Conectar a Redis"""
-        settings = get_settings()
-        self.redis = redis.from_url(
-            settings.redis_url,
-            encoding="utf-8",
-            decode_responses=True
-        )
-    
+        # Binario: los items del historial son msgpack (ver session_codec)
+        client = create_redis(decode_responses=False)
+        try:
+            await client.ping()
+        except Exception:
+            await client.aclose()
+            raise
+        self.redis = client
+        self._update_script = client.register_script(UPDATE_SESSION_LUA)
+        self._summary_script = client.register_script(APPLY_SUMMARY_LUA)
+        self._migrate_script = client.register_script(MIGRATE_HISTORY_LUA)
+
     async def disconnect(self):
-        """Desconectar de Redis"""
+        """Desconectar de Redis (después de terminar las escrituras pendientes)"""
+        if self._writes:
+            await asyncio.wait(list(self._writes.values()))
+        if self._recovery is not None:
+            self._recovery.cancel()
+            self._recovery = None
+        for task in list(self._migrations):
+            task.cancel()
+        unsynced = sum(1 for entry in self._local.values() if entry.pending)
+        if unsynced:
+            logger.error("❌ %s sesión(es) sin guardar en Redis al cerrar", unsynced)
         if self.redis:
-            await self.redis.close()
-    
+            await self.redis.aclose()
+            self.redis = None
+
+    @property
+    def available(self) -> bool:
+        """Conectado y sin una recuperación en curso"""
+        return self.redis is not None and (self._recovery is None or self._recovery.done())
+
+    def start_recovery(self):
+        """Reintentar la conexión en background y rellenar Redis al volver"""
+        if self._recovery is None or self._recovery.done():
+            self._recovery = asyncio.create_task(self._recover())
+
+    async def _recover(self):
+        while True:
+            await asyncio.sleep(self._reconnect_interval)
+            try:
+                if not self.redis:
+                    await self.connect()
+                else:
+                    await self.redis.ping()
+                synced = await self._backfill()
+            except Exception as e:
+                logger.debug("Redis de sesiones sigue sin responder: %s", e)
+                continue
+            if any(entry.pending for entry in self._local.values()):
+                continue  # Se difirió algo más durante el relleno
+            logger.info("✅ Redis de sesiones disponible (%s sesión(es) rellenada(s))", synced)
+            return
+
+    async def _backfill(self) -> int:
+        """Escribir en orden los intercambios que quedaron solo en el L1"""
+        synced = 0
+        for phone, entry in list(self._local.items()):
+            if not entry.pending:
+                continue
+            while entry.pending:
+                await self._run_update(phone, *entry.pending[0])
+                entry.pending.pop(0)
+            synced += 1
+            # Redis ya tiene la historia completa (la de antes y la de la caída)
+            if entry.partial and self._local.get(phone) is entry:
+                del self._local[phone]
+        return synced
+
+    def _degraded(self, error: Exception):
+        logger.warning("⚠️ Redis de sesiones no disponible, usando memoria: %s", error)
+        self.start_recovery()
+
+    def _cached(self, phone: str) -> Optional[CachedSession]:
+        entry = self._local.get(phone)
+        if entry is None:
+            return None
+        # Con escrituras sin bajar a Redis, el L1 es la única copia: no vence
+        if entry.expires < time.monotonic() and not entry.pending:
+            del self._local[phone]
+            return None
+        self._local.move_to_end(phone)
+        return entry
+
+    def _remember(self, phone: str, session: dict, partial: bool = False) -> CachedSession:
+        entry = CachedSession(session, time.monotonic() + self._local_ttl, partial)
+        self._local[phone] = entry
+        self._local.move_to_end(phone)
+        while len(self._local) > self._local_max:
+            # Desalojar la menos usada que ya esté en Redis
+            victim = next((key for key, e in self._local.items() if not e.pending), None)
+            if victim is None:
+                victim, lost = self._local.popitem(last=False)
+                logger.error(
+                    "❌ L1 lleno: se descartan %s intercambio(s) sin guardar de %s", len(lost.pending), victim
+                )
+            else:
+                del self._local[victim]
+        return entry
+
+    async def last_active(self, phone: str) -> Optional[int]:
+        """
+        Epoch del último intercambio (del L1 si sirve lecturas, si no de la
+        metadata en Redis), o None si no hay sesión o no se pudo leer
+        """
+        entry = self._local.get(phone)
+        if entry is not None and (self.cache_reads or entry.pending or not self.available):
+            return entry.updated_at
+        if not self.available:
+            return None
+        _, meta_key, _ = self._keys(phone)
+        try:
+            return to_epoch(await self.redis.hget(meta_key, "updated_at"))
+        except (redis.RedisError, OSError) as e:
+            logger.debug("Sin última actividad de %s: %s", phone, e)
+            return None
+
+    def forget(self, predicate: Callable[[str], bool]):
+        """
+        Sacar del L1 las sesiones (ya guardadas) cuyas claves cumplan
+        `predicate`, p. ej. al dejar de ser dueño de un shard
+        """
+        for phone in [key for key, entry in self._local.items() if not entry.pending and predicate(key)]:
+            del self._local[phone]
+
+    @staticmethod
+    def _keys(phone: str) -> tuple:
+        """Historial (lista), metadata (hash) y clave del formato anterior"""
+        return f"session:{phone}:history", f"session:{phone}:meta", f"session:{phone}"
+
     async def get_session(self, phone: str) -> dict:
-        """Obtener sesión de un usuario"""
-        if not self.redis:
+        """Obtener sesión de un usuario (del L1 o en un solo round trip)"""
+        entry = self._cached(phone)
+        # Sin exclusividad el L1 puede estar viejo: solo sirve si es la única copia
+        if entry is not None and (self.cache_reads or entry.pending or not self.available):
+            CACHE_LOOKUPS.labels("session", "hit").inc()
+            return entry.as_session()
+
+        if not self.available:
+            CACHE_LOOKUPS.labels("session", "unavailable").inc()
             return self._empty_session()
-        
-        key = f"session:{phone}"
-        data = await self.redis.get(key)
-        
-        if data:
-            return json.loads(data)
-        
-        return self._empty_session()
-    
+        CACHE_LOOKUPS.labels("session", "miss").inc()
+
+        # Leer lo propio: esperar la escritura pendiente de esta conversación
+        pending = self._writes.get(phone)
+        if pending is not None:
+            await asyncio.wait([pending])
+
+        token = self._loading[phone] = object()
+        history_key, meta_key, legacy_key = self._keys(phone)
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.lrange(history_key, 0, -1)
+            pipe.hgetall(meta_key)
+            pipe.get(legacy_key)
+            with track("redis_get"):
+                history, meta, legacy = await pipe.execute()
+        except (redis.RedisError, OSError) as e:
+            self._degraded(e)
+            return self._empty_session()
+        finally:
+            # Si alguien escribió durante la lectura, lo leído ya es viejo
+            fresh = self._loading.get(phone) is token
+            if fresh:
+                del self._loading[phone]
+
+        if history or meta:
+            meta = {key.decode(): value for key, value in meta.items()}
+            session = {
+                "history": [decode_message(item) for item in history],
+                "metadata": json.loads(meta["metadata"]) if meta.get("metadata") else {},
+                "summary": meta["summary"].decode() if meta.get("summary") else "",
+                "created_at": to_epoch(meta.get("created_at")),
+                "updated_at": to_epoch(meta.get("updated_at"))
+            }
+            if any(is_legacy(item) for item in history):
+                self._migrate_later(phone, history, session)
+        elif legacy:
+            session = json.loads(legacy)
+            session["created_at"] = to_epoch(session.get("created_at"))
+            session["updated_at"] = to_epoch(session.get("updated_at"))
+        else:
+            session = self._empty_session()
+
+        if fresh and self.cache_reads and phone not in self._local:
+            return self._remember(phone, session).as_session()
+        return session
+
     async def update_session(
-        self, 
-        phone: str, 
-        user_message: str, 
+        self,
+        phone: str,
+        user_message: str,
         bot_response: str,
         metadata: dict = None
     ):
-        """Actualizar sesión con nuevo intercambio"""
-        if not self.redis:
+        """Actualizar sesión con nuevo intercambio (L1 + Redis atómico, un round trip)"""
+        self._write_local(phone, user_message, bot_response, metadata)
+        await self._write_remote(phone, user_message, bot_response, metadata)
+
+    def update_session_later(
+        self,
+        phone: str,
+        user_message: str,
+        bot_response: str,
+        metadata: dict = None
+    ) -> asyncio.Task:
+        """
+        Igual que `update_session` pero sin bloquear a quien responde: el L1 se
+        actualiza ya y la escritura a Redis queda encadenada en orden detrás
+        de las anteriores de esa conversación.
+        """
+        self._write_local(phone, user_message, bot_response, metadata)
+        previous = self._writes.get(phone)
+        task = asyncio.create_task(
+            self._write_after(previous, phone, user_message, bot_response, metadata)
+        )
+        self._writes[phone] = task
+
+        def done(_):
+            if self._writes.get(phone) is task:
+                del self._writes[phone]
+
+        task.add_done_callback(done)
+        return task
+
+    async def _write_after(
+        self,
+        previous: Optional[asyncio.Task],
+        phone: str,
+        user_message: str,
+        bot_response: str,
+        metadata: dict = None
+    ):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await self._write_remote(phone, user_message, bot_response, metadata)
+        except Exception as e:
+            logger.error("❌ No se pudo guardar la sesión de %s: %s", phone, e)
+
+    def _write_local(self, phone: str, user_message: str, bot_response: str, metadata: Optional[dict]):
+        """Write-through: el L1 queda al día antes de ir a Redis"""
+        self._loading.pop(phone, None)
+        entry = self._cached(phone)
+        if entry is None:
+            if self.available:
+                return  # La próxima lectura la trae de Redis
+            entry = self._remember(phone, self._empty_session(), partial=True)
+        entry.append(user_message, bot_response, metadata, now_epoch(), self.max_messages)
+        entry.expires = time.monotonic() + self._local_ttl
+
+    async def _write_remote(self, phone: str, user_message: str, bot_response: str, metadata: Optional[dict]):
+        """Escribir en Redis o, si no se puede, dejarlo para el relleno"""
+        exchange = (user_message, bot_response, metadata)
+        entry = self._local.get(phone)
+        # Sin Redis, o con intercambios anteriores aún sin escribir (el orden importa)
+        if not self.available or (entry is not None and entry.pending):
+            self._defer(phone, exchange)
             return
-        
-        key = f"session:{phone}"
-        session = await self.get_session(phone)
-        
-        # Agregar mensajes al historial
-        session["history"].append({"role": "user", "content": user_message})
-        session["history"].append({"role": "assistant", "content": bot_response})
-        
-        # Mantener solo últimos 10 intercambios (20 mensajes)
-        session["history"] = session["history"][-20:]
-        
-        # Actualizar metadata
-        session["updated_at"] = datetime.utcnow().isoformat()
-        if metadata:
-            session["metadata"].update(metadata)
-        
-        # Guardar
-        await self.redis.setex(key, self.ttl, json.dumps(session))
-    
+
+        try:
+            await self._run_update(phone, *exchange)
+        except (redis.RedisError, OSError) as e:
+            self._defer(phone, exchange)
+            self._degraded(e)
+
+    async def _run_update(self, phone: str, user_message: str, bot_response: str, metadata: Optional[dict]):
+        with track("redis_update"):
+            await self._update_script(
+                keys=list(self._keys(phone)),
+                args=[
+                    self.ttl,
+                    self.max_messages,
+                    now_epoch(),
+                    json.dumps(metadata) if metadata else "",
+                    encode_message(history_entry("user", user_message), self.compress_min_bytes),
+                    encode_message(history_entry("assistant", bot_response), self.compress_min_bytes),
+                ]
+            )
+
+    def _defer(self, phone: str, exchange: tuple):
+        entry = self._local.get(phone)
+        if entry is None:
+            entry = self._remember(phone, self._empty_session(), partial=True)
+            entry.append(*exchange, now_epoch(), self.max_messages)
+        entry.pending.append(exchange)
+        self.start_recovery()
+
+    async def apply_summary(self, phone: str, summary: str, folded: list) -> bool:
+        """
+        Reemplazar los mensajes `folded` (los más viejos) por un resumen
+
+        Returns:
+            False si el historial cambió mientras se resumía (se reintenta luego)
+        """
+        if not self.available or not folded:
+            return False
+
+        history_key, meta_key, _ = self._keys(phone)
+        first = folded[0]
+        applied = bool(await self._summary_script(
+            keys=[history_key, meta_key],
+            args=[
+                len(folded), first["role"], first["content"], summary,
+                encode_message(first, self.compress_min_bytes)
+            ]
+        ))
+
+        # Mismo recorte en el L1 (si su historial empieza igual)
+        entry = self._local.get(phone)
+        if entry is not None:
+            head = entry.history[0] if entry.history else {}
+            if applied and head.get("role") == first["role"] and head.get("content") == first["content"]:
+                del entry.history[:len(folded)]
+                entry.summary = summary
+            else:
+                self.forget(lambda key: key == phone)
+        return applied
+
     async def clear_session(self, phone: str):
         """Limpiar sesión de un usuario"""
+        self._local.pop(phone, None)
+        self._loading.pop(phone, None)
         if not self.redis:
             return
-        
-        key = f"session:{phone}"
-        await self.redis.delete(key)
-    
+
+        await self.redis.delete(*self._keys(phone))
+
+    def _migrate_later(self, phone: str, raw_history: list, session: dict):
+        """Pasar al formato compacto un historial leído con items JSON (en background)"""
+        task = asyncio.create_task(self._migrate(phone, raw_history, session))
+        self._migrations.add(task)
+        task.add_done_callback(self._migrations.discard)
+
+    async def _migrate(self, phone: str, raw_history: list, session: dict):
+        history_key, meta_key, _ = self._keys(phone)
+        try:
+            migrated = await self._migrate_script(
+                keys=[history_key, meta_key],
+                args=[
+                    session["created_at"] or "",
+                    session["updated_at"] or "",
+                    len(raw_history),
+                    *raw_history,
+                    *(encode_message(message, self.compress_min_bytes) for message in session["history"]),
+                ]
+            )
+        except Exception as e:
+            logger.warning("⚠️ No se pudo migrar la sesión de %s: %s", phone, e)
+            return
+        if migrated:
+            logger.info("🗜️ Sesión de %s migrada al formato compacto", phone)
+
     def _empty_session(self) -> dict:
         """Sesión vacía por defecto"""
+        now = now_epoch()
         return {
             "history": [],
             "metadata": {},
-            "created_at": datetime.utcnow().isoformat(),
-            "updated_at": datetime.utcnow().isoformat()
+            "summary": "",
+            "created_at": now,
+            "updated_at": now
         }
 
 
@@ -0,0 +1,344 @@
+"""
+Resiliencia frente al proveedor: circuit breaker, backoff y hedging
+"""
+import asyncio
+import contextvars
+import logging
+import random
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[type, ...]:
+    """
+    Errores transitorios: cuentan para el breaker y se reintentan (el SDK de
+    Groq se importa recién cuando hace falta)
+    """
+    from groq import APIConnectionError, InternalServerError
+    return asyncio.TimeoutError, APIConnectionError, InternalServerError
+
+
+@lru_cache(maxsize=None)
+def throttle_errors() -> Tuple[type, ...]:
+    """
+    429: se agotó nuestra cuota, el modelo no está fallando. No cuenta para
+    el breaker ni se reintenta aquí (el rate limiter ya esperó y reintentó);
+    se pasa al siguiente modelo, que tiene su propia cuota.
+    """
+    from groq import RateLimitError
+    return (RateLimitError,)
+
+
+class CircuitOpenError(Exception):
+    """Todos los modelos candidatos tienen el circuito abierto"""
+
+
+class CircuitBreaker:
+    """
+    Cerrado: pasan todas las llamadas. Tras `threshold` fallos seguidos se abre
+    y rechaza durante `reset_timeout`; luego deja pasar una sola llamada de
+    prueba (semiabierto) que lo cierra o lo vuelve a abrir.
+    """
+
+    def __init__(self, name: str, threshold: int, reset_timeout: float):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("🔌 Circuito %s cerrado", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def release(self):
+        """La llamada de prueba no llegó a hacerse (se canceló o no hizo falta)"""
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.threshold:
+            if self.opened_at is None or self._probing:
+                logger.warning("🔌 Circuito %s abierto (%s fallos)", self.name, self.failures)
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class AttemptClock:
+    """
+    Tiempo de un intento contra el proveedor, sin contar las esperas locales
+    (nuestro propio rate limit): esas no consumen el timeout del intento, no
+    disparan el hedge y no terminan contadas como fallos del breaker.
+    """
+
+    def __init__(self, wake: asyncio.Event):
+        self.started = time.monotonic()
+        self.local = 0.0
+        self.paused_at: Optional[float] = None
+        self._wake = wake
+
+    @property
+    def waiting_locally(self) -> bool:
+        return self.paused_at is not None
+
+    def elapsed(self) -> float:
+        """Segundos esperando al proveedor"""
+        now = time.monotonic()
+        local = self.local + (now - self.paused_at if self.paused_at is not None else 0.0)
+        return now - self.started - local
+
+    @contextmanager
+    def pause(self) -> Iterator[None]:
+        self.paused_at = time.monotonic()
+        try:
+            yield
+        finally:
+            self.local += time.monotonic() - self.paused_at
+            self.paused_at = None
+            self._wake.set()
+
+
+_attempt_clock: contextvars.ContextVar[Optional[AttemptClock]] = contextvars.ContextVar(
+    "attempt_clock", default=None
+)
+
+
+@contextmanager
+def local_wait() -> Iterator[None]:
+    """Marcar una espera local dentro de un intento (ej. turno en un token bucket)"""
+    clock = _attempt_clock.get()
+    if clock is None:
+        yield
+        return
+    with clock.pause():
+        yield
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Backoff exponencial con full jitter"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class ResilientCaller:
+    """
+    Ejecuta una llamada al proveedor con deadline total, timeout por intento,
+    reintentos con backoff, un breaker por modelo y, si el principal supera el
+    presupuesto de latencia, una petición en paralelo al modelo de respaldo
+    (gana la primera que responda).
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                model,
+                self.settings.groq_circuit_threshold,
+                self.settings.groq_circuit_reset_timeout
+            )
+            self._breakers[model] = breaker
+        return breaker
+
+    async def call(
+        self,
+        operation: str,
+        models: List[str],
+        attempt: Callable[[str], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[None]]] = None,
+        hedge_after: Optional[float] = None,
+    ) -> T:
+        """
+        Args:
+            operation: Nombre para los logs
+            models: Modelo principal y, opcionalmente, el de respaldo
+            attempt: Hace un intento contra el modelo dado
+            discard: Libera el resultado de un intento que llegó tarde (streams)
+            hedge_after: Segundos antes de lanzar el respaldo (None usa la config)
+        """
+        s = self.settings
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + s.groq_deadline
+        hedge_after = s.groq_hedge_after if hedge_after is None else hedge_after
+        models = list(dict.fromkeys(m for m in models if m))
+        last_error: Optional[BaseException] = None
+
+        for retry in range(s.groq_max_retries + 1):
+            # El deadline antes que allow(): un permiso de prueba (semiabierto)
+            # que no se usa tiene que liberarse, si no el circuito queda trabado
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            candidates = [m for m in models if self.breaker(m).allow()]
+            if not candidates:
+                raise CircuitOpenError(f"Groq {operation}: circuito abierto para {', '.join(models)}")
+
+            try:
+                return await asyncio.wait_for(
+                    self._hedged(operation, candidates, attempt, discard, hedge_after),
+                    remaining
+                )
+            except retryable_errors() as e:
+                last_error = e
+
+            delay = backoff_delay(retry, s.groq_backoff_base, s.groq_backoff_max)
+            if retry >= s.groq_max_retries or loop.time() + delay >= deadline:
+                break
+            logger.warning(
+                "🔁 Groq %s: reintento %s/%s en %.2fs (%s)",
+                operation, retry + 1, s.groq_max_retries, delay, type(last_error).__name__
+            )
+            await asyncio.sleep(delay)
+
+        raise last_error or asyncio.TimeoutError(f"Groq {operation}: deadline de {s.groq_deadline}s agotado")
+
+    async def _hedged(
+        self,
+        operation: str,
+        candidates: List[str],
+        attempt: Callable[[str], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[None]]],
+        hedge_after: float,
+    ) -> T:
+        """
+        Principal primero; el respaldo entra si el principal tarda o falla.
+        El timeout por intento y el hedge se miden con el reloj del proveedor
+        (`AttemptClock`): lo que un intento espera en `local_wait` no cuenta.
+        """
+        timeout = self.settings.groq_attempt_timeout
+        started = time.perf_counter()
+        wake = asyncio.Event()
+        tasks: Dict[asyncio.Task, Tuple[str, AttemptClock]] = {}
+        pending_models = list(candidates)
+        last_error: Optional[BaseException] = None
+
+        async def run(model: str, clock: AttemptClock) -> T:
+            _attempt_clock.set(clock)  # Solo en el contexto de esta tarea
+            return await attempt(model)
+
+        def launch():
+            model = pending_models.pop(0)
+            clock = AttemptClock(wake)
+            tasks[asyncio.ensure_future(run(model, clock))] = (model, clock)
+
+        def failed(model: str, error: BaseException):
+            nonlocal last_error
+            self.breaker(model).record_failure()
+            last_error = error
+            logger.warning("⚠️ Groq %s con %s falló: %s", operation, model, type(error).__name__)
+
+        launch()
+        primary = next(iter(tasks.values()))[1]
+        try:
+            while tasks or pending_models:
+                # Intentos que agotaron su tiempo de proveedor
+                waits = []
+                for task, (model, clock) in list(tasks.items()):
+                    if clock.waiting_locally:
+                        continue
+                    remaining = timeout - clock.elapsed()
+                    if remaining <= 0:
+                        del tasks[task]
+                        task.cancel()
+                        failed(model, asyncio.TimeoutError(f"{model}: sin respuesta en {timeout}s"))
+                    else:
+                        waits.append(remaining)
+
+                if pending_models and (not tasks or (
+                    hedge_after > 0 and not primary.waiting_locally and primary.elapsed() >= hedge_after
+                )):
+                    if tasks:
+                        logger.warning(
+                            "⏱️ Groq %s: %s sin respuesta en %ss, se lanza %s",
+                            operation, candidates[0], hedge_after, pending_models[0]
+                        )
+                    launch()
+                    continue
+                if not tasks:
+                    break
+                if pending_models and hedge_after > 0 and not primary.waiting_locally:
+                    waits.append(hedge_after - primary.elapsed())
+
+                # Despertar al terminar un intento, al vencer un plazo o al
+                # terminar una espera local (ahí empieza a correr su reloj)
+                wake.clear()
+                woken = asyncio.ensure_future(wake.wait())
+                try:
+                    done, _ = await asyncio.wait(
+                        [*tasks, woken], timeout=min(waits) if waits else None,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                finally:
+                    woken.cancel()
+
+                for task in done:
+                    if task is woken:
+                        continue
+                    model, _ = tasks.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        self.breaker(model).record_success()
+                        if model != candidates[0]:
+                            elapsed_ms = (time.perf_counter() - started) * 1000
+                            logger.info("🪂 Groq %s: respondió %s (%.0f ms)", operation, model, elapsed_ms)
+                        return task.result()
+
+                    if isinstance(error, throttle_errors()):
+                        self.breaker(model).release()
+                        last_error = error
+                        logger.warning("🚦 Groq %s: cuota agotada en %s", operation, model)
+                        continue
+                    if not isinstance(error, retryable_errors()):
+                        self.breaker(model).release()
+                        raise error
+                    failed(model, error)
+
+            raise last_error
+        finally:
+            for task, (model, _) in tasks.items():
+                task.cancel()
+                self.breaker(model).release()
+                if discard:
+                    task.add_done_callback(_discard_late(discard))
+            for model in pending_models:
+                self.breaker(model).release()
+
+
+def _discard_late(discard: Callable[[T], Awaitable[None]]) -> Callable[[asyncio.Task], None]:
+    """Liberar el resultado de un intento perdedor que terminó igual"""
+    def callback(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(discard(task.result()))
+    return callback
@@ -0,0 +1,194 @@
+"""
+Ruteo de turnos por nivel de modelo, con un clasificador de intención local
+
+Cada turno se clasifica sin red antes de llamar al LLM:
+
+- template: saludos, agradecimientos, despedidas, stickers y adjuntos que no
+  se pueden leer se responden con una plantilla
+- small: turnos simples (confirmaciones, charla corta) van al modelo chico
+- large: preguntas de calificación (precios, integraciones, volumen, agenda)
+  o mensajes largos van al modelo del tenant
+"""
+import logging
+import math
+import re
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, List, Optional
+
+from app.config import get_settings
+from app.metrics import ROUTES
+from app.prompts import ROUTE_TEMPLATES
+from app.services.answer_cache_service import normalize_question
+from app.services.tenant_service import Tenant
+
+logger = logging.getLogger(__name__)
+
+# Marcadores que arma extract_message_content para lo que no es texto
+PLACEHOLDER = re.compile(r"^\[(?P<kind>[^\]]+)\]")
+STICKER_PLACEHOLDERS = ("sticker",)
+
+# Intenciones triviales: el mensaje solo tiene palabras del vocabulario y al
+# menos una palabra ancla (ej. "hola buenas tardes", "mil gracias")
+INTENTS: Dict[str, tuple] = {
+    "goodbye": (
+        frozenset({"chao", "chau", "adios", "bye", "hasta", "luego", "vemos"}),
+        frozenset({"pronto", "manana", "nos", "gracias", "muchas", "ok", "bueno", "listo", "pues", "feliz", "dia", "tarde", "noche"}),
+    ),
+    "thanks": (
+        frozenset({"gracias", "grax", "thanks", "agradezco"}),
+        frozenset({"muchas", "mil", "muy", "amable", "ok", "vale", "listo", "perfecto", "super", "genial", "excelente",
+                   "bueno", "te", "le", "lo", "se", "por", "todo", "la", "info", "informacion", "de", "nuevo", "oki"}),
+    ),
+    "greeting": (
+        frozenset({"hola", "holi", "holaa", "buenas", "buenos", "buen", "hey", "saludos", "hi", "hello"}),
+        frozenset({"dia", "dias", "tardes", "noches", "que", "tal", "como", "estas", "esta", "estan", "vas", "va"}),
+    ),
+    "ack": (
+        frozenset({"ok", "okay", "oki", "vale", "listo", "perfecto", "dale", "entendido", "claro", "si", "no",
+                   "genial", "excelente", "super", "bueno", "bien", "jaja", "jajaja", "ya"}),
+        frozenset({"esta", "muy", "de", "acuerdo", "gracias", "entiendo", "todo", "mas", "o", "menos"}),
+    ),
+}
+
+# Comienzos de palabra que indican una conversación de calificación (texto normalizado)
+QUALIFICATION_STEMS = (
+    "precio", "cuesta", "costo", "cuanto", "valor", "cotiza", "presupuesto", "tarifa", "plan",
+    "empresa", "negocio", "cliente", "venta", "vender",
+    "crm", "integra", "api", "automatiz", "agente", "chatbot", "bot",
+    "agenda", "reunion", "llamada", "demo", "asesor", "humano",
+    "volumen", "mensajes", "implementa", "contrat", "pago", "factura",
+)
+
+# Modelo lineal: pesos fijos sobre rasgos baratos del texto; probabilidad de
+# que el turno necesite el modelo grande
+WEIGHTS = {
+    "bias": -2.0,
+    "words": 0.9,  # log(1 + palabras)
+    "qualification": 1.6,  # Raíces de calificación (hasta 3)
+    "question": 0.7,
+    "digits": 0.5,
+    "summary": 0.5,  # Conversación larga, ya resumida
+}
+
+
+@dataclass(frozen=True)
+class Route:
+    """Decisión de ruteo de un turno"""
+    tier: str  # template | small | large
+    reason: str  # Intención o motivo (etiqueta de métricas)
+    score: float = 0.0  # Probabilidad del modelo lineal de necesitar el modelo grande
+    model: Optional[str] = None
+    max_tokens: int = 0
+    reply: Optional[str] = None  # Solo para template
+
+
+def features(normalized: str, raw: str, summary: Optional[str] = None) -> Dict[str, float]:
+    """Rasgos del modelo lineal"""
+    words = normalized.split()
+    hits = sum(1 for word in words if word.startswith(QUALIFICATION_STEMS))
+    return {
+        "bias": 1.0,
+        "words": math.log1p(len(words)),
+        "qualification": float(min(hits, 3)),
+        "question": 1.0 if "?" in raw else 0.0,
+        "digits": 1.0 if any(c.isdigit() for c in normalized) else 0.0,
+        "summary": 1.0 if summary else 0.0,
+    }
+
+
+def large_model_score(feats: Dict[str, float]) -> float:
+    z = sum(WEIGHTS[name] * value for name, value in feats.items())
+    return 1 / (1 + math.exp(-z))
+
+
+def match_intent(normalized: str) -> Optional[str]:
+    """Intención trivial si todo el mensaje es de su vocabulario"""
+    words: FrozenSet[str] = frozenset(normalized.split())
+    if not words or len(normalized) > 60:
+        return None
+    for intent, (anchors, filler) in INTENTS.items():
+        if words & anchors and words <= anchors | filler:
+            return intent
+    return None
+
+
+class ModelRouter:
+    """Elige plantilla, modelo chico o modelo del tenant para cada turno"""
+
+    def __init__(self):
+        self.settings = get_settings()
+
+    def classify(self, text: str, history: List[dict], summary: Optional[str] = None) -> Route:
+        """Intención y nivel del turno (sin modelo ni plantilla resueltos)"""
+        raw = (text or "").strip()
+        lines = [line.strip() for line in raw.splitlines() if line.strip()]
+
+        # Solo adjuntos (un turno puede agrupar varios)
+        placeholders = [PLACEHOLDER.match(line) for line in lines]
+        if lines and all(placeholders):
+            kinds = {match.group("kind").split()[0].lower() for match in placeholders}
+            return Route("template", "sticker" if kinds <= set(STICKER_PLACEHOLDERS) else "media")
+
+        normalized = normalize_question(raw)
+        if not normalized:
+            # Solo emojis o signos: depende del contexto ("👍" a "¿agendamos?")
+            return Route("small", "emoji")
+
+        intent = match_intent(normalized)
+        if intent in ("thanks", "goodbye"):
+            return Route("template", intent)
+        if intent == "greeting":
+            # Un saludo en medio de una conversación se contesta con contexto
+            return Route("template", intent) if not history else Route("small", intent)
+
+        feats = features(normalized, raw, summary)
+        score = large_model_score(feats)
+        if intent == "ack":
+            return Route("small", intent, score)
+        if score >= self.settings.router_large_threshold:
+            return Route("large", "qualification" if feats["qualification"] else "complex", score)
+        return Route("small", "simple", score)
+
+    def route(self, text: str, tenant: Tenant, history: List[dict], summary: Optional[str] = None) -> Route:
+        """
+        Decidir cómo responder un turno; la decisión queda en logs y métricas
+
+        Args:
+            text: Texto del turno (mensajes agrupados separados por salto de línea)
+            tenant: Negocio (modelo grande, max_tokens y datos de las plantillas)
+            history: Historial reciente de la conversación
+            summary: Resumen de la parte vieja de la conversación
+
+        Returns:
+            Route con la plantilla ya compilada o el modelo y max_tokens a usar
+        """
+        s = self.settings
+        if not s.router_enabled:
+            route = Route("large", "disabled")
+        else:
+            route = self.classify(text, history, summary)
+            if route.tier == "template" and not s.router_templates_enabled:
+                route = Route("small", route.reason)
+            if route.tier == "small" and not s.router_small_model:
+                route = Route("large", route.reason, route.score)
+
+        if route.tier == "template":
+            reply = ROUTE_TEMPLATES[route.reason].format(business_name=tenant.business_name)
+            route = Route(route.tier, route.reason, route.score, reply=reply)
+        elif route.tier == "small":
+            max_tokens = min(tenant.max_tokens, s.router_small_max_tokens)
+            route = Route(route.tier, route.reason, route.score, s.router_small_model, max_tokens)
+        else:
+            route = Route(route.tier, route.reason, route.score, tenant.model, tenant.max_tokens)
+
+        ROUTES.labels(route.tier, route.reason).inc()
+        logger.info(
+            "🧭 Turno → %s (%s, score %.2f)%s", route.tier, route.reason, route.score,
+            f" con {route.model}" if route.model else "",
+            extra={"event": "model_route", "tier": route.tier, "reason": route.reason, "score": round(route.score, 3)}
+        )
+        return route
+
+
+# Instancia global
+model_router = ModelRouter()
@@ -0,0 +1,80 @@
+"""
+Formato compacto de los mensajes de sesión guardados en Redis
+
+Cada mensaje del historial es un item binario versionado por su primer byte:
+
+- `{`  v1 (formato anterior): JSON con role/content/tokens
+- 0x02 v2: msgpack de [rol, contenido, tokens], con el rol como entero
+- 0x03 v2 comprimido: lo mismo pasado por zlib (solo mensajes largos)
+
+Los timestamps se guardan como epoch en segundos.
+"""
+import json
+import time
+import zlib
+from datetime import datetime, timezone
+from typing import Optional, Union
+
+import msgpack
+
+V2 = b"\x02"
+V2_ZLIB = b"\x03"
+
+ROLES = ("user", "assistant", "system")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+
+def encode_message(message: dict, compress_min_bytes: int = 0) -> bytes:
+    """
+    Mensaje de historial -> item v2 (determinístico: el mismo mensaje da
+    siempre los mismos bytes, los scripts Lua comparan por igualdad)
+    """
+    role = message.get("role", "")
+    payload = msgpack.packb(
+        [ROLE_CODES.get(role, role), message.get("content", ""), message.get("tokens") or 0],
+        use_bin_type=True,
+    )
+    if compress_min_bytes and len(payload) >= compress_min_bytes:
+        compressed = zlib.compress(payload, 6)
+        if len(compressed) < len(payload):
+            return V2_ZLIB + compressed
+    return V2 + payload
+
+
+def decode_message(raw: Union[bytes, str]) -> dict:
+    """Item v1 o v2 -> mensaje de historial"""
+    if isinstance(raw, str):
+        raw = raw.encode()
+    version, payload = raw[:1], raw[1:]
+    if version == V2_ZLIB:
+        payload = zlib.decompress(payload)
+    elif version != V2:
+        return json.loads(raw)
+    role, content, tokens = msgpack.unpackb(payload, raw=False)
+    return {"role": ROLES[role] if isinstance(role, int) else role, "content": content, "tokens": tokens}
+
+
+def is_legacy(raw: Union[bytes, str]) -> bool:
+    """Item guardado en el formato JSON anterior"""
+    return raw[:1] in (b"{", "{")
+
+
+def now_epoch() -> int:
+    return int(time.time())
+
+
+def to_epoch(value: Union[bytes, str, int, float, None]) -> Optional[int]:
+    """Timestamp guardado (epoch, o ISO del formato anterior) -> epoch"""
+    if value is None or value == "":
+        return None
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(float(value))
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=timezone.utc)  # Se guardaban con utcnow()
+        return int(parsed.timestamp())
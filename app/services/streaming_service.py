@@ -0,0 +1,124 @@
+"""
+Envío de respuestas en streaming: fragmentos de la respuesta del LLM como
+mensajes de WhatsApp separados mientras la generación continúa
+"""
+import asyncio
+import logging
+import re
+from typing import AsyncIterator, List, Optional
+
+from app.config import get_settings
+from app.services.tenant_service import Tenant
+from app.services.whatsapp_service import whatsapp_service, split_text
+
+logger = logging.getLogger(__name__)
+
+SENTENCE_END = re.compile(r"[.!?…](?:\s+)")
+
+
+class ReplyChunker:
+    """
+    Acumula deltas del LLM y decide dónde cortar:
+    - el primer mensaje sale en el primer fin de oración (llega rápido) o,
+      si no hay puntuación, con las mismas reglas que los siguientes
+    - los siguientes en fin de párrafo, o de oración si el buffer ya es largo
+    - nunca se pasa del límite de WhatsApp
+    """
+
+    def __init__(self, first_chars: int, min_chars: int, max_chars: int, limit: int):
+        self.first_chars = first_chars
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.limit = limit
+        self.buffer = ""
+        self.emitted = 0
+
+    def feed(self, delta: str) -> List[str]:
+        """Agregar un delta y devolver los fragmentos listos para enviar"""
+        self.buffer += delta
+        ready = []
+        while True:
+            cut = self._find_cut()
+            if cut is None:
+                break
+            chunk, self.buffer = self.buffer[:cut].strip(), self.buffer[cut:]
+            if chunk:
+                ready.append(chunk)
+                self.emitted += 1
+        return ready
+
+    def finish(self) -> List[str]:
+        """Vaciar lo que quede al terminar la generación"""
+        rest, self.buffer = self.buffer.strip(), ""
+        return split_text(rest, self.limit) if rest else []
+
+    def _find_cut(self) -> Optional[int]:
+        buf = self.buffer
+        # El primero sale en cuanto hay algo; los siguientes esperan un mínimo
+        start = self.min_chars if self.emitted else self.first_chars
+
+        if not self.emitted:
+            cut = self._sentence_end(buf, start)
+            if cut is not None and cut <= self.limit:
+                return cut
+
+        paragraph = buf.find("\n\n", start)
+        if paragraph != -1 and paragraph < self.limit:
+            return paragraph + 2
+
+        if len(buf) >= self.max_chars:
+            cut = self._sentence_end(buf, start)
+            if cut is not None and cut <= self.limit:
+                return cut
+
+        if len(buf) > self.limit:
+            return len(split_text(buf, self.limit)[0])
+
+        return None
+
+    @staticmethod
+    def _sentence_end(buf: str, start: int) -> Optional[int]:
+        match = SENTENCE_END.search(buf, start)
+        return match.end() if match else None
+
+
+async def stream_reply(phone: str, deltas: AsyncIterator[str], tenant: Optional[Tenant] = None) -> str:
+    """
+    Enviar la respuesta por partes, en orden, mientras se genera
+
+    Returns:
+        Respuesta completa (para guardar en la sesión)
+    """
+    settings = get_settings()
+    chunker = ReplyChunker(
+        first_chars=settings.stream_first_chunk_chars,
+        min_chars=settings.stream_min_chunk_chars,
+        max_chars=settings.stream_max_chunk_chars,
+        limit=whatsapp_service.MAX_BODY_CHARS
+    )
+    outbox: asyncio.Queue = asyncio.Queue()
+    sent = 0
+
+    async def sender():
+        nonlocal sent
+        # Un solo sender por respuesta: los mensajes salen en el orden generado
+        while (chunk := await outbox.get()) is not None:
+            await whatsapp_service.send_text_message(phone, chunk, tenant)
+            sent += 1
+
+    sending = asyncio.create_task(sender())
+    parts = []
+    try:
+        async for delta in deltas:
+            parts.append(delta)
+            for chunk in chunker.feed(delta):
+                outbox.put_nowait(chunk)
+        for chunk in chunker.finish():
+            outbox.put_nowait(chunk)
+    finally:
+        # Lo ya generado se termina de enviar aunque la generación falle
+        outbox.put_nowait(None)
+        await sending
+
+    logger.info("📤 Respuesta enviada en %d parte(s) a %s", sent, phone, extra={"event": "reply_streamed"})
+    return "".join(parts).strip()
@@ -0,0 +1,53 @@
+"""
+Resumen incremental de conversaciones (fuera del camino de respuesta)
+"""
+import asyncio
+import logging
+from typing import Dict, List
+
+from app.config import get_settings
+from app.services.groq_service import groq_service
+from app.services.history_service import fit_history
+from app.services.redis_service import session_manager
+
+logger = logging.getLogger(__name__)
+
+
+class ConversationSummarizer:
+    def __init__(self):
+        self.settings = get_settings()
+        self._running: Dict[str, asyncio.Task] = {}
+
+    def needs_summary(self, history: List[dict]) -> bool:
+        """Hay mensajes que ya no entran en el presupuesto"""
+        _, overflow = fit_history(history, self.settings.history_token_budget)
+        return bool(overflow)
+
+    def schedule(self, phone: str, business_name: str = None):
+        """Resumir en background (una tarea por conversación a la vez)"""
+        if phone in self._running:
+            return
+        task = asyncio.create_task(self._summarize(phone, business_name))
+        self._running[phone] = task
+        task.add_done_callback(lambda _: self._running.pop(phone, None))
+
+    async def _summarize(self, phone: str, business_name: str = None):
+        try:
+            session = await session_manager.get_session(phone)
+            _, overflow = fit_history(session.get("history", []), self.settings.history_token_budget)
+            if not overflow:
+                return
+
+            summary = await groq_service.summarize(session.get("summary", ""), overflow, business_name)
+
+            if await session_manager.apply_summary(phone, summary, overflow):
+                logger.info("📝 Resumen actualizado para %s (%s mensajes)", phone, len(overflow))
+            else:
+                logger.info("📝 Historial de %s cambió mientras se resumía, se reintenta luego", phone)
+
+        except Exception as e:
+            logger.warning("⚠️ No se pudo resumir la conversación de %s: %s", phone, e)
+
+
+# Instancia global
+conversation_summarizer = ConversationSummarizer()
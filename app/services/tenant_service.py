@@ -0,0 +1,164 @@
+"""
+Registro de tenants - un número de WhatsApp (phone_number_id) por negocio
+"""
+import asyncio
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional
+
+import redis.asyncio as redis
+
+from app.config import get_settings
+from app.prompts import LOOPERA_PROMPT_TEMPLATE, render_prompt
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+
+
+@dataclass(frozen=True)
+class Tenant:
+    phone_number_id: str
+    whatsapp_token: str
+    business_name: str
+    business_description: str
+    system_prompt: str  # Ya compilado
+    prompt_version: str
+    model: str = DEFAULT_MODEL
+    temperature: float = 0.7
+    max_tokens: int = 500
+    is_default: bool = False
+
+    def session_key(self, phone: str) -> str:
+        """Clave de conversación (el tenant por defecto conserva las claves de siempre)"""
+        return phone if self.is_default else f"{self.phone_number_id}:{phone}"
+
+
+def build_tenant(data: dict, is_default: bool = False) -> Tenant:
+    """Armar un Tenant desde su configuración, compilando el prompt una vez"""
+    settings = get_settings()
+    business_name = data.get("business_name") or settings.business_name
+    business_description = data.get("business_description") or settings.business_description
+    system_prompt = render_prompt(
+        data.get("prompt_template") or LOOPERA_PROMPT_TEMPLATE,
+        business_name,
+        business_description
+    )
+    return Tenant(
+        phone_number_id=str(data.get("phone_number_id") or ""),
+        whatsapp_token=data.get("whatsapp_token") or settings.whatsapp_token,
+        business_name=business_name,
+        business_description=business_description,
+        system_prompt=system_prompt,
+        prompt_version=hashlib.sha1(system_prompt.encode()).hexdigest()[:12],
+        model=data.get("model") or DEFAULT_MODEL,
+        temperature=float(data.get("temperature", 0.7)),
+        max_tokens=int(data.get("max_tokens", 500)),
+        is_default=is_default,
+    )
+
+
+class TenantRegistry:
+    """
+    Tenants cargados desde un archivo JSON y/o un hash de Redis
+    (phone_number_id -> JSON), con recarga en caliente.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self.default = build_tenant({"phone_number_id": self.settings.phone_id}, is_default=True)
+        self._tenants: Dict[str, Tenant] = {}
+        self._sources_fingerprint = ""
+        self._watcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        """Cargar tenants y vigilar cambios"""
+        if self.settings.tenants_redis_key:
+            self.redis = create_redis()
+        try:
+            await self.reload()
+        except Exception as e:
+            logger.error("❌ Error cargando tenants, se usa solo el negocio por defecto: %s", e)
+        if self.settings.tenants_file or self.redis:
+            self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._watcher:
+            self._watcher.cancel()
+            self._watcher = None
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    def resolve(self, phone_number_id: Optional[str]) -> Optional[Tenant]:
+        """
+        Tenant dueño del número
+
+        Returns:
+            El tenant registrado, el negocio por defecto si el número es el
+            suyo (o el job no trae número, como los encolados antes de
+            multi-tenant) o None si el número no es de ningún negocio: no se
+            responde con el token y el número de otro
+        """
+        if not phone_number_id or phone_number_id == self.default.phone_number_id:
+            return self.default
+        return self._tenants.get(phone_number_id)
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    async def reload(self) -> bool:
+        """Recargar si las fuentes cambiaron; True si hubo cambios"""
+        raw = await self._read_sources()
+        fingerprint = hashlib.sha1(json.dumps(raw, sort_keys=True).encode()).hexdigest()
+        if fingerprint == self._sources_fingerprint:
+            return False
+
+        tenants = {}
+        for phone_number_id, data in raw.items():
+            try:
+                tenant = build_tenant({**data, "phone_number_id": phone_number_id})
+                tenants[tenant.phone_number_id] = tenant
+            except Exception as e:
+                logger.error("❌ Tenant %s inválido: %s", phone_number_id, e)
+
+        # Reemplazo atómico: los mensajes en curso siguen con el registro anterior
+        self._tenants = tenants
+        self._sources_fingerprint = fingerprint
+        logger.info("🏢 %s tenant(s) cargados", len(tenants))
+        return True
+
+    async def _read_sources(self) -> Dict[str, dict]:
+        raw: Dict[str, dict] = {}
+
+        if self.settings.tenants_file:
+            # Un error de lectura se propaga: mejor conservar el registro anterior
+            # que quedarse sin tenants por un archivo a medio escribir
+            data = json.loads(await asyncio.to_thread(Path(self.settings.tenants_file).read_text))
+            entries = data.get("tenants", []) if isinstance(data, dict) else data
+            for entry in entries:
+                raw[str(entry["phone_number_id"])] = entry
+
+        if self.redis:
+            stored = await self.redis.hgetall(self.settings.tenants_redis_key)
+            for phone_number_id, value in stored.items():
+                raw[phone_number_id] = json.loads(value)
+
+        return raw
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.settings.tenants_reload_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error("❌ Error recargando tenants: %s", e)
+
+
+# Instancia global
+tenant_registry = TenantRegistry()
@@ -0,0 +1,156 @@
+"""
+Caché de transcripciones de notas de voz (audios reenviados o repetidos)
+"""
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+import redis.asyncio as redis
+
+from app.config import get_settings
+from app.metrics import CACHE_LOOKUPS
+from app.services.redis_service import create_redis
+
+logger = logging.getLogger(__name__)
+
+# Cambiar si cambia la preparación del audio (invalida lo cacheado); el
+# modelo y el idioma de Whisper ya van en la clave
+CACHE_VERSION = "v2"
+
+
+class TranscriptionCache:
+    """
+    Texto por SHA-256 del audio (sirve para reenvíos, que llegan con otro
+    media_id) y por media_id (evita hasta la descarga). Un LRU local delante
+    de Redis y una sola transcripción en vuelo por audio.
+    """
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.redis: Optional[redis.Redis] = None
+        self.ttl = self.settings.transcription_cache_ttl
+        self._local: "OrderedDict[str, str]" = OrderedDict()
+        self._local_max = self.settings.transcription_cache_local_size
+        self._inflight: Dict[str, asyncio.Future] = {}
+        language = self.settings.whisper_language or "auto"
+        self._prefix = f"transcript:{CACHE_VERSION}:{self.settings.whisper_model}:{language}"
+
+    async def connect(self):
+        """Conectar a Redis"""
+        self.redis = create_redis()
+
+    async def disconnect(self):
+        """Desconectar de Redis"""
+        if self.redis:
+            await self.redis.aclose()
+            self.redis = None
+
+    def _key(self, kind: str, value: str) -> str:
+        return f"{self._prefix}:{kind}:{value}"
+
+    def _remember(self, key: str, text: str):
+        self._local[key] = text
+        self._local.move_to_end(key)
+        while len(self._local) > self._local_max:
+            self._local.popitem(last=False)
+
+    async def _get(self, key: str) -> Optional[str]:
+        text = self._local.get(key)
+        if text is not None:
+            self._local.move_to_end(key)
+            return text
+        if not self.redis:
+            return None
+        try:
+            text = await self.redis.get(key)
+        except Exception as e:
+            logger.warning("⚠️ Caché de transcripciones sin Redis: %s", e)
+            return None
+        if text is not None:
+            self._remember(key, text)
+        return text
+
+    async def lookup_media(self, media_id: str) -> Optional[str]:
+        """Transcripción de un media_id ya visto (antes de descargarlo)"""
+        text = await self._get(self._key("media", media_id))
+        if text is not None:
+            CACHE_LOOKUPS.labels("transcription", "media_hit").inc()
+            logger.info("💾 Transcripción cacheada (media %s)", media_id)
+        return text
+
+    async def transcribe(
+        self,
+        audio_bytes: bytes,
+        media_id: str,
+        transcribe: Callable[[], Awaitable[str]]
+    ) -> str:
+        """
+        Transcripción por contenido: si el audio ya se transcribió se reutiliza,
+        si se está transcribiendo se espera esa misma llamada, y si no se llama
+        a `transcribe` y se guarda el resultado.
+        """
+        digest = hashlib.sha256(audio_bytes).hexdigest()
+        content_key = self._key("sha256", digest)
+
+        text = await self._get(content_key)
+        if text is not None:
+            CACHE_LOOKUPS.labels("transcription", "content_hit").inc()
+            logger.info("💾 Transcripción cacheada (audio %.12s)", digest)
+            await self._store(content_key, media_id, text)
+            return text
+
+        inflight = self._inflight.get(digest)
+        if inflight is not None:
+            CACHE_LOOKUPS.labels("transcription", "inflight_hit").inc()
+            try:
+                text = await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Si se canceló la transcripción ajena (no esta tarea), hacerla aquí
+                if not inflight.cancelled():
+                    raise
+            else:
+                await self._store(content_key, media_id, text)
+                return text
+
+        CACHE_LOOKUPS.labels("transcription", "miss").inc()
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[digest] = future
+        try:
+            text = await transcribe()
+            future.set_result(text)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Si nadie más esperaba, evitar "exception was never retrieved"
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(digest, None)
+
+        await self._store(content_key, media_id, text)
+        return text
+
+    async def _store(self, content_key: str, media_id: str, text: str):
+        """Guardar bajo el hash del audio y bajo el media_id, con TTL"""
+        media_key = self._key("media", media_id) if media_id else None
+        self._remember(content_key, text)
+        if media_key:
+            self._remember(media_key, text)
+        if not self.redis:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.set(content_key, text, ex=self.ttl)
+            if media_key:
+                pipe.set(media_key, text, ex=self.ttl)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("⚠️ No se pudo cachear la transcripción: %s", e)
+
+
+# Instancia global
+transcription_cache = TranscriptionCache()
@@ -1,33 +1,123 @@
 """
 Servicio de WhatsApp Cloud API
 """
+import asyncio
 import logging
 import httpx
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
 
 from app.config import get_settings
+from app.metrics import track
+from app.services.rate_limit_service import parse_duration, rate_limiter
+from app.services.tenant_service import Tenant
 
 logger = logging.getLogger(__name__)
 
+# Códigos de Meta por throughput, par emisor-receptor o límite de la app
+THROTTLE_CODES = {130429, 131056, 80007, 4, 613}
+
+
+def split_text(text: str, limit: int) -> List[str]:
+    """Partir un texto en trozos de máximo `limit` caracteres, cortando en espacios"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        parts.append(text)
+    return parts
+
 
 class WhatsAppService:
-    BASE_URL = "https://graph.facebook.com/v21.0"
+    MAX_BODY_CHARS = 4096  # Límite de Meta para text.body
 
     def __init__(self):
         self.settings = get_settings()
-        # Log de verificación de config
-        token = self.settings.whatsapp_token or "(vacío)"
-        phone_id = self.settings.phone_id or "(vacío)"
-        logger.info(f"📱 WhatsApp Config - Token: {token[:20] if len(token) > 20 else token}... | Phone ID: {phone_id}")
-
-    async def send_text_message(self, to: str, text: str) -> dict:
-        """Enviar mensaje de texto"""
-        url = f"{self.BASE_URL}/{self.settings.phone_id}/messages"
-
-        headers = {
-            "Authorization": f"Bearer {self.settings.whatsapp_token}",
-            "Content-Type": "application/json"
-        }
+        self.base_url = self.settings.whatsapp_api_url.rstrip("/")
+        self.client: Optional[httpx.AsyncClient] = None
+        self._headers_by_token: Dict[str, Tuple[dict, dict]] = {}
+
+    async def start(self):
+        """Crear el pool HTTP compartido (se llama desde lifespan)"""
+        if self.client is None:
+            self.client = self._build_client()
+            # Log de verificación de config (sin exponer el token)
+            logger.info(
+                "📱 WhatsApp Config - Token: %s | Phone ID: %s",
+                "configurado" if self.settings.whatsapp_token else "(vacío)",
+                self.settings.phone_id or "(vacío)"
+            )
+
+    async def warm_up(self):
+        """
+        Resolver el DNS de Graph API y dejar una conexión abierta en el pool,
+        para que el primer mensaje no pague DNS + TLS
+        """
+        url = urlsplit(self.base_url)
+        port = url.port or (443 if url.scheme == "https" else 80)
+        await asyncio.get_running_loop().getaddrinfo(url.hostname, port)
+        # Cualquier respuesta sirve (la conexión queda en keep-alive)
+        await self._get_client().head(self.base_url)
+
+    async def close(self):
+        """Cerrar el pool HTTP compartido"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _build_client(self) -> httpx.AsyncClient:
+        """Cliente HTTP/2 con keep-alive y timeouts configurables"""
+        s = self.settings
+        return httpx.AsyncClient(
+            http2=s.whatsapp_http2,
+            limits=httpx.Limits(
+                max_connections=s.whatsapp_max_connections,
+                max_keepalive_connections=s.whatsapp_max_keepalive_connections,
+                keepalive_expiry=s.whatsapp_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                s.whatsapp_read_timeout,
+                connect=s.whatsapp_connect_timeout,
+                pool=s.whatsapp_pool_timeout,
+            ),
+        )
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Obtener el pool compartido (lazy si no pasó por lifespan)"""
+        if self.client is None:
+            self.client = self._build_client()
+        return self.client
+
+    def _headers(self, tenant: Optional[Tenant] = None) -> Tuple[dict, dict]:
+        """Headers de auth y JSON por token (armados una vez por tenant)"""
+        token = tenant.whatsapp_token if tenant else self.settings.whatsapp_token
+        headers = self._headers_by_token.get(token)
+        if headers is None:
+            auth = {"Authorization": f"Bearer {token}"}
+            headers = (auth, {**auth, "Content-Type": "application/json"})
+            self._headers_by_token[token] = headers
+        return headers
+
+    def _messages_url(self, tenant: Optional[Tenant] = None) -> str:
+        phone_id = tenant.phone_number_id if tenant else self.settings.phone_id
+        return f"{self.base_url}/{phone_id}/messages"
+
+    async def send_text_message(self, to: str, text: str, tenant: Optional[Tenant] = None) -> dict:
+        """Enviar mensaje de texto (si supera el límite de Meta, va en varios mensajes)"""
+        if len(text) > self.MAX_BODY_CHARS:
+            result = {}
+            for part in split_text(text, self.MAX_BODY_CHARS):
+                result = await self.send_text_message(to, part, tenant)
+            return result
+
+        url = self._messages_url(tenant)
+        _, json_headers = self._headers(tenant)
 
         payload = {
             "messaging_product": "whatsapp",
@@ -37,90 +127,92 @@ class WhatsAppService:
             "text": {"body": text}
         }
 
-        logger.info(f"📤 Enviando mensaje a {to}")
-        logger.info(f"📤 URL: {url}")
-        logger.info(f"📤 Payload: {payload}")
+        logger.debug("📤 URL: %s", url)
+        logger.debug("📤 Payload: %s", payload)
 
-        async with httpx.AsyncClient() as client:
-            response = await client.post(url, headers=headers, json=payload)
+        bucket = f"whatsapp:{tenant.phone_number_id if tenant else self.settings.phone_id}"
+        retries = self.settings.rate_limit_max_retries
+        for attempt in range(retries + 1):
+            await rate_limiter.acquire(bucket)
+            with track("send_text"):
+                response = await self._get_client().post(url, headers=json_headers, json=payload)
 
-            # Log completo de la respuesta
-            logger.info(f"📥 Status Code: {response.status_code}")
-            logger.info(f"📥 Response Body: {response.text}")
+            # La respuesta completa solo en modo debug
+            logger.info(
+                "📤 Mensaje enviado a %s (%d)", to, response.status_code,
+                extra={"event": "message_sent"}
+            )
+            logger.debug("📥 Response Body: %s", response.text)
 
-            if response.status_code != 200:
-                logger.error(f"❌ Error enviando mensaje: {response.status_code} - {response.text}")
-
-            return response.json()
-    
-    async def send_typing_indicator(self, to: str):
-        """Enviar indicador de 'escribiendo...'"""
-        url = f"{self.BASE_URL}/{self.settings.phone_id}/messages"
-        
-        headers = {
-            "Authorization": f"Bearer {self.settings.whatsapp_token}",
-            "Content-Type": "application/json"
-        }
-        
-        payload = {
-            "messaging_product": "whatsapp",
-            "recipient_type": "individual",
-            "to": to,
-            "type": "reaction",
-            "status": "typing"
-        }
-        
-        async with httpx.AsyncClient() as client:
-            try:
-                await client.post(url, headers=headers, json=payload)
-            except:
-                pass  # Ignorar errores del typing indicator
-    
-    async def download_media(self, media_id: str) -> Optional[bytes]:
+            if not self._is_throttled(response) or attempt >= retries:
+                break
+
+            # Pausar el número para todos los workers y reintentar
+            pause = parse_duration(response.headers.get("retry-after")) or 2.0 ** attempt
+            logger.warning("🚦 Meta limitó %s, reintento %d/%d", bucket, attempt + 1, retries)
+            await rate_limiter.block(bucket, pause)
+
+        if response.status_code != 200:
+            logger.error("❌ Error enviando mensaje: %d - %s", response.status_code, response.text)
+
+        return response.json()
+
+    @staticmethod
+    def _is_throttled(response: httpx.Response) -> bool:
+        """429 o error de Graph API con código de throttling"""
+        if response.status_code == 429:
+            return True
+        if response.status_code < 400:
+            return False
+        try:
+            code = response.json().get("error", {}).get("code")
+        except ValueError:
+            return False
+        return code in THROTTLE_CODES
+
+    async def download_media(self, media_id: str, tenant: Optional[Tenant] = None) -> Optional[bytes]:
         """Descargar archivo multimedia (audio, imagen, etc.)"""
-        # Paso 1: Obtener URL del media
-        url = f"{self.BASE_URL}/{media_id}"
-        headers = {"Authorization": f"Bearer {self.settings.whatsapp_token}"}
-        
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url, headers=headers)
-            
+        client = self._get_client()
+        auth_headers, _ = self._headers(tenant)
+
+        with track("download_media"):
+            # Paso 1: Obtener URL del media
+            url = f"{self.base_url}/{media_id}"
+            response = await client.get(url, headers=auth_headers)
+
             if response.status_code != 200:
                 return None
-            
+
             media_url = response.json().get("url")
-            
+
             if not media_url:
                 return None
-            
+
             # Paso 2: Descargar el archivo
-            media_response = await client.get(media_url, headers=headers)
-            
-            if media_response.status_code == 200:
-                return media_response.content
-            
-            return None
-    
-    async def mark_as_read(self, message_id: str):
-        """Marcar mensaje como leído"""
-        url = f"{self.BASE_URL}/{self.settings.phone_id}/messages"
-        
-        headers = {
-            "Authorization": f"Bearer {self.settings.whatsapp_token}",
-            "Content-Type": "application/json"
-        }
-        
+            media_response = await client.get(media_url, headers=auth_headers)
+
+        if media_response.status_code == 200:
+            return media_response.content
+
+        return None
+
+    async def mark_as_read(self, message_id: str, tenant: Optional[Tenant] = None, typing: bool = False):
+        """Marcar mensaje como leído (y, con `typing`, mostrar 'escribiendo...' en la misma llamada)"""
         payload = {
             "messaging_product": "whatsapp",
             "status": "read",
             "message_id": message_id
         }
-        
-        async with httpx.AsyncClient() as client:
-            try:
-                await client.post(url, headers=headers, json=payload)
-            except:
-                pass
+        if typing:
+            payload["typing_indicator"] = {"type": "text"}
+
+        try:
+            with track("mark_as_read"):
+                await self._get_client().post(
+                    self._messages_url(tenant), headers=self._headers(tenant)[1], json=payload
+                )
+        except Exception:
+            pass
 
 
 # Instancia global
@@ -0,0 +1,99 @@
+"""
+Warm-up de arranque y estado de readiness
+
+El proceso está vivo (liveness) apenas responde HTTP; está listo (readiness)
+recién cuando terminó el warm-up: clientes creados, DNS resuelto, conexiones
+TLS y de Redis abiertas y ffmpeg verificado. Así el primer usuario después de
+un autoscale no paga el arranque en frío.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict
+
+from app.config import get_settings
+from app.services import (
+    session_manager,
+    whatsapp_service,
+    groq_service,
+    audio_transcoder,
+    message_queue,
+    message_deduplicator,
+    answer_cache,
+    transcription_cache,
+    rate_limiter,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """Estado del proceso: starting -> ready -> stopping"""
+
+    def __init__(self):
+        self.state = "starting"
+        self.checks: Dict[str, str] = {}
+
+    @property
+    def ready(self) -> bool:
+        return self.state == "ready"
+
+    def report(self) -> dict:
+        return {"status": self.state, "checks": self.checks}
+
+
+async def _check(name: str, warm: Callable[[], Awaitable], timeout: float) -> str:
+    started = time.perf_counter()
+    try:
+        detail = await asyncio.wait_for(warm(), timeout)
+    except FileNotFoundError:
+        logger.warning("⚠️ Warm-up %s: no encontrado", name)
+        return "missing"
+    except Exception as e:
+        logger.warning("⚠️ Warm-up %s falló: %s", name, e or type(e).__name__)
+        return f"error: {type(e).__name__}"
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    logger.info("🔥 Warm-up %s: %.0f ms%s", name, elapsed_ms, f" ({detail})" if isinstance(detail, str) else "")
+    return "ok"
+
+
+async def warm_up(readiness: Readiness, groq: bool = True):
+    """
+    Preparar todo lo que usa el primer mensaje, en paralelo y con tope de
+    `WARMUP_TIMEOUT` por chequeo. Un chequeo fallido no bloquea el arranque
+    (cada servicio ya degrada solo); queda reportado en `readiness.checks`.
+
+    Args:
+        readiness: Estado a actualizar
+        groq: Preparar el cliente de Groq (el web con cola activa no lo usa)
+    """
+    timeout = get_settings().warmup_timeout
+    checks: Dict[str, Callable[[], Awaitable]] = {
+        "whatsapp": whatsapp_service.warm_up,
+        "ffmpeg": audio_transcoder.warm_up,
+    }
+    if groq:
+        checks["groq"] = groq_service.warm_up
+
+    # Una conexión abierta por cliente Redis (el pool las crea a demanda)
+    for name, service in (
+        ("redis_sessions", session_manager),
+        ("redis_queue", message_queue),
+        ("redis_dedup", message_deduplicator),
+        ("redis_rate_limit", rate_limiter),
+        ("redis_answer_cache", answer_cache),
+        ("redis_transcriptions", transcription_cache),
+    ):
+        if getattr(service, "redis", None) is not None:
+            checks[name] = service.redis.ping
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_check(name, warm, timeout) for name, warm in checks.items()))
+    readiness.checks = dict(zip(checks, results))
+    if readiness.state == "starting":
+        readiness.state = "ready"
+    logger.info("✅ Warm-up completo en %.0f ms", (time.perf_counter() - started) * 1000)
+
+
+# Instancia global
+readiness = Readiness()
@@ -0,0 +1,53 @@
+"""
+Ingesta del webhook de WhatsApp - firma, parseo y extracción de mensajes
+"""
+import hmac
+import hashlib
+from typing import List, Optional, Tuple
+
+import orjson
+
+SIGNATURE_PREFIX = "sha256="
+
+
+def verify_signature(raw_body: bytes, signature_header: Optional[str], app_secret: str) -> bool:
+    """
+    Verificar X-Hub-Signature-256 en tiempo constante
+
+    Args:
+        raw_body: Bytes exactos recibidos de Meta
+        signature_header: Valor del header ("sha256=<hex>")
+        app_secret: App Secret de la app de Meta
+
+    Returns:
+        True si la firma es válida
+    """
+    if not signature_header or not signature_header.startswith(SIGNATURE_PREFIX):
+        return False
+
+    expected = hmac.new(app_secret.encode(), raw_body, hashlib.sha256).hexdigest()
+    received = signature_header[len(SIGNATURE_PREFIX):]
+    return hmac.compare_digest(expected, received)
+
+
+def parse_body(raw_body: bytes) -> dict:
+    """Parsear el body una sola vez (orjson trabaja directo sobre bytes)"""
+    body = orjson.loads(raw_body)
+    return body if isinstance(body, dict) else {}
+
+
+def extract_messages(body: dict) -> List[Tuple[dict, dict]]:
+    """
+    Extraer todos los mensajes de todas las entradas y cambios
+
+    Returns:
+        Lista de tuplas (mensaje, metadata del número receptor)
+    """
+    extracted = []
+    for entry in body.get("entry") or ():
+        for change in entry.get("changes") or ():
+            value = change.get("value") or {}
+            metadata = value.get("metadata") or {}
+            for message in value.get("messages") or ():
+                extracted.append((message, metadata))
+    return extracted
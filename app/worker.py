@@ -0,0 +1,224 @@
+"""
+Worker de procesamiento - consume la cola de Redis Streams
+
+Uso: python -m app.worker
+"""
+import asyncio
+import logging
+import math
+import os
+import signal
+import socket
+import uuid
+from functools import partial
+from typing import Dict, Set
+
+from prometheus_client import start_http_server
+
+from app.config import get_settings
+from app.logging_config import setup_logging
+from app.metrics import registry
+from app.pipeline import PhoneChain, process_message
+from app.warmup import readiness, warm_up
+from app.services import (
+    session_manager,
+    whatsapp_service,
+    message_queue,
+    answer_cache,
+    transcription_cache,
+    tenant_registry,
+    rate_limiter,
+    close_redis_pools,
+)
+
+setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    def __init__(self):
+        self.settings = get_settings()
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.owned: Set[int] = set()
+        self._chain = PhoneChain()  # Jobs en vuelo, en orden por teléfono
+        self._inflight: Dict[int, int] = {}  # Jobs en vuelo por shard
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        logger.info("👋 Deteniendo worker...")
+        self._stopping.set()
+
+    async def run(self):
+        """Loop principal: leases + lectura + despacho"""
+        logger.info("🚀 Iniciando worker %s", self.consumer)
+
+        await whatsapp_service.start()
+        try:
+            await session_manager.connect()
+        except Exception as e:
+            logger.warning("⚠️ No se pudo conectar a Redis para sesiones: %s", e)
+            session_manager.start_recovery()
+        await tenant_registry.start()
+        await rate_limiter.connect()
+        if self.settings.transcription_cache_enabled:
+            await transcription_cache.connect()
+        if self.settings.answer_cache_enabled:
+            await answer_cache.connect()
+        await message_queue.connect()
+        await message_queue.ensure_groups()
+        # Clientes y conexiones listos antes de tomar el primer mensaje
+        await warm_up(readiness)
+        await self._rebalance()
+
+        leases = asyncio.create_task(self._maintain_leases())
+        try:
+            await self._consume()
+        finally:
+            leases.cancel()
+            if self._chain.tasks:
+                await asyncio.wait(list(self._chain.tasks))
+            await message_queue.leave(self.consumer, list(self.owned))
+            await message_queue.disconnect()
+            await session_manager.disconnect()
+            await answer_cache.disconnect()
+            await tenant_registry.stop()
+            await rate_limiter.disconnect()
+            await transcription_cache.disconnect()
+            await close_redis_pools()
+            await whatsapp_service.close()
+
+    async def _consume(self):
+        block_ms = self.settings.worker_block_ms
+        # Más de lo que admite el control de admisión, para que haya entre qué
+        # elegir por prioridad (el resto espera durable en el stream)
+        max_inflight = self.settings.admission_max_inflight + self.settings.worker_concurrency
+
+        while not self._stopping.is_set():
+            # Backpressure: no leer más de lo que podemos procesar
+            if not self.owned or sum(self._inflight.values()) >= max_inflight:
+                await asyncio.sleep(block_ms / 1000 if not self.owned else 0.05)
+                continue
+
+            try:
+                jobs = await message_queue.read(
+                    self.consumer, sorted(self.owned),
+                    count=max_inflight, block_ms=block_ms
+                )
+            except Exception as e:
+                logger.error("Error leyendo la cola: %s", e)
+                await asyncio.sleep(1)
+                continue
+
+            for stream, entry_id, job in jobs:
+                self._dispatch(stream, entry_id, job)
+
+    async def _maintain_leases(self):
+        """Renovar leases periódicamente"""
+        interval = self.settings.queue_lease_ttl_ms / 3000
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._rebalance()
+            except Exception as e:
+                logger.error("Error manteniendo leases: %s", e)
+
+    async def _rebalance(self):
+        """Repartir shards entre workers vivos y reclamar jobs colgados"""
+        shards = message_queue.shards
+        alive = await message_queue.heartbeat(self.consumer)
+        fair_share = math.ceil(shards / alive)
+
+        # Renovar los propios
+        for shard in list(self.owned):
+            if not await message_queue.acquire_shard(shard, self.consumer):
+                logger.warning("⚠️ Lease perdido en shard %s", shard)
+                self.owned.discard(shard)
+                self._forget_sessions(shard)
+
+        # Ceder excedente (solo shards sin jobs en vuelo, para no romper el orden)
+        for shard in sorted(self.owned, reverse=True):
+            if len(self.owned) <= fair_share:
+                break
+            if not self._inflight.get(shard):
+                await message_queue.release_shard(shard, self.consumer)
+                self.owned.discard(shard)
+                self._forget_sessions(shard)
+
+        # Tomar shards libres hasta la cuota justa
+        for shard in range(shards):
+            if len(self.owned) >= fair_share:
+                break
+            if shard not in self.owned and await message_queue.acquire_shard(shard, self.consumer):
+                # Lo que quedó en el L1 de una tenencia anterior puede estar viejo
+                self._forget_sessions(shard)
+                # Primero lo que dejó pendiente el dueño anterior, después lo nuevo
+                for stream, entry_id, job in await message_queue.take_over(self.consumer, shard):
+                    logger.info("♻️ Reclamado job %s de %s (cambio de dueño)", entry_id, stream)
+                    self._dispatch(stream, entry_id, job)
+                self.owned.add(shard)
+                logger.info("📥 Shard %s asignado a %s", shard, self.consumer)
+
+        # Reclamar jobs de workers caídos antes de leer nuevos (los propios no:
+        # siguen esperando cupo, admisión o el turno de otro mensaje)
+        for shard in sorted(self.owned):
+            for stream, entry_id, job in await message_queue.claim_stalled(
+                self.consumer, shard, count=self.settings.worker_concurrency
+            ):
+                logger.info("♻️ Reclamado job %s de %s", entry_id, stream)
+                self._dispatch(stream, entry_id, job)
+
+    @staticmethod
+    def _forget_sessions(shard: int):
+        """Sacar del L1 las sesiones de un shard que otro worker puede modificar"""
+        # La clave de sesión es el teléfono, con prefijo de tenant si no es el por defecto
+        session_manager.forget(lambda key: message_queue.shard_for(key.rpartition(":")[2]) == shard)
+
+    def _dispatch(self, stream: str, entry_id: str, job: dict):
+        """Encadenar el job detrás del anterior del mismo teléfono"""
+        phone = job.get("phone") or ""
+        shard = message_queue.shard_for(phone)
+        self._inflight[shard] = self._inflight.get(shard, 0) + 1
+
+        task = self._chain.dispatch(phone, partial(self._run, stream, entry_id, job))
+
+        def _done(_: asyncio.Task):
+            self._inflight[shard] -= 1
+
+        task.add_done_callback(_done)
+
+    async def _run(self, stream: str, entry_id: str, job: dict, ingested: asyncio.Event):
+        # El XACK lo hace process_message: si el mensaje se sumó al turno de
+        # otro job, recién cuando ese turno se respondió. El cupo y la
+        # prioridad los decide el control de admisión de process_message.
+        try:
+            await process_message(
+                **job, ingested=ingested, ack=partial(message_queue.ack, stream, entry_id)
+            )
+        except Exception as e:
+            # process_message ya maneja sus errores; esto evita reintentos infinitos
+            logger.error("Error en job %s: %s", entry_id, e)
+            try:
+                await message_queue.ack(stream, entry_id)
+            except Exception as e:
+                logger.error("Error confirmando job %s: %s", entry_id, e)
+
+
+async def main():
+    settings = get_settings()
+    if settings.worker_metrics_port:
+        # Los workers no tienen HTTP: exponen /metrics en su propio puerto
+        try:
+            start_http_server(settings.worker_metrics_port, registry=registry())
+            logger.info("📊 Métricas en :%s/metrics", settings.worker_metrics_port)
+        except OSError as e:
+            logger.warning("⚠️ Sin endpoint de métricas en :%s: %s", settings.worker_metrics_port, e)
+
+    worker = Worker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, worker.stop)
+    await worker.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,3 @@
+"""
+Benchmarks offline (python -m bench.run, python -m bench.sessions)
+"""
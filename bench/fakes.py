@@ -0,0 +1,239 @@
+"""
+Servidores falsos de Graph API y Groq para benchmarks offline
+
+Un solo servidor HTTP local atiende:
+- Graph API: /v21.0/{phone_id}/messages, /v21.0/{media_id} y /media/{media_id}
+- Groq: /openai/v1/chat/completions (con y sin streaming),
+  /openai/v1/audio/transcriptions y /openai/v1/models (warm-up)
+
+Cada ruta simula latencia (con jitter) y errores (500/429) configurables, y
+registra cuándo llega cada respuesta del bot para medir latencia de punta a punta.
+"""
+import asyncio
+import os
+import random
+import shutil
+import threading
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+FAKE_REPLY = (
+    "¡Hola! Soy el asistente de Loopera. Desarrollamos agentes de IA que atienden "
+    "a tus clientes por WhatsApp 24/7, califican prospectos y agendan reuniones. "
+    "¿Qué volumen de mensajes maneja hoy tu empresa?"
+)
+
+
+@dataclass
+class Upstream:
+    """Comportamiento simulado de un proveedor"""
+    latency: float = 0.0  # Segundos de base
+    jitter: float = 0.0  # Fracción aleatoria extra (0.5 = hasta +50%)
+    error_rate: float = 0.0  # Probabilidad de 500
+    throttle_rate: float = 0.0  # Probabilidad de 429
+
+    async def delay(self, scale: float = 1.0):
+        if self.latency:
+            await asyncio.sleep(self.latency * scale * (1 + random.random() * self.jitter))
+
+    def failure(self) -> Optional[Response]:
+        roll = random.random()
+        if roll < self.throttle_rate:
+            return JSONResponse(
+                {"error": {"message": "rate limited", "code": 130429}},
+                status_code=429,
+                headers={"retry-after": "0.2"},
+            )
+        if roll < self.throttle_rate + self.error_rate:
+            return JSONResponse({"error": {"message": "fake upstream error"}}, status_code=500)
+        return None
+
+
+class VoiceNotes:
+    """
+    Audio por media_id. El media_id termina en un id de contenido
+    (`media<mensaje>-<contenido>`): contenidos distintos dan bytes distintos y
+    un reenvío repite el contenido de otra nota con otro media_id, como en
+    WhatsApp. Sin ffmpeg son bytes opacos servidos como MP3 (sin transcodificar).
+    """
+
+    def __init__(self):
+        self.ffmpeg = shutil.which("ffmpeg") is not None
+        self.mime = "audio/ogg; codecs=opus" if self.ffmpeg else "audio/mpeg"
+        self._notes: Dict[str, asyncio.Task] = {}
+
+    @staticmethod
+    def media_id(message_id: str, content: str) -> str:
+        return f"media{message_id[-8:]}-{content}"
+
+    async def get(self, media_id: str) -> bytes:
+        content = media_id.rpartition("-")[2]
+        note = self._notes.get(content)
+        if note is None:
+            note = self._notes[content] = asyncio.ensure_future(self._generate())
+        return await note
+
+    async def _generate(self) -> bytes:
+        if not self.ffmpeg:
+            return os.urandom(24000)
+        # El muxer OGG usa un número de serie aleatorio: cada nota es única
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-loglevel", "error", "-f", "lavfi", "-i",
+            f"sine=frequency={random.randint(200, 800)}:duration=6",
+            "-c:a", "libopus", "-b:a", "24k", "-f", "ogg", "pipe:1",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+        data, _ = await process.communicate()
+        return data
+
+
+@dataclass
+class Recorder:
+    """Mensajes enviados por el bot, por teléfono destino (thread-safe)"""
+    sends: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    counts: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def send(self, phone: str):
+        with self._lock:
+            self.sends[phone].append(time.perf_counter())
+            self.counts["send"] += 1
+
+    def count(self, name: str):
+        with self._lock:
+            self.counts[name] += 1
+
+
+def build_app(
+    recorder: Recorder,
+    graph: Upstream,
+    chat: Upstream,
+    whisper: Upstream,
+    audio: VoiceNotes,
+    stream_chunks: int = 8,
+) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/v21.0/{phone_id}/messages")
+    async def messages(phone_id: str, request: Request):
+        payload = orjson.loads(await request.body())
+        await graph.delay()
+        failure = graph.failure()
+        if failure:
+            recorder.count("graph_error")
+            return failure
+        if payload.get("status") == "read":
+            recorder.count("read")
+            return {"success": True}
+        recorder.send(payload.get("to", ""))
+        return {"messages": [{"id": f"wamid.fake{random.getrandbits(48):x}"}]}
+
+    @app.get("/v21.0/{media_id}")
+    async def media_url(media_id: str, request: Request):
+        await graph.delay()
+        return {"url": f"{request.base_url}media/{media_id}", "mime_type": "audio/ogg"}
+
+    @app.get("/media/{media_id}")
+    async def media(media_id: str):
+        await graph.delay()
+        recorder.count("media")
+        return Response(await audio.get(media_id), media_type="audio/ogg")
+
+    @app.get("/openai/v1/models")
+    async def models():
+        await chat.delay(0.1)
+        return {"object": "list", "data": [{"id": "llama-3.3-70b-versatile", "object": "model", "created": 0, "owned_by": "fake"}]}
+
+    @app.post("/openai/v1/chat/completions")
+    async def completions(request: Request):
+        body = orjson.loads(await request.body())
+        model = body.get("model", "fake")
+        failure = chat.failure()
+        if failure:
+            await chat.delay(0.2)
+            recorder.count("chat_error")
+            return failure
+        recorder.count("chat")
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await chat.delay()
+            return {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": FAKE_REPLY},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 60, "total_tokens": 160},
+            }
+
+        async def events():
+            # Primer token tras ~1/3 de la latencia, el resto repartido
+            await chat.delay(1 / 3)
+            words = FAKE_REPLY.split(" ")
+            size = max(1, len(words) // stream_chunks)
+            for i in range(0, len(words), size):
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [{
+                        "index": 0,
+                        "delta": {"content": " ".join(words[i:i + size]) + " "},
+                        "finish_reason": None,
+                    }],
+                }
+                yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+                await chat.delay(2 / 3 / stream_chunks)
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/openai/v1/audio/transcriptions")
+    async def transcriptions(request: Request):
+        await request.body()
+        await whisper.delay()
+        failure = whisper.failure()
+        if failure:
+            recorder.count("whisper_error")
+            return failure
+        recorder.count("whisper")
+        return {"text": "Hola, quisiera saber cuánto cuesta un agente para mi empresa"}
+
+    return app
+
+
+class FakeServers:
+    """Corre los fakes en un hilo aparte (su propio event loop)"""
+
+    def __init__(self, app: FastAPI, host: str = "127.0.0.1", port: int = 0):
+        self.server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        sock = self.server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServers":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
@@ -0,0 +1,519 @@
+"""
+Benchmark offline del bot: webhook real contra proveedores falsos
+
+Uso:
+    python -m bench.run --rate 50 --duration 30
+    python -m bench.run --redis-url redis://localhost:6379 --workers 2 --json out.json
+    python -m bench.run --baseline main.json --max-regression 0.15
+
+Levanta `app.main:app` en este proceso (su propio hilo y event loop) apuntando
+a los fakes de `bench.fakes`, dispara webhooks firmados a ritmo fijo (lazo
+abierto: no espera respuestas para seguir enviando) y reporta latencia de ack,
+latencia de punta a punta hasta la primera y la última respuesta, throughput
+y memoria.
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import hmac
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import orjson
+
+from bench.fakes import FakeServers, Recorder, Upstream, VoiceNotes, build_app
+
+PHONE_NUMBER_ID = "100000000000001"
+APP_SECRET = "bench-secret"
+KINDS = ("text", "audio", "batch", "burst", "status")
+QUESTIONS = [
+    "Hola, ¿qué hacen exactamente?",
+    "¿Cuánto cuesta un agente de IA?",
+    "Tengo una clínica y recibimos 300 mensajes al día, ¿me sirve?",
+    "¿Se puede integrar con mi CRM?",
+    "Quiero agendar una reunión para la próxima semana",
+]
+
+
+# ---------------------------------------------------------------- payloads
+
+def webhook(messages: List[dict] = None, statuses: List[dict] = None) -> dict:
+    value = {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "15550000000", "phone_number_id": PHONE_NUMBER_ID},
+    }
+    if messages:
+        value["contacts"] = [{"profile": {"name": "Bench"}, "wa_id": m["from"]} for m in messages]
+        value["messages"] = messages
+    if statuses:
+        value["statuses"] = statuses
+    return {
+        "object": "whatsapp_business_account",
+        "entry": [{"id": "0", "changes": [{"field": "messages", "value": value}]}],
+    }
+
+
+def text_message(phone: str, message_id: str, body: str) -> dict:
+    return {
+        "from": phone, "id": message_id, "timestamp": str(int(time.time())),
+        "type": "text", "text": {"body": body},
+    }
+
+
+def audio_message(phone: str, message_id: str, mime_type: str, content: str) -> dict:
+    media_id = VoiceNotes.media_id(message_id, content)
+    return {
+        "from": phone, "id": message_id, "timestamp": str(int(time.time())),
+        "type": "audio", "audio": {"id": media_id, "mime_type": mime_type, "voice": True},
+    }
+
+
+def sign(raw: bytes) -> str:
+    return "sha256=" + hmac.new(APP_SECRET.encode(), raw, hashlib.sha256).hexdigest()
+
+
+# ---------------------------------------------------------------- stats
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentil por rango más cercano (en ms)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index] * 1000, 1)
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50),
+        "p90_ms": percentile(values, 90),
+        "p99_ms": percentile(values, 99),
+        "max_ms": round(max(values) * 1000, 1) if values else None,
+    }
+
+
+def rss_kb(pid: str = "self", field_name: str = "VmHWM") -> Optional[int]:
+    """Memoria residente (pico por defecto) de un proceso, en KB"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(field_name + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+@dataclass
+class Load:
+    """Lo que envió el generador"""
+    posted: Dict[str, List[float]] = field(default_factory=lambda: defaultdict(list))
+    acks: List[float] = field(default_factory=list)
+    statuses: Dict[int, int] = field(default_factory=lambda: defaultdict(int))
+    kinds: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    retries: int = 0
+    audio: Dict[str, bool] = field(default_factory=dict)  # Teléfono -> la nota es un reenvío
+
+
+# ---------------------------------------------------------------- app
+
+def configure_env(args, fakes_url: str):
+    """Variables de entorno para la app (antes de importarla: los servicios leen Settings al importar)"""
+    env = {
+        "WHATSAPP_TOKEN": "bench-token",
+        "WHATSAPP_PHONE_NUMBER_ID": PHONE_NUMBER_ID,
+        "WHATSAPP_APP_SECRET": APP_SECRET,
+        "WHATSAPP_API_URL": f"{fakes_url}/v21.0",
+        "GROQ_API_KEY": "bench-key",
+        "GROQ_BASE_URL": fakes_url,
+        "LOG_LEVEL": args.log_level,
+        "LOG_FORMAT": "text",
+        "WORKER_METRICS_PORT": "0",
+        "QUEUE_ENABLED": "true" if args.workers else "false",
+    }
+    if args.redis_url:
+        env["REDIS_URL"] = args.redis_url
+    for item in args.set:
+        key, _, value = item.partition("=")
+        env[key.upper()] = value
+    os.environ.update(env)
+    return env
+
+
+def use_fake_redis():
+    """Todos los servicios comparten un servidor fakeredis en memoria"""
+    try:
+        import fakeredis
+    except ImportError:
+        sys.exit("Sin --redis-url hace falta fakeredis (y lupa para los scripts Lua): pip install fakeredis lupa")
+
+    # Importar el paquete carga todos los servicios, que ya tienen su referencia a create_redis
+    import app.services.redis_service as redis_service
+    original = redis_service.create_redis
+    server = fakeredis.FakeServer()
+
+    def create_fake(decode_responses: bool = True):
+        return fakeredis.aioredis.FakeRedis(server=server, decode_responses=decode_responses)
+
+    for name, module in list(sys.modules.items()):
+        if name.startswith("app.") and getattr(module, "create_redis", None) is original:
+            module.create_redis = create_fake
+
+
+class AppServer:
+    """app.main:app con uvicorn en un hilo aparte"""
+
+    def __init__(self):
+        import uvicorn
+        from app.main import app
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning"))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "AppServer":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+# ---------------------------------------------------------------- load
+
+class Generator:
+    def __init__(self, args, url: str, audio_mime: str):
+        self.args = args
+        self.url = f"{url}/webhook"
+        self.audio_mime = audio_mime
+        self.run_id = uuid.uuid4().hex[:6]
+        self.prefix = f"57{random.randint(300, 399)}"
+        self.counter = 0
+        self.contents: List[str] = []  # Notas de voz ya enviadas (para reenviarlas)
+        self.load = Load()
+        self.mix = self._parse_mix(args.mix)
+
+    @staticmethod
+    def _parse_mix(value: str) -> Tuple[List[str], List[float]]:
+        weights = {}
+        for item in value.split(","):
+            kind, _, weight = item.partition("=")
+            if kind.strip() not in KINDS:
+                raise SystemExit(f"Tipo desconocido en --mix: {kind} (válidos: {', '.join(KINDS)})")
+            weights[kind.strip()] = float(weight)
+        return list(weights), list(weights.values())
+
+    def _next(self) -> Tuple[str, str]:
+        self.counter += 1
+        return f"{self.prefix}{self.counter:07d}", f"wamid.bench.{self.run_id}.{self.counter}"
+
+    def _build(self, kind: str) -> List[Tuple[dict, List[str], float]]:
+        """Webhooks a enviar: (cuerpo, teléfonos que esperan respuesta, retraso)"""
+        if kind == "status":
+            phone, message_id = self._next()
+            status = {"id": message_id, "status": "delivered", "timestamp": str(int(time.time())), "recipient_id": phone}
+            return [(webhook(statuses=[status]), [], 0.0)]
+        if kind == "audio":
+            phone, message_id = self._next()
+            # Reenvío: el mismo audio que otra nota (lo sirve la caché de transcripciones)
+            repeat = bool(self.contents) and random.random() < self.args.audio_repeat
+            content = random.choice(self.contents) if repeat else str(self.counter)
+            if not repeat:
+                self.contents.append(content)
+            self.load.audio[phone] = repeat
+            return [(webhook([audio_message(phone, message_id, self.audio_mime, content)]), [phone], 0.0)]
+        if kind == "batch":
+            # Meta agrupa varios mensajes de distintos usuarios en un webhook
+            messages = []
+            for _ in range(random.randint(2, 4)):
+                phone, message_id = self._next()
+                messages.append(text_message(phone, message_id, random.choice(QUESTIONS)))
+            return [(webhook(messages), [m["from"] for m in messages], 0.0)]
+        if kind == "burst":
+            # Un usuario que escribe en varios mensajes seguidos (coalescing)
+            phone, _ = self._next()
+            posts = []
+            for i in range(3):
+                _, message_id = self._next()
+                posts.append((webhook([text_message(phone, message_id, random.choice(QUESTIONS))]), [phone], i * 0.3))
+            return posts
+        phone, message_id = self._next()
+        return [(webhook([text_message(phone, message_id, random.choice(QUESTIONS))]), [phone], 0.0)]
+
+    async def _post(self, client: httpx.AsyncClient, body: dict, phones: List[str], delay: float, retry: bool = False):
+        if delay:
+            await asyncio.sleep(delay)
+        raw = orjson.dumps(body)
+        started = time.perf_counter()
+        try:
+            response = await client.post(
+                self.url, content=raw,
+                headers={"Content-Type": "application/json", "X-Hub-Signature-256": sign(raw)},
+            )
+            status = response.status_code
+        except httpx.HTTPError:
+            status = 0
+        finished = time.perf_counter()
+
+        self.load.acks.append(finished - started)
+        self.load.statuses[status] += 1
+        if retry:
+            self.load.retries += 1
+            return
+        for phone in phones:
+            self.load.posted[phone].append(started)
+
+        # Meta reintenta si no recibió el 200 a tiempo: el mismo message_id otra vez
+        if phones and random.random() < self.args.retry_rate:
+            await self._post(client, body, phones, random.uniform(0.5, 2.0), retry=True)
+
+    async def run(self):
+        interval = 1 / self.args.rate
+        total = int(self.args.rate * self.args.duration)
+        kinds, weights = self.mix
+        tasks = []
+        limits = httpx.Limits(max_connections=self.args.connections, max_keepalive_connections=self.args.connections)
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            start = time.perf_counter()
+            for i in range(total):
+                # Lazo abierto: cada envío sale a su hora aunque los anteriores no hayan vuelto
+                await asyncio.sleep(max(0.0, start + i * interval - time.perf_counter()))
+                kind = random.choices(kinds, weights)[0]
+                self.load.kinds[kind] += 1
+                for body, phones, delay in self._build(kind):
+                    tasks.append(asyncio.create_task(self._post(client, body, phones, delay)))
+            await asyncio.gather(*tasks)
+
+
+# ---------------------------------------------------------------- report
+
+def end_to_end(load: Load, recorder: Recorder, phones=None) -> Tuple[List[float], List[float], int]:
+    """Por mensaje: hasta la primera y hasta la última respuesta enviada a ese teléfono"""
+    first, last, missing = [], [], 0
+    for phone, posts in load.posted.items():
+        if phones is not None and phone not in phones:
+            continue
+        sends = sorted(recorder.sends.get(phone, []))
+        for posted in posts:
+            index = bisect.bisect_right(sends, posted)
+            if index == len(sends):
+                missing += 1
+                continue
+            first.append(sends[index] - posted)
+            last.append(sends[-1] - posted)
+    return first, last, missing
+
+
+def wait_for_replies(load: Load, recorder: Recorder, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if all(recorder.sends.get(phone) for phone in load.posted):
+            # Un respiro para las partes restantes de respuestas en streaming
+            time.sleep(min(1.0, max(0.0, deadline - time.perf_counter())))
+            return
+        time.sleep(0.1)
+
+
+def transcription_lookups() -> Optional[Dict[str, int]]:
+    """Resultados de la caché de transcripciones (solo sin workers: la app corre en este proceso)"""
+    from prometheus_client import REGISTRY
+    lookups = {}
+    for metric in REGISTRY.collect():
+        if metric.name != "loopera_cache_lookups":
+            continue
+        for sample in metric.samples:
+            if sample.name.endswith("_total") and sample.labels.get("cache") == "transcription":
+                lookups[sample.labels["result"]] = int(sample.value)
+    return lookups
+
+
+def audio_report(args, load: Load, recorder: Recorder) -> dict:
+    """Notas nuevas y reenviadas por separado: un reenvío no llega a Whisper"""
+    report = {
+        "notes": len(load.audio),
+        "repeats": sum(load.audio.values()),
+        "whisper_calls": recorder.counts.get("whisper", 0),
+    }
+    for name, repeat in (("new", False), ("repeat", True)):
+        first, _, _ = end_to_end(load, recorder, {phone for phone, r in load.audio.items() if r is repeat})
+        report[f"e2e_first_reply_{name}"] = summarize(first)
+    if not args.workers:
+        lookups = transcription_lookups()
+        report["cache_lookups"] = lookups
+        report["cache_hits"] = sum(v for k, v in lookups.items() if k.endswith("_hit"))
+    return report
+
+
+def build_report(args, load: Load, recorder: Recorder, elapsed: float, worker_pids: List[int]) -> dict:
+    first, last, missing = end_to_end(load, recorder)
+    return {
+        "config": {
+            "rate": args.rate, "duration": args.duration, "mix": args.mix,
+            "retry_rate": args.retry_rate, "audio_repeat": args.audio_repeat, "workers": args.workers,
+            "graph_latency": args.graph_latency, "chat_latency": args.chat_latency,
+            "whisper_latency": args.whisper_latency, "error_rate": args.error_rate,
+            "overrides": args.set,
+        },
+        "webhooks": {"kinds": dict(load.kinds), "status_codes": dict(load.statuses), "retries": load.retries},
+        "ack": summarize(load.acks),
+        "e2e_first_reply": summarize(first),
+        "e2e_last_reply": summarize(last),
+        "throughput": {
+            "messages": sum(len(p) for p in load.posted.values()),
+            "replied": len(first),
+            "missing_replies": missing,
+            "replies_per_second": round(len(first) / elapsed, 2) if elapsed else None,
+        },
+        "audio": audio_report(args, load, recorder),
+        "upstream": dict(recorder.counts),
+        "memory_kb": {
+            "bench_process_peak": rss_kb(),
+            "bench_process_maxrss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "workers_peak": [rss_kb(str(pid)) for pid in worker_pids],
+        },
+    }
+
+
+def print_report(report: dict):
+    def row(name: str, stats: dict):
+        print(f"  {name:<18} n={stats['count']:<6} p50={stats['p50_ms']} ms  p90={stats['p90_ms']} ms  "
+              f"p99={stats['p99_ms']} ms  max={stats['max_ms']} ms")
+
+    print("\n📊 Resultado")
+    print(f"  webhooks           {report['webhooks']}")
+    row("ack", report["ack"])
+    row("e2e primera resp.", report["e2e_first_reply"])
+    row("e2e última resp.", report["e2e_last_reply"])
+    print(f"  throughput         {report['throughput']}")
+    audio = report["audio"]
+    print(f"  audio              notas={audio['notes']} reenvios={audio['repeats']} "
+          f"whisper={audio['whisper_calls']} hits={audio.get('cache_hits', 'n/d')}")
+    row("  audio nuevo", audio["e2e_first_reply_new"])
+    row("  audio reenviado", audio["e2e_first_reply_repeat"])
+    print(f"  upstream           {report['upstream']}")
+    print(f"  memoria (KB)       {report['memory_kb']}")
+
+
+def compare(report: dict, baseline_path: str, max_regression: float) -> List[str]:
+    """Regresiones de p99 o throughput frente a un resultado anterior"""
+    with open(baseline_path, "rb") as f:
+        baseline = orjson.loads(f.read())
+    problems = []
+    for section in ("ack", "e2e_first_reply", "e2e_last_reply"):
+        old, new = baseline[section]["p99_ms"], report[section]["p99_ms"]
+        if old and new and new > old * (1 + max_regression):
+            problems.append(f"{section} p99: {old} -> {new} ms")
+    old, new = baseline["throughput"]["replies_per_second"], report["throughput"]["replies_per_second"]
+    if old and new is not None and new < old * (1 - max_regression):
+        problems.append(f"throughput: {old} -> {new} resp/s")
+    return problems
+
+
+# ---------------------------------------------------------------- main
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline del bot de WhatsApp")
+    parser.add_argument("--rate", type=float, default=20, help="Eventos por segundo")
+    parser.add_argument("--duration", type=float, default=20, help="Segundos de carga")
+    parser.add_argument("--mix", default="text=0.6,audio=0.15,batch=0.1,burst=0.05,status=0.1",
+                        help=f"Pesos por tipo ({', '.join(KINDS)})")
+    parser.add_argument("--retry-rate", type=float, default=0.05, help="Fracción de webhooks que Meta reenvía")
+    parser.add_argument("--audio-repeat", type=float, default=0.0,
+                        help="Fracción de notas de voz que repiten el audio de otra (reenvíos, pegan en la caché)")
+    parser.add_argument("--connections", type=int, default=200, help="Conexiones del generador")
+    parser.add_argument("--drain", type=float, default=30, help="Segundos máximos esperando respuestas")
+    parser.add_argument("--graph-latency", type=float, default=0.08)
+    parser.add_argument("--chat-latency", type=float, default=0.6, help="Latencia total de una respuesta del LLM")
+    parser.add_argument("--whisper-latency", type=float, default=0.4)
+    parser.add_argument("--jitter", type=float, default=0.5, help="Latencia extra aleatoria (fracción)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Probabilidad de 500 en cada proveedor")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probabilidad de 429 en cada proveedor")
+    parser.add_argument("--redis-url", default="", help="Redis real; si no se indica se usa fakeredis")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Workers (python -m app.worker) con cola; requiere --redis-url")
+    parser.add_argument("--set", action="append", default=[], metavar="CLAVE=VALOR",
+                        help="Sobrescribir un setting de la app (ej. COALESCE_WINDOW_MS=0)")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", help="Guardar el resultado en este archivo")
+    parser.add_argument("--baseline", help="Resultado anterior (JSON) para detectar regresiones")
+    parser.add_argument("--max-regression", type=float, default=0.15)
+    args = parser.parse_args(argv)
+    if args.workers and not args.redis_url:
+        parser.error("--workers necesita --redis-url (fakeredis no se comparte entre procesos)")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    notes = VoiceNotes()
+
+    def upstream(latency: float) -> Upstream:
+        return Upstream(latency, args.jitter, args.error_rate, args.throttle_rate)
+
+    recorder = Recorder()
+    fakes = FakeServers(build_app(
+        recorder, upstream(args.graph_latency), upstream(args.chat_latency), upstream(args.whisper_latency), notes
+    )).start()
+    env = configure_env(args, fakes.url)
+
+    if not args.redis_url:
+        use_fake_redis()
+    server = AppServer().start()
+
+    workers = [
+        subprocess.Popen([sys.executable, "-m", "app.worker"], env={**os.environ, **env})
+        for _ in range(args.workers)
+    ]
+
+    print(f"🏁 {args.rate} eventos/s durante {args.duration}s contra {server.url} (fakes en {fakes.url})")
+    generator = Generator(args, server.url, notes.mime)
+    started = time.perf_counter()
+    try:
+        asyncio.run(generator.run())
+        wait_for_replies(generator.load, recorder, args.drain)
+        # Throughput hasta la última respuesta, sin contar la espera final
+        last_send = max((max(sends) for sends in recorder.sends.values() if sends), default=started)
+        report = build_report(args, generator.load, recorder, last_send - started, [w.pid for w in workers])
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait(timeout=15)
+        server.stop()
+        fakes.stop()
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+
+    if args.baseline:
+        problems = compare(report, args.baseline, args.max_regression)
+        if problems:
+            print("\n❌ Regresiones frente a la línea base:")
+            for problem in problems:
+                print(f"  - {problem}")
+            sys.exit(1)
+        print("\n✅ Sin regresiones frente a la línea base")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Benchmark del formato de sesiones: bytes por sesión y costo de codificar/decodificar
+
+Compara el formato JSON anterior (v1, timestamps ISO) con el compacto (v2,
+msgpack + roles como entero + epoch), con y sin compresión de mensajes largos.
+Con --redis-url mide además la memoria real en Redis (MEMORY USAGE).
+
+Uso: python -m bench.sessions --messages 40 --sessions 2000
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from datetime import datetime
+from typing import Callable, Dict, List
+
+import orjson
+
+from app.services.history_service import history_entry
+from app.services.session_codec import decode_message, encode_message
+
+USER_TEXTS = [
+    "Hola",
+    "¿Cuánto cuesta un agente para mi empresa?",
+    "Tenemos unos 300 mensajes diarios por WhatsApp, sobre todo consultas de precios y horarios",
+    "¿Se puede integrar con nuestro CRM y con Google Calendar para agendar reuniones?",
+    "Perfecto, gracias",
+]
+BOT_TEXTS = [
+    "¡Hola! Soy el asistente de Loopera. ¿En qué te puedo ayudar?",
+    "Depende del volumen y de las integraciones. ¿Qué volumen de mensajes manejan hoy?",
+    "Con ese volumen un agente puede resolver la mayoría de las consultas de precios y horarios "
+    "sin intervención humana, y derivar al equipo los casos complejos. También califica prospectos, "
+    "agenda reuniones y deja todo registrado en tu CRM. ¿Te gustaría que agendemos una demo de 20 "
+    "minutos para mostrarte cómo quedaría con tus propios datos y flujos de atención?",
+    "Sí, tenemos integraciones con los CRM más usados y con Google Calendar. ¿Cuál usan ustedes?",
+]
+
+
+def build_history(messages: int, rng: random.Random) -> List[dict]:
+    history = []
+    for i in range(messages):
+        texts = USER_TEXTS if i % 2 == 0 else BOT_TEXTS
+        history.append(history_entry("user" if i % 2 == 0 else "assistant", rng.choice(texts)))
+    return history
+
+
+def v1_encode(history: List[dict]) -> Dict[str, bytes]:
+    now = datetime.utcnow().isoformat()
+    return {
+        "items": [json.dumps(message).encode() for message in history],
+        "meta": {"created_at": now.encode(), "updated_at": now.encode()},
+    }
+
+
+def v2_encoder(compress_min_bytes: int) -> Callable[[List[dict]], Dict[str, bytes]]:
+    def encode(history: List[dict]) -> Dict[str, bytes]:
+        now = str(int(time.time())).encode()
+        return {
+            "items": [encode_message(message, compress_min_bytes) for message in history],
+            "meta": {"created_at": now, "updated_at": now},
+        }
+    return encode
+
+
+def size_of(encoded: Dict[str, bytes]) -> int:
+    items = sum(len(item) for item in encoded["items"])
+    meta = sum(len(key) + len(value) for key, value in encoded["meta"].items())
+    return items + meta
+
+
+def time_per_session(fn: Callable, sessions: list) -> float:
+    """Microsegundos por sesión"""
+    started = time.perf_counter()
+    for session in sessions:
+        fn(session)
+    return (time.perf_counter() - started) / len(sessions) * 1e6
+
+
+async def redis_usage(url: str, name: str, encoded: List[Dict[str, bytes]]) -> float:
+    """Bytes promedio en Redis (lista + hash) por sesión"""
+    import redis.asyncio as redis
+
+    client = redis.Redis.from_url(url)
+    total = 0
+    try:
+        for i, session in enumerate(encoded):
+            history_key, meta_key = f"bench:{name}:{i}:history", f"bench:{name}:{i}:meta"
+            pipe = client.pipeline(transaction=False)
+            pipe.rpush(history_key, *session["items"])
+            pipe.hset(meta_key, mapping=session["meta"])
+            pipe.memory_usage(history_key, samples=0)
+            pipe.memory_usage(meta_key, samples=0)
+            pipe.delete(history_key, meta_key)
+            *_, history_bytes, meta_bytes, _ = await pipe.execute()
+            total += (history_bytes or 0) + (meta_bytes or 0)
+    finally:
+        await client.aclose()
+    return total / len(encoded)
+
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    histories = [build_history(args.messages, rng) for _ in range(args.sessions)]
+    formats = {
+        "v1_json": v1_encode,
+        "v2_msgpack": v2_encoder(0),
+        f"v2_zlib_{args.compress_min_bytes}": v2_encoder(args.compress_min_bytes),
+    }
+
+    report = {"messages_per_session": args.messages, "sessions": args.sessions, "formats": {}}
+    for name, encode in formats.items():
+        encoded = [encode(history) for history in histories]
+        items = [session["items"] for session in encoded]
+        result = {
+            "bytes_per_session": round(sum(size_of(session) for session in encoded) / len(encoded), 1),
+            "encode_us": round(time_per_session(encode, histories), 1),
+            "decode_us": round(time_per_session(
+                (lambda raw: [json.loads(item) for item in raw]) if name == "v1_json"
+                else (lambda raw: [decode_message(item) for item in raw]),
+                items
+            ), 1),
+        }
+        if args.redis_url:
+            result["redis_bytes_per_session"] = round(asyncio.run(redis_usage(args.redis_url, name, encoded)), 1)
+        report["formats"][name] = result
+
+    base = report["formats"]["v1_json"]["bytes_per_session"]
+    for result in report["formats"].values():
+        result["vs_v1"] = round(result["bytes_per_session"] / base, 3)
+    return report
+
+
+def print_report(report: dict):
+    print(f"\n📊 Sesiones de {report['messages_per_session']} mensajes ({report['sessions']} muestras)")
+    for name, result in report["formats"].items():
+        redis_part = f"  redis={result['redis_bytes_per_session']} B" if "redis_bytes_per_session" in result else ""
+        print(
+            f"  {name:<14} {result['bytes_per_session']:>9} B/sesión ({result['vs_v1']:.0%})  "
+            f"encode={result['encode_us']} µs  decode={result['decode_us']} µs{redis_part}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del formato de sesiones")
+    parser.add_argument("--messages", type=int, default=40, help="Mensajes por sesión")
+    parser.add_argument("--sessions", type=int, default=2000, help="Sesiones a medir")
+    parser.add_argument("--compress-min-bytes", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--redis-url", default="", help="Medir también MEMORY USAGE en este Redis")
+    parser.add_argument("--json", help="Guardar el resultado en este archivo")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "wb") as f:
+            f.write(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Configuración común de los tests: Settings por entorno (antes de importar la
+app, los servicios leen Settings al importar) y Redis en memoria con fakeredis
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+os.environ.update({
+    "WHATSAPP_TOKEN": "test-token",
+    "WHATSAPP_PHONE_NUMBER_ID": "100000000000001",
+    "WHATSAPP_API_URL": "http://127.0.0.1:9/v21.0",
+    "WHATSAPP_APP_SECRET": "",
+    "GROQ_API_KEY": "test-key",
+    "LOG_FORMAT": "text",
+    "LOG_LEVEL": "WARNING",
+    "QUEUE_ENABLED": "false",
+    "STREAM_REPLIES": "false",
+    "TYPING_INDICATOR": "false",
+    "COALESCE_WINDOW_MS": "200",
+    "COALESCE_MAX_WAIT_MS": "1000",
+    "WARMUP_TIMEOUT": "0.5",
+    "WORKER_METRICS_PORT": "0",
+})
+
+import fakeredis  # noqa: E402
+
+import app.services  # noqa: E402,F401
+import app.services.redis_service as redis_service  # noqa: E402
+
+SERVER = fakeredis.FakeServer()
+
+
+def create_fake_redis(decode_responses: bool = True):
+    return fakeredis.aioredis.FakeRedis(server=SERVER, decode_responses=decode_responses)
+
+
+# Los servicios ya tienen su referencia a create_redis: reemplazarla en cada módulo
+_original = redis_service.create_redis
+for _name, _module in list(sys.modules.items()):
+    if _name.startswith("app.") and getattr(_module, "create_redis", None) is _original:
+        _module.create_redis = create_fake_redis
+
+
+@pytest.fixture(autouse=True)
+def flush_redis():
+    """Cada test arranca con Redis vacío"""
+    yield
+    asyncio.run(create_fake_redis().flushall())
+
@@ -0,0 +1,153 @@
+"""
+Control de admisión: orden por prioridad, cupo de audio, aviso de demora
+y descarte bajo sobrecarga
+"""
+import asyncio
+import time
+
+import pytest
+
+from app.services.admission_service import AdmissionController, Overloaded
+
+
+def make_controller(total: int = 1, audio: int = 1, queue_size: int = 10,
+                    busy_after: float = 5.0, max_queue_age: float = 30.0) -> AdmissionController:
+    controller = AdmissionController()
+    controller.budgets = {"total": total, "audio": audio}
+    controller.queue_size = queue_size
+    controller.busy_after = busy_after
+    controller.max_queue_age = max_queue_age
+    return controller
+
+
+async def hold(controller: AdmissionController, name: str, order: list, release: asyncio.Event,
+               message_type: str = "text", returning=False, **kwargs):
+    async with controller.admit(message_type, returning, **kwargs):
+        order.append(name)
+        await release.wait()
+
+
+def test_waiting_messages_go_in_priority_order():
+    async def scenario():
+        controller = make_controller(total=1, audio=1)
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold(controller, "blocker", order, release))
+        await asyncio.sleep(0)
+
+        async def is_active():
+            return True
+
+        waiting = [
+            asyncio.create_task(hold(controller, "new-audio", order, release, "audio")),
+            asyncio.create_task(hold(controller, "new-text", order, release)),
+            asyncio.create_task(hold(controller, "active-audio", order, release, "audio", is_active)),
+            asyncio.create_task(hold(controller, "active-text", order, release, "text", True)),
+        ]
+        await asyncio.sleep(0.01)
+        assert order == ["blocker"] and len(controller._waiters) == 4
+
+        release.set()
+        await asyncio.gather(blocker, *waiting)
+        assert order == ["blocker", "active-text", "active-audio", "new-text", "new-audio"]
+
+    asyncio.run(scenario())
+
+
+def test_returning_lookup_only_runs_when_waiting():
+    async def scenario():
+        controller = make_controller(total=1)
+        calls = []
+
+        async def is_active():
+            calls.append(1)
+            return False
+
+        async with controller.admit("text", is_active):
+            pass
+        assert calls == []
+
+    asyncio.run(scenario())
+
+
+def test_audio_sub_limit_lets_text_through():
+    async def scenario():
+        controller = make_controller(total=3, audio=1)
+        order, release = [], asyncio.Event()
+        tasks = [
+            asyncio.create_task(hold(controller, "audio-1", order, release, "audio")),
+            asyncio.create_task(hold(controller, "audio-2", order, release, "audio")),
+            asyncio.create_task(hold(controller, "text", order, release)),
+        ]
+        await asyncio.sleep(0.01)
+        # El segundo audio espera su cupo; el texto pasa igual
+        assert order == ["audio-1", "text"]
+        assert controller._active == {"total": 2, "audio": 1}
+        release.set()
+        await asyncio.gather(*tasks)
+        assert order[-1] == "audio-2"
+        assert controller._active == {"total": 0, "audio": 0}
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_sheds_the_worst_priority():
+    async def scenario():
+        controller = make_controller(total=1, queue_size=1)
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold(controller, "blocker", order, release))
+        await asyncio.sleep(0)
+        new_audio = asyncio.create_task(hold(controller, "new-audio", order, release, "audio"))
+        await asyncio.sleep(0)
+
+        # Un mensaje de peor o igual prioridad no entra
+        with pytest.raises(Overloaded):
+            await hold(controller, "new-audio-2", order, release, "audio")
+        # Uno mejor desplaza al peor que esperaba
+        active = asyncio.create_task(hold(controller, "active-text", order, release, "text", True))
+        await asyncio.sleep(0.01)
+        with pytest.raises(Overloaded):
+            await new_audio
+
+        release.set()
+        await asyncio.gather(blocker, active)
+        assert order == ["blocker", "active-text"]
+
+    asyncio.run(scenario())
+
+
+def test_busy_reply_then_expiry():
+    async def scenario():
+        controller = make_controller(total=1, busy_after=0.05, max_queue_age=0.2)
+        order, release = [], asyncio.Event()
+        blocker = asyncio.create_task(hold(controller, "blocker", order, release))
+        await asyncio.sleep(0)
+
+        notified = []
+
+        async def on_busy():
+            notified.append(time.time())
+
+        started = time.time()
+        with pytest.raises(Overloaded):
+            await hold(controller, "late", order, release, received_at=started, on_busy=on_busy)
+        assert len(notified) == 1 and notified[0] - started >= 0.05
+        assert time.time() - started >= 0.2
+        assert not controller._waiters
+
+        # Ya venía viejo de la cola de Redis: se descarta sin esperar
+        with pytest.raises(Overloaded):
+            await hold(controller, "old", order, release, received_at=time.time() - 1)
+
+        release.set()
+        await blocker
+        assert order == ["blocker"]
+
+    asyncio.run(scenario())
+
+
+def test_one_busy_notice_per_conversation():
+    controller = make_controller()
+    controller.busy_cooldown = 60
+    assert controller.should_notify("573001")
+    assert not controller.should_notify("573001")
+    assert controller.should_notify("573002")
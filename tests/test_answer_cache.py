@@ -0,0 +1,54 @@
+"""
+Caché de respuestas: casi-duplicados sin cambiar el sentido de la pregunta
+"""
+import asyncio
+
+from app.services.answer_cache_service import AnswerCache
+
+
+def test_near_duplicates_keep_negations_and_numbers():
+    async def scenario():
+        cache = AnswerCache()
+        await cache.connect()
+        await cache.store("Quiero agendar una demo", "¡Agendemos!", "v1")
+        await cache.store("¿Cuánto cuesta para 300 mensajes al día?", "Desde $99", "v1")
+
+        assert await cache.lookup("quiero agendar una demo!!", "v1") == "¡Agendemos!"
+        assert await cache.lookup("Quiero agendar la demo", "v1") == "¡Agendemos!"
+        assert await cache.lookup("No quiero agendar una demo", "v1") is None
+        assert await cache.lookup("¿Cuánto cuesta para 3000 mensajes al día?", "v1") is None
+        assert await cache.lookup("Cuanto cuesta para 300 mensajes al dia", "v1") == "Desde $99"
+        await cache.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_personal_answers_never_reach_another_user():
+    async def scenario():
+        cache = AnswerCache()
+        await cache.connect()
+
+        # Usuario A: se presenta, da su correo o recibe una respuesta con su nombre
+        assert not cache.eligible("Hola, soy Ana, ¿cuánto cuesta?", [])
+        assert not cache.eligible("Me llamo Ana, ¿cuánto cuesta?", [])
+        assert not cache.eligible("¿Cuánto cuesta? mi correo es ana@clinica.co", [])
+        assert not cache.eligible("¿Cuánto cuesta? llámame al 300 111 2233", [])
+        # Respuestas del modelo chico tampoco se comparten
+        assert not cache.eligible("¿Cuánto cuesta?", [], tier="small")
+        assert cache.eligible("¿Cuánto cuesta?", [])
+
+        await cache.store("Hola, soy Ana, ¿cuánto cuesta?", "¡Hola Ana! Desde $99", "v1")
+        await cache.store("¿Cuánto cuesta?", "¡Hola Ana! Desde $99", "v1")
+        await cache.store("¿Tienen demo?", "Sí, te escribo al 3001112233", "v1")
+
+        # Usuario B pregunta lo mismo: no recibe nada de A
+        assert await cache.lookup("¿Cuánto cuesta?", "v1") is None
+        assert await cache.lookup("hola ¿cuánto cuesta?", "v1") is None
+        assert await cache.lookup("¿Tienen demo?", "v1") is None
+
+        # Una respuesta genérica sí se comparte (los precios no son cifras personales)
+        await cache.store("¿Cuánto cuesta?", "Desde $1.500.000 al año", "v1")
+        assert await cache.lookup("¿Cuánto cuesta?", "v1") == "Desde $1.500.000 al año"
+        await cache.disconnect()
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+"""
+Notas de voz: lectura del stderr de ffmpeg, plan de cortes y ffmpeg que no
+queda vivo al cancelar
+"""
+import asyncio
+import sys
+
+import pytest
+
+from app.services.audio_service import AudioTranscoder, parse_ffmpeg_stats, plan_chunks
+
+STDERR = b"""
+[silencedetect @ 0x1] silence_start: 12.2
+[silencedetect @ 0x1] silence_end: 12.8 | silence_duration: 0.6
+[silencedetect @ 0x1] silence_start: 54.2
+[silencedetect @ 0x1] silence_end: 54.8 | silence_duration: 0.6
+size=     120kB time=00:00:30.00 bitrate=  32.8kbits/s speed=90x
+size=     190kB time=00:01:35.80 bitrate=  16.2kbits/s speed=91x
+"""
+
+
+def test_parse_ffmpeg_stats():
+    seconds, pauses = parse_ffmpeg_stats(STDERR)
+    assert seconds == 95.8
+    assert pauses == [12.5, 54.5]
+    assert parse_ffmpeg_stats(b"") == (None, [])
+
+
+def test_short_audio_is_one_chunk():
+    assert plan_chunks(45, [], chunk_seconds=60, max_chunks=8) == [(0.0, None)]
+    assert plan_chunks(600, [], chunk_seconds=0, max_chunks=8) == [(0.0, None)]
+
+
+def test_cuts_on_the_last_pause_in_the_second_half():
+    # 12.5 está en la primera mitad: se corta en 54.5 aunque no llegue a 60
+    assert plan_chunks(95.8, [12.5, 54.5], chunk_seconds=60, max_chunks=8) == [(0.0, 54.5), (54.5, None)]
+
+
+def test_cuts_hard_without_pauses():
+    assert plan_chunks(150, [], chunk_seconds=60, max_chunks=8) == [(0.0, 60), (60, 120), (120, None)]
+
+
+def test_long_audio_is_capped_at_max_chunks():
+    chunks = plan_chunks(1000, [], chunk_seconds=60, max_chunks=4)
+    assert len(chunks) == 4
+    assert chunks[0] == (0.0, 250) and chunks[-1] == (750, None)
+
+
+def test_cancelled_ffmpeg_is_killed_and_reaped(monkeypatch):
+    spawned = []
+    create = asyncio.create_subprocess_exec
+
+    async def spawn(*args, **kwargs):
+        process = await create(*args, **kwargs)
+        spawned.append(process)
+        return process
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", spawn)
+    transcoder = AudioTranscoder()
+    slow = [sys.executable, "-c", "import time; time.sleep(30)"]
+
+    async def scenario():
+        task = asyncio.create_task(transcoder._run(slow, b"", "transcode"))
+        while not spawned:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert spawned[0].returncode is not None  # Muerto y esperado
+
+        # Por timeout, igual
+        transcoder.settings = transcoder.settings.model_copy(update={"audio_ffmpeg_timeout": 0.1})
+        with pytest.raises(asyncio.TimeoutError):
+            await transcoder._run(slow, b"", "transcode")
+        assert spawned[1].returncode is not None
+
+    asyncio.run(scenario())
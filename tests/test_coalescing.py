@@ -0,0 +1,144 @@
+"""
+Agrupación de mensajes seguidos: un turno, una llamada al LLM, y los
+mensajes agrupados se confirman en la cola recién después de responder
+"""
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+from app.services import groq_service, message_coalescer, whatsapp_service
+from app.pipeline import PhoneChain
+from app.services.coalesce_service import MessageCoalescer
+
+PHONE = "573001112233"
+
+
+def webhook_body(*texts: str) -> dict:
+    messages = [
+        {"from": PHONE, "id": f"wamid.{time.time_ns()}.{i}", "type": "text", "text": {"body": text}}
+        for i, text in enumerate(texts)
+    ]
+    return {"entry": [{"changes": [{"value": {
+        "metadata": {"phone_number_id": "100000000000001"},
+        "messages": messages,
+    }}]}]}
+
+
+@pytest.fixture
+def fake_upstream(monkeypatch):
+    """LLM y envíos de WhatsApp en memoria"""
+    calls = {"chat": [], "sent": []}
+
+    async def chat(user_message, **kwargs):
+        calls["chat"].append(user_message)
+        await asyncio.sleep(0.05)
+        return "Con gusto te cuento cómo funciona."
+
+    async def send_text_message(phone, text, tenant=None):
+        calls["sent"].append(text)
+        return True
+
+    async def noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(groq_service, "chat", chat)
+    monkeypatch.setattr(groq_service, "warm_up", noop)
+    monkeypatch.setattr(whatsapp_service, "send_text_message", send_text_message)
+    monkeypatch.setattr(whatsapp_service, "mark_as_read", noop)
+    monkeypatch.setattr(whatsapp_service, "warm_up", noop)
+    return calls
+
+
+def test_batched_webhook_is_one_turn(fake_upstream):
+    texts = ["Tengo una empresa de logística", "¿Cuánto cuesta un agente?", "Manejamos 300 mensajes al día"]
+    with TestClient(main.app) as client:
+        response = client.post("/webhook", json=webhook_body(*texts))
+        assert response.status_code == 200
+
+        deadline = time.monotonic() + 5
+        while not fake_upstream["sent"] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.3)  # Por si llegara una segunda respuesta
+
+    assert fake_upstream["chat"] == ["\n".join(texts)]
+    assert len(fake_upstream["sent"]) == 1
+
+
+def test_phone_chain_orders_ingestion_per_phone():
+    async def scenario():
+        chain, order = PhoneChain(), []
+
+        def message(name: str, delay: float, fail: bool = False):
+            async def run(ingested: asyncio.Event):
+                order.append(f"{name}:start")
+                await asyncio.sleep(delay)
+                if fail:
+                    raise RuntimeError("sin marcar ingested")
+                order.append(f"{name}:ingested")
+                ingested.set()
+                await asyncio.sleep(0.05)  # Respuesta: ya no frena al siguiente
+                order.append(f"{name}:done")
+            return run
+
+        chain.dispatch("A", message("a1", 0.03, fail=True))
+        chain.dispatch("A", message("a2", 0.01))
+        chain.dispatch("A", message("a3", 0))
+        chain.dispatch("B", message("b1", 0))
+        await asyncio.gather(*chain.tasks, return_exceptions=True)
+
+        # B no espera a A; a2 arranca cuando a1 terminó (aunque falló)
+        assert order.index("b1:start") < order.index("a2:start")
+        assert order.index("a1:start") < order.index("a2:start")
+        # a3 arranca apenas a2 quedó extraído, sin esperar su respuesta
+        assert order.index("a2:ingested") < order.index("a3:start") < order.index("a2:done")
+        assert not chain.tasks and not chain._tails
+
+    asyncio.run(scenario())
+
+
+def test_merged_messages_are_acked_after_reply():
+    coalescer = MessageCoalescer()
+    events = []
+
+    def ack(name):
+        async def confirm():
+            events.append(f"ack:{name}")
+        return confirm
+
+    async def handler(batch):
+        await asyncio.sleep(0.05)
+        events.append("reply")
+
+    async def scenario():
+        batch = coalescer.add("k", "uno", "text", ack=ack("first"))
+        assert coalescer.add("k", "dos", "text", ack=ack("merged")) is None
+        await coalescer.flush(batch, handler)
+
+    asyncio.run(scenario())
+    assert events == ["reply", "ack:first", "ack:merged"]
+
+
+def test_cancelled_turn_is_not_acked():
+    coalescer = MessageCoalescer()
+    acked = []
+
+    async def confirm():
+        acked.append(True)
+
+    async def handler(batch):
+        await asyncio.sleep(10)
+
+    async def scenario():
+        batch = coalescer.add("k", "uno", "text", ack=confirm)
+        coalescer.add("k", "dos", "text", ack=confirm)
+        task = asyncio.ensure_future(coalescer.flush(batch, handler))
+        await asyncio.sleep(coalescer.window + 0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert acked == []
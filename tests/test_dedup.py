@@ -0,0 +1,67 @@
+"""
+Idempotencia del webhook: SET NX por message_id compartido entre procesos,
+LRU local delante de Redis y sin Redis se procesa igual
+"""
+import asyncio
+
+from app.services.dedup_service import MessageDeduplicator
+
+
+async def make_deduplicator(**overrides) -> MessageDeduplicator:
+    dedup = MessageDeduplicator()
+    for name, value in overrides.items():
+        setattr(dedup, name, value)
+    await dedup.connect()
+    return dedup
+
+
+def test_claim_is_shared_between_processes():
+    async def scenario():
+        a, b = await make_deduplicator(ttl=600), await make_deduplicator()
+        assert await a.claim("wamid.1")
+        assert not await a.claim("wamid.1")  # Reintento al mismo proceso (L1)
+        assert not await b.claim("wamid.1")  # Reintento a otro proceso (SET NX)
+        assert 0 < await a.redis.ttl("seen:wamid.1") <= 600
+
+        # Vencido el TTL el id queda libre otra vez
+        await a.redis.delete("seen:wamid.1")
+        later = await make_deduplicator()
+        assert await later.claim("wamid.1")
+        await later.disconnect()
+
+        # Sin id no hay con qué deduplicar
+        assert await a.claim("") and await a.claim(None)
+        await a.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_local_cache_evicts_least_recent():
+    async def scenario():
+        dedup = MessageDeduplicator()
+        dedup._recent_max = 2
+        for message_id in ("m1", "m2"):
+            assert await dedup.claim(message_id)
+        assert not await dedup.claim("m1")  # m1 pasa a ser el más reciente
+        assert await dedup.claim("m3")
+        assert list(dedup._recent) == ["m1", "m3"]
+        # Sin Redis, lo que salió del L1 ya no se reconoce
+        assert await dedup.claim("m2")
+
+    asyncio.run(scenario())
+
+
+def test_redis_down_processes_anyway():
+    async def scenario():
+        dedup = await make_deduplicator()
+        await dedup.redis.aclose()
+
+        async def down(*args, **kwargs):
+            raise ConnectionError("Redis caído")
+
+        dedup.redis.set = down
+        assert await dedup.claim("wamid.2")
+        assert not await dedup.claim("wamid.2")  # El L1 sigue filtrando
+
+    asyncio.run(scenario())
@@ -0,0 +1,38 @@
+"""
+Historial con presupuesto de tokens
+"""
+from app.services.history_service import estimate_tokens, fit_history, history_entry
+
+
+def conversation(turns: int, chars: int = 40) -> list:
+    history = []
+    for n in range(turns):
+        history.append(history_entry("user", f"{n}" * chars))
+        history.append(history_entry("assistant", f"{n}" * chars))
+    return history
+
+
+def test_fit_history_keeps_newest_within_budget():
+    history = conversation(5)  # 14 tokens por mensaje
+    fitted, overflow = fit_history(history, budget=60)
+    assert fitted == history[-4:]
+    assert overflow == history[:-4]
+    assert sum(m["tokens"] for m in fitted) <= 60
+
+
+def test_fit_history_starts_on_a_user_message():
+    history = conversation(5)
+    # Entran 5 mensajes, pero el más viejo es del asistente: se deja afuera
+    fitted, overflow = fit_history(history, budget=5 * 14)
+    assert fitted == history[-4:] and fitted[0]["role"] == "user"
+    assert overflow + fitted == history
+
+
+def test_fit_history_edges():
+    history = conversation(2)
+    assert fit_history(history, budget=10_000) == (history, [])
+    assert fit_history(history, budget=0) == ([], history)
+    assert fit_history([], budget=100) == ([], [])
+    # Mensajes del formato anterior, sin conteo guardado
+    legacy = [{"role": "user", "content": "x" * 40}]
+    assert fit_history(legacy, budget=estimate_tokens("x" * 40)) == (legacy, [])
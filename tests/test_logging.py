@@ -0,0 +1,105 @@
+"""
+Logging: redacción de teléfonos y tokens, muestreo por evento y handler en
+cola (el record se formatea en el hilo del listener, no en el que loguea)
+"""
+import atexit
+import io
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler
+
+import app.logging_config as logging_config
+from app.logging_config import (
+    ContextFilter,
+    NonBlockingQueueHandler,
+    debug_logging,
+    parse_sample_rates,
+    redact,
+    setup_logging,
+)
+
+
+def test_redact_phones_in_any_format():
+    assert redact("Mensaje de 573001112233") == "Mensaje de ***2233"
+    assert redact("de +57 300 111 2233: hola") == "de ***2233: hola"
+    assert redact("+57-300-111-2233") == "***2233"
+    assert redact("tel +1 (555) 123-4567.") == "tel ***4567."
+    assert redact("300-111-2233 o (300) 111-2233") == "***2233 o ***2233"
+    # Fechas, horas, montos e IDs no se tocan
+    for text in ["fecha 2024-05-01 12:00:03", "precio $99.000", "total 1234 y 99",
+                 "wamid.HBgMNTczMDAxMTEyMjMzFQIAEhgUM0"]:
+        assert redact(text) == text
+
+
+def test_redact_tokens():
+    assert redact("Authorization: Bearer EAAabc.def-123") == "Authorization: Bearer [REDACTED]"
+    assert redact("url?access_token=EAAxyz123&x=1") == "url?access_token=[REDACTED]&x=1"
+    assert "gsk_" not in redact("key gsk_abcdefghijklmnop")
+
+
+def record(level: int = logging.INFO, event: str = None) -> logging.LogRecord:
+    r = logging.LogRecord("app.test", level, __file__, 1, "hola %s", ("573001112233",), None)
+    if event:
+        r.event = event
+    return r
+
+
+def test_sampling_and_debug_mode():
+    rates = parse_sample_rates("webhook_received=0, send_response=1.0")
+    assert rates == {"webhook_received": 0.0, "send_response": 1.0}
+    f = ContextFilter(logging.INFO, rates)
+
+    assert not f.filter(record(event="webhook_received"))
+    assert f.filter(record(event="send_response"))
+    assert f.filter(record())  # Sin evento: siempre
+    assert not f.filter(record(logging.DEBUG))
+
+    # En modo debug pasa todo, sin muestreo
+    with debug_logging():
+        assert f.filter(record(event="webhook_received"))
+        debug = record(logging.DEBUG)
+        assert f.filter(debug) and debug.debug
+    assert not f.filter(record(logging.DEBUG))
+
+
+def test_queue_handler_defers_formatting_and_drops_when_full():
+    handler = NonBlockingQueueHandler(queue.Queue(maxsize=1))
+    dropped = NonBlockingQueueHandler.dropped
+    first = record()
+    handler.handle(first)
+    assert handler.queue.get_nowait() is first
+    assert first.args == ("573001112233",) and not hasattr(first, "message")
+
+    handler.handle(record())
+    handler.handle(record())  # Cola llena: se descarta sin bloquear
+    assert NonBlockingQueueHandler.dropped == dropped + 1
+
+
+def test_setup_logging_writes_redacted_json_from_the_listener(monkeypatch):
+    settings = logging_config.get_settings().model_copy(update={
+        "log_format": "json", "log_level": "INFO", "log_sample_rates": "noisy=0",
+    })
+    monkeypatch.setattr(logging_config, "get_settings", lambda: settings)
+    output = io.StringIO()
+    monkeypatch.setattr(logging_config.sys, "stdout", output)
+
+    root = logging.getLogger()
+    previous = (list(root.handlers), root.level)
+    listener = setup_logging()
+    try:
+        assert len(root.handlers) == 1 and isinstance(root.handlers[0], QueueHandler)
+        logger = logging.getLogger("app.test")
+        logger.info("📩 Mensaje de %s", "+57 300 111 2233", extra={"event": "message_received"})
+        logger.info("muestreado", extra={"event": "noisy"})
+        logger.debug("sin modo debug")
+    finally:
+        listener.stop()
+        atexit.unregister(listener.stop)
+        root.handlers[:] = previous[0]
+        root.setLevel(previous[1])
+
+    lines = [json.loads(line) for line in output.getvalue().splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["msg"] == "📩 Mensaje de ***2233"
+    assert lines[0]["event"] == "message_received" and lines[0]["level"] == "INFO"
@@ -0,0 +1,74 @@
+"""
+Cola por shards: reclamo de pendientes sin duplicar los propios y
+traspaso ordenado al tomar un shard
+"""
+import asyncio
+
+from app.services.queue_service import MessageQueue
+
+
+async def make_queue() -> MessageQueue:
+    queue = MessageQueue()
+    await queue.connect()
+    await queue.ensure_groups()
+    return queue
+
+
+def job(phone: str, n: int) -> dict:
+    return {"phone": phone, "message": {"n": n}, "message_type": "text", "message_id": f"m{n}"}
+
+
+def test_stalled_claim_skips_own_pending():
+    async def scenario():
+        queue = await make_queue()
+        shard = queue.shard_for("573001")
+        for n in range(3):
+            await queue.enqueue(job("573001", n))
+        read = await queue.read("worker-a", [shard], count=10, block_ms=0)
+        assert len(read) == 3
+        # Siguen en proceso en worker-a (esperando cupo o admisión): no se reclaman
+        assert await queue.claim_pending("worker-a", shard, min_idle_ms=0, count=10) == []
+        await queue.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_take_over_claims_previous_owner_in_order():
+    async def scenario():
+        queue = await make_queue()
+        shard = queue.shard_for("573002")
+        for n in range(4):
+            await queue.enqueue(job("573002", n))
+        await queue.read("dead-worker", [shard], count=3, block_ms=0)
+
+        claimed = await queue.take_over("new-worker", shard)
+        assert [entry[2]["message"]["n"] for entry in claimed] == [0, 1, 2]
+
+        # Después del traspaso, lo nuevo
+        fresh = await queue.read("new-worker", [shard], count=10, block_ms=0)
+        assert [entry[2]["message"]["n"] for entry in fresh] == [3]
+
+        for stream, entry_id, _ in claimed + fresh:
+            await queue.ack(stream, entry_id)
+        assert await queue.take_over("other-worker", shard) == []
+        await queue.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_claim_respects_count():
+    async def scenario():
+        queue = await make_queue()
+        shard = queue.shard_for("573003")
+        for n in range(5):
+            await queue.enqueue(job("573003", n))
+        await queue.read("dead-worker", [shard], count=5, block_ms=0)
+
+        first = await queue.claim_pending("worker-b", shard, min_idle_ms=0, count=2)
+        # Lo que worker-b ya tiene no lo vuelve a reclamar
+        rest = await queue.claim_pending("worker-b", shard, min_idle_ms=0, count=10)
+        assert [entry[2]["message"]["n"] for entry in first] == [0, 1]
+        assert [entry[2]["message"]["n"] for entry in rest] == [2, 3, 4]
+        await queue.disconnect()
+
+    asyncio.run(scenario())
@@ -0,0 +1,118 @@
+"""
+Rate limiting compartido: token buckets en Redis (Lua) y ajuste por headers
+"""
+import asyncio
+import time
+
+import pytest
+
+from app.services.rate_limit_service import RateLimiter, parse_duration
+
+
+async def make_limiter(**overrides) -> RateLimiter:
+    limiter = RateLimiter()
+    limiter.settings = limiter.settings.model_copy(update=overrides)
+    await limiter.connect()
+    return limiter
+
+
+def test_parse_duration():
+    assert parse_duration("7.66s") == pytest.approx(7.66)
+    assert parse_duration("2m59.56s") == pytest.approx(179.56)
+    assert parse_duration("120ms") == pytest.approx(0.12)
+    assert parse_duration("1h") == 3600
+    assert parse_duration(" 3 ") == 3.0  # Retry-After en segundos
+    assert parse_duration("") is None
+    assert parse_duration(None) is None
+    assert parse_duration("pronto") is None
+
+
+def test_bucket_specs_by_prefix():
+    limiter = RateLimiter()
+    limiter.settings = limiter.settings.model_copy(update={
+        "whatsapp_sends_per_second": 80, "groq_requests_per_minute": 600,
+        "groq_tokens_per_minute": 6000, "whisper_audio_seconds_per_hour": 3600,
+    })
+    assert (limiter.spec_for("whatsapp:100").rate, limiter.spec_for("whatsapp:100").capacity) == (80, 80)
+    assert (limiter.spec_for("llm:requests:m").rate, limiter.spec_for("llm:requests:m").capacity) == (10, 100)
+    assert (limiter.spec_for("llm:tokens:m").rate, limiter.spec_for("llm:tokens:m").capacity) == (100, 1000)
+    assert limiter.spec_for("whisper:audio").rate == 1
+    with pytest.raises(ValueError):
+        limiter.spec_for("otro")
+
+
+def test_token_bucket_grants_burst_then_waits():
+    async def scenario():
+        # 4 por segundo, ráfaga de 4 (un token nuevo cada 250 ms)
+        limiter = await make_limiter(whatsapp_sends_per_second=4, rate_limit_max_wait=5)
+        for _ in range(4):
+            assert await limiter.acquire("whatsapp:100") == 0.0
+        started = time.perf_counter()
+        waited = await limiter.acquire("whatsapp:100")
+        assert waited > 0.1 and time.perf_counter() - started >= 0.1
+        # Otro phone_number_id tiene su propio bucket
+        assert await limiter.acquire("whatsapp:200") == 0.0
+        # Estado en Redis bajo ratelimit:<bucket>
+        assert await limiter.redis.exists("ratelimit:whatsapp:100", "ratelimit:whatsapp:200") == 2
+        await limiter.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_wait_is_capped_by_max_wait():
+    async def scenario():
+        limiter = await make_limiter(groq_requests_per_minute=6, rate_limit_max_wait=0.1)
+        assert await limiter.acquire("llm:requests:m") == 0.0  # Ráfaga de 1
+        started = time.perf_counter()
+        waited = await limiter.acquire("llm:requests:m")
+        assert 0.1 <= waited < 0.2 and time.perf_counter() - started < 0.5
+        await limiter.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_block_pauses_a_bucket_for_every_worker():
+    async def scenario():
+        limiter = await make_limiter(rate_limit_max_wait=0.05)
+        other = await make_limiter(rate_limit_max_wait=0.05)
+        await limiter.block("whatsapp:100", 30)
+        assert 25_000 < await limiter.redis.pttl("ratelimit:whatsapp:100:blocked") <= 30_000
+        assert await other.acquire("whatsapp:100") >= 0.05  # Espera hasta el tope y sigue
+        assert await other.acquire("whatsapp:200") == 0.0
+        await limiter.disconnect()
+        await other.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_observe_groq_headers():
+    async def scenario():
+        limiter = await make_limiter()
+        blocked = "ratelimit:llm:{}:m:blocked"
+
+        await limiter.observe_groq("m", {"x-ratelimit-remaining-requests": "12", "x-ratelimit-remaining-tokens": "900"})
+        assert not await limiter.redis.exists(blocked.format("requests"), blocked.format("tokens"))
+
+        await limiter.observe_groq("m", {"x-ratelimit-remaining-tokens": "0", "x-ratelimit-reset-tokens": "7.5s"})
+        assert 7000 < await limiter.redis.pttl(blocked.format("tokens")) <= 7500
+        assert not await limiter.redis.exists(blocked.format("requests"))
+
+        await limiter.observe_groq("m", {"retry-after": "2", "x-ratelimit-remaining-requests": "0"})
+        assert 1500 < await limiter.redis.pttl(blocked.format("requests")) <= 2000
+        await limiter.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_fails_open_without_redis():
+    async def scenario():
+        limiter = RateLimiter()
+        assert await limiter.acquire("whatsapp:100") == 0.0
+        await limiter.block("whatsapp:100", 5)  # No hace nada
+
+        limiter = await make_limiter()
+        await limiter.redis.aclose()
+        limiter._bucket_script = lambda **_: (_ for _ in ()).throw(ConnectionError("caído"))
+        assert await limiter.acquire("whatsapp:100") == 0.0
+
+    asyncio.run(scenario())
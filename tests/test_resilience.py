@@ -0,0 +1,114 @@
+"""
+Hedging y timeout por intento: la espera en nuestro propio rate limit no
+cuenta como lentitud del proveedor
+"""
+import asyncio
+import time
+
+from app.services.resilience_service import ResilientCaller, local_wait
+
+
+def make_caller(**overrides) -> ResilientCaller:
+    caller = ResilientCaller()
+    caller.settings = caller.settings.model_copy(update={
+        "groq_attempt_timeout": 0.2,
+        "groq_hedge_after": 0.1,
+        "groq_deadline": 5.0,
+        "groq_max_retries": 0,
+        **overrides,
+    })
+    return caller
+
+
+def test_local_wait_does_not_time_out_hedge_or_trip_breaker():
+    calls = []
+
+    async def attempt(model: str) -> str:
+        calls.append(model)
+        with local_wait():
+            await asyncio.sleep(0.5)  # Turno en el bucket: más que timeout y hedge
+        await asyncio.sleep(0.05)
+        return model
+
+    caller = make_caller()
+    result = asyncio.run(caller.call("chat", ["large", "small"], attempt))
+    assert result == "large"
+    assert calls == ["large"]
+    assert caller.breaker("large").failures == 0
+
+
+def test_slow_provider_still_hedges_and_times_out():
+    async def attempt(model: str) -> str:
+        await asyncio.sleep(1.0 if model == "large" else 0.05)
+        return model
+
+    caller = make_caller()
+    assert asyncio.run(caller.call("chat", ["large", "small"], attempt)) == "small"
+
+    async def stuck(model: str) -> str:
+        await asyncio.sleep(1.0)
+        return model
+
+    caller = make_caller(groq_hedge_after=0)
+    try:
+        asyncio.run(caller.call("chat", ["large"], stuck))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        raise AssertionError("el intento debía vencer")
+    assert caller.breaker("large").failures == 1
+
+
+def rate_limited(model: str) -> Exception:
+    import httpx
+    from groq import RateLimitError
+    response = httpx.Response(429, request=httpx.Request("POST", f"https://groq.test/{model}"))
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+def test_quota_errors_are_not_breaker_failures_nor_retried():
+    calls = []
+
+    async def attempt(model: str) -> str:
+        calls.append(model)
+        if model == "large":
+            raise rate_limited(model)
+        return model
+
+    # El respaldo tiene su propia cuota
+    caller = make_caller(groq_max_retries=2, groq_hedge_after=0)
+    assert asyncio.run(caller.call("chat", ["large", "small"], attempt)) == "small"
+    assert calls == ["large", "small"]
+    assert caller.breaker("large").failures == 0
+
+    # Sin respaldo sale el 429, sin más vueltas
+    calls.clear()
+    caller = make_caller(groq_max_retries=2, groq_circuit_threshold=1)
+    try:
+        asyncio.run(caller.call("chat", ["large"], attempt))
+    except Exception as e:
+        assert type(e).__name__ == "RateLimitError"
+    else:
+        raise AssertionError("debía salir el 429")
+    assert calls == ["large"]
+    assert caller.breaker("large").state == "closed"
+
+
+def test_expired_deadline_does_not_take_the_half_open_probe():
+    async def attempt(model: str) -> str:
+        return model
+
+    caller = make_caller(groq_deadline=0)
+    breaker = caller.breaker("large")
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout  # Semiabierto
+    try:
+        asyncio.run(caller.call("chat", ["large"], attempt))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        raise AssertionError("el deadline ya había vencido")
+
+    # La prueba sigue disponible para la próxima llamada, que cierra el circuito
+    caller.settings = caller.settings.model_copy(update={"groq_deadline": 5.0})
+    assert asyncio.run(caller.call("chat", ["large"], attempt)) == "large"
+    assert breaker.state == "closed"
@@ -0,0 +1,48 @@
+"""
+Ruteo de turnos: plantilla, modelo chico o modelo del tenant
+"""
+from app.services.routing_service import ModelRouter
+from app.services.tenant_service import tenant_registry
+
+
+def test_classify():
+    router = ModelRouter()
+    turn = [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "¡Hola!"}]
+    cases = [
+        ("Hola, buenas tardes", [], ("template", "greeting")),
+        ("hola!", turn, ("small", "greeting")),
+        ("Muchas gracias 🙌", turn, ("template", "thanks")),
+        ("chao, hasta luego", turn, ("template", "goodbye")),
+        ("[sticker]", turn, ("template", "sticker")),
+        ("[imagen]\n[documento adjunto]", turn, ("template", "media")),
+        ("👍", turn, ("small", "emoji")),
+        ("ok perfecto", turn, ("small", "ack")),
+        ("¿Cuánto cuesta un agente para 300 mensajes al día?", [], ("large", "qualification")),
+        ("¿Se puede integrar con mi CRM?", turn, ("large", "qualification")),
+        ("me parece bien", turn, ("small", "simple")),
+    ]
+    for text, history, expected in cases:
+        route = router.classify(text, history)
+        assert (route.tier, route.reason) == expected, text
+
+
+def test_route_resolves_template_and_models():
+    router = ModelRouter()
+    tenant = tenant_registry.default
+    template = router.route("hola buenos días", tenant, [])
+    assert (template.tier, template.model) == ("template", None)
+    assert tenant.business_name in template.reply
+
+    small = router.route("ok", tenant, [{"role": "user", "content": "hola"}])
+    assert small.model == router.settings.router_small_model
+    assert small.max_tokens == min(tenant.max_tokens, router.settings.router_small_max_tokens)
+
+    large = router.route("¿Cuánto cuesta la integración con mi CRM?", tenant, [])
+    assert (large.model, large.max_tokens) == (tenant.model, tenant.max_tokens)
+
+
+def test_disabled_router_always_uses_tenant_model():
+    router = ModelRouter()
+    router.settings = router.settings.model_copy(update={"router_enabled": False})
+    route = router.route("gracias", tenant_registry.default, [])
+    assert (route.tier, route.reason, route.model) == ("large", "disabled", tenant_registry.default.model)
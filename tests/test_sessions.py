@@ -0,0 +1,201 @@
+"""
+Sesiones: L1 en memoria delante de Redis, scripts Lua (update atómico,
+migración desde los formatos anteriores, resumen) y formato compacto
+"""
+import asyncio
+import json
+import time
+
+from app.services.history_service import history_entry
+from app.services.redis_service import SessionManager
+from app.services.session_codec import V2, V2_ZLIB, decode_message, encode_message, is_legacy, to_epoch
+
+
+async def make_manager(cache_reads: bool = True) -> SessionManager:
+    manager = SessionManager()
+    manager.cache_reads = cache_reads
+    await manager.connect()
+    return manager
+
+
+def test_web_processes_read_other_processes_writes():
+    async def scenario():
+        # Dos procesos web atendiendo el mismo número
+        a, b = await make_manager(cache_reads=False), await make_manager(cache_reads=False)
+        await a.update_session("573001", "hola", "¡Hola!")
+        assert len((await b.get_session("573001"))["history"]) == 2
+        await b.update_session("573001", "precios", "Desde $99")
+        history = (await a.get_session("573001"))["history"]
+        assert [m["content"] for m in history] == ["hola", "¡Hola!", "precios", "Desde $99"]
+        await a.disconnect()
+        await b.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_shard_owner_serves_from_l1():
+    async def scenario():
+        owner, other = await make_manager(), await make_manager()
+        await owner.get_session("573002")
+        await owner.update_session("573002", "hola", "¡Hola!")
+        # Otro proceso escribe (no debería pasar con shards): el dueño sigue con su L1
+        await other.update_session("573002", "x", "y")
+        assert len((await owner.get_session("573002"))["history"]) == 2
+        await owner.disconnect()
+        await other.disconnect()
+
+    asyncio.run(scenario())
+
+
+# ---- Scripts Lua y formato compacto
+
+def test_codec_round_trip_and_compression():
+    short = history_entry("user", "hola")
+    assert encode_message(short)[:1] == V2
+    assert decode_message(encode_message(short)) == short
+
+    long = history_entry("assistant", "Loopera automatiza ventas por WhatsApp. " * 30)
+    packed = encode_message(long, compress_min_bytes=512)
+    assert packed[:1] == V2_ZLIB and len(packed) < len(long["content"])
+    assert decode_message(packed) == long
+    # Determinístico: los scripts Lua comparan items por igualdad
+    assert encode_message(long, 512) == packed
+
+    legacy = json.dumps({"role": "user", "content": "hola"}).encode()
+    assert is_legacy(legacy) and not is_legacy(packed)
+    assert decode_message(legacy) == {"role": "user", "content": "hola"}
+    assert to_epoch("2024-05-01T12:00:00") == 1714564800
+    assert to_epoch(b"1714564800") == 1714564800
+
+
+def test_update_is_atomic_trims_and_merges_metadata():
+    async def scenario():
+        manager = await make_manager(cache_reads=False)
+        manager.max_messages = 4
+        await manager.update_session("573010", "hola", "¡Hola!", {"name": "Ana"})
+        await manager.update_session("573010", "precios", "Desde $99", {"company": "Clínica"})
+        await manager.update_session("573010", "demo", "¡Agendemos!")
+
+        history_key, meta_key, _ = manager._keys("573010")
+        raw = await manager.redis.lrange(history_key, 0, -1)
+        assert all(item[:1] in (V2, V2_ZLIB) for item in raw)
+
+        session = await manager.get_session("573010")
+        assert [m["content"] for m in session["history"]] == ["precios", "Desde $99", "demo", "¡Agendemos!"]
+        assert session["metadata"] == {"name": "Ana", "company": "Clínica"}
+        assert session["created_at"] <= session["updated_at"]
+        assert 0 < await manager.redis.ttl(history_key) <= manager.ttl
+        assert 0 < await manager.redis.ttl(meta_key) <= manager.ttl
+        await manager.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_legacy_string_session_moves_to_list_on_update():
+    async def scenario():
+        manager = await make_manager(cache_reads=False)
+        history_key, meta_key, legacy_key = manager._keys("573011")
+        await manager.redis.set(legacy_key, json.dumps({
+            "history": [{"role": "user", "content": "hola"}, {"role": "assistant", "content": "¡Hola!"}],
+            "metadata": {"name": "Ana"},
+            "created_at": "2024-05-01T12:00:00",
+        }))
+
+        # Lectura del formato más viejo, tal cual
+        session = await manager.get_session("573011")
+        assert [m["content"] for m in session["history"]] == ["hola", "¡Hola!"]
+        assert session["created_at"] == 1714564800
+
+        await manager.update_session("573011", "precios", "Desde $99")
+        assert not await manager.redis.exists(legacy_key)
+        session = await manager.get_session("573011")
+        assert [m["content"] for m in session["history"]] == ["hola", "¡Hola!", "precios", "Desde $99"]
+        assert session["metadata"] == {"name": "Ana"}
+
+        # Los mensajes viejos quedaron como items JSON; la lectura los compacta
+        await asyncio.gather(*manager._migrations)
+        raw = await manager.redis.lrange(history_key, 0, -1)
+        assert len(raw) == 4 and not any(is_legacy(item) for item in raw)
+        await manager.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_json_items_migrate_to_compact_format():
+    async def scenario():
+        manager = await make_manager(cache_reads=False)
+        history_key, meta_key, _ = manager._keys("573012")
+        items = [json.dumps({"role": "user", "content": "hola"}), json.dumps({"role": "assistant", "content": "¡Hola!"})]
+        await manager.redis.rpush(history_key, *items)
+        await manager.redis.expire(history_key, 600)
+        await manager.redis.hset(meta_key, "created_at", "2024-05-01T12:00:00")
+
+        session = await manager.get_session("573012")
+        assert [m["content"] for m in session["history"]] == ["hola", "¡Hola!"]
+        await asyncio.gather(*manager._migrations)
+
+        raw = await manager.redis.lrange(history_key, 0, -1)
+        assert [decode_message(item)["content"] for item in raw] == ["hola", "¡Hola!"]
+        assert not any(is_legacy(item) for item in raw)
+        assert await manager.redis.hget(meta_key, "created_at") == b"1714564800"
+        assert 0 < await manager.redis.ttl(history_key) <= 600  # Conserva el TTL
+        await manager.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_migration_skips_a_history_that_changed():
+    async def scenario():
+        manager = await make_manager(cache_reads=False)
+        history_key, _, _ = manager._keys("573013")
+        item = json.dumps({"role": "user", "content": "hola"})
+        await manager.redis.rpush(history_key, item)
+        session = {"history": [decode_message(item)], "created_at": None, "updated_at": None}
+        await manager.redis.rpush(history_key, encode_message(history_entry("assistant", "¡Hola!")))
+
+        await manager._migrate("573013", [item.encode()], session)
+        assert await manager.redis.llen(history_key) == 2
+        assert is_legacy(await manager.redis.lindex(history_key, 0))
+        await manager.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_summary_folds_oldest_messages_only_if_unchanged():
+    async def scenario():
+        manager = await make_manager()
+        for n in range(3):
+            await manager.update_session("573014", f"pregunta {n}", f"respuesta {n}")
+        session = await manager.get_session("573014")
+        folded = session["history"][:2]
+
+        assert await manager.apply_summary("573014", "Preguntó 0", folded)
+        session = await manager.get_session("573014")
+        assert session["summary"] == "Preguntó 0"
+        assert [m["content"] for m in session["history"]][0] == "pregunta 1"
+        # El L1 hizo el mismo recorte
+        other = await make_manager(cache_reads=False)
+        assert (await other.get_session("573014"))["history"] == session["history"]
+
+        # Los mensajes resumidos ya no están al frente: no se aplica
+        assert not await manager.apply_summary("573014", "Viejo", folded)
+        assert (await other.get_session("573014"))["summary"] == "Preguntó 0"
+        await manager.disconnect()
+        await other.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_last_active_comes_from_redis_in_web_processes():
+    async def scenario():
+        worker, web = await make_manager(), await make_manager(cache_reads=False)
+        assert await web.last_active("573015") is None
+        await worker.get_session("573015")
+        await worker.update_session("573015", "hola", "¡Hola!")
+        # El web no tiene la conversación en su L1, pero la ve activa en Redis
+        assert abs(await web.last_active("573015") - time.time()) < 5
+        assert await worker.last_active("573015") == await web.last_active("573015")
+        await worker.disconnect()
+        await web.disconnect()
+
+    asyncio.run(scenario())
@@ -0,0 +1,60 @@
+"""
+Cortes de la respuesta en streaming
+"""
+from app.services.streaming_service import ReplyChunker
+
+
+def feed_all(chunker: ReplyChunker, text: str, step: int = 7) -> list:
+    parts = []
+    for i in range(0, len(text), step):
+        parts.extend(chunker.feed(text[i:i + step]))
+    return parts + chunker.finish()
+
+
+def test_first_sentence_goes_out_alone():
+    chunker = ReplyChunker(first_chars=10, min_chars=80, max_chars=300, limit=4096)
+    assert chunker.feed("¡Hola! Soy el asistente") == []  # Antes de first_chars
+    assert chunker.feed(" de Loopera. Desarrollamos") == ["¡Hola! Soy el asistente de Loopera."]
+    assert chunker.finish() == ["Desarrollamos"]
+
+
+def test_cuts_on_paragraphs_and_long_buffers():
+    paragraph = "Automatizamos la atención por WhatsApp con agentes de IA que responden al instante. "
+    text = "Hola. " + paragraph * 2 + "\n\n" + paragraph * 5 + "¿Agendamos?"
+    chunker = ReplyChunker(first_chars=0, min_chars=80, max_chars=300, limit=4096)
+    parts = feed_all(chunker, text)
+    assert parts[0] == "Hola."
+    assert parts[1] == (paragraph * 2).strip()  # Fin de párrafo
+    assert all(len(part) <= 300 + len(paragraph) for part in parts)
+    assert " ".join(parts).split() == text.split()
+
+
+def test_never_exceeds_whatsapp_limit():
+    text = "palabra " * 200  # Sin fines de oración
+    chunker = ReplyChunker(first_chars=0, min_chars=50, max_chars=200, limit=300)
+    parts = feed_all(chunker, text, step=50)
+    assert len(parts) > 1
+    assert all(len(part) <= 300 for part in parts)
+    assert " ".join(parts).split() == text.split()
+
+
+def test_unpunctuated_reply_streams_before_finish():
+    # Lista sin puntos: antes no salía nada hasta finish() y el buffer crecía sin tope
+    text = "".join(f"- opción {n} con integración a CRM y agenda\n" for n in range(150))
+    chunker = ReplyChunker(first_chars=0, min_chars=80, max_chars=300, limit=4096)
+    streamed = []
+    for i in range(0, len(text), 20):
+        streamed.extend(chunker.feed(text[i:i + 20]))
+        assert len(chunker.buffer) <= 4096 + 20
+    assert streamed
+    parts = streamed + chunker.finish()
+    assert all(len(part) <= 4096 for part in parts)
+    assert " ".join(parts).split() == text.split()
+
+
+def test_first_sentence_longer_than_limit_is_split():
+    text = "palabra " * 100 + "fin. Y sigue"
+    chunker = ReplyChunker(first_chars=0, min_chars=50, max_chars=200, limit=300)
+    parts = feed_all(chunker, text, step=len(text))
+    assert all(len(part) <= 300 for part in parts)
+    assert " ".join(parts).split() == text.split()
@@ -0,0 +1,99 @@
+"""
+Tenants por phone_number_id: búsqueda, números desconocidos y recarga en
+caliente desde archivo y Redis
+"""
+import asyncio
+import json
+
+import pytest
+
+import app.pipeline as pipeline
+from app.services.tenant_service import TenantRegistry
+
+DEFAULT_ID = "100000000000001"  # WHATSAPP_PHONE_NUMBER_ID de conftest
+
+
+def make_registry(tmp_path, tenants: list, redis_key: str = "") -> TenantRegistry:
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps(tenants))
+    registry = TenantRegistry()
+    registry.settings = registry.settings.model_copy(update={
+        "tenants_file": str(path), "tenants_redis_key": redis_key, "tenants_reload_interval": 3600,
+    })
+    return registry
+
+
+def test_lookup_by_phone_number_id(tmp_path):
+    async def scenario():
+        registry = make_registry(tmp_path, [
+            {"phone_number_id": "200", "whatsapp_token": "token-acme", "business_name": "Acme"},
+        ])
+        await registry.start()
+        acme = registry.resolve("200")
+        assert acme.business_name == "Acme" and acme.whatsapp_token == "token-acme"
+        assert acme.session_key("573001") == "200:573001"
+
+        # El número propio y los jobs sin número van al negocio por defecto
+        assert registry.resolve(DEFAULT_ID) is registry.default
+        assert registry.resolve(None) is registry.default
+        assert registry.default.session_key("573001") == "573001"
+        # Un número ajeno no cae en las credenciales por defecto
+        assert registry.resolve("999") is None
+        await registry.stop()
+
+    asyncio.run(scenario())
+
+
+def test_hot_reload_from_file_and_redis(tmp_path):
+    async def scenario():
+        registry = make_registry(tmp_path, [{"phone_number_id": "200", "business_name": "Acme"}], "tenants")
+        await registry.start()
+        assert len(registry) == 1
+        assert not await registry.reload()  # Sin cambios
+
+        # Alta en Redis y cambio en el archivo
+        await registry.redis.hset("tenants", "300", json.dumps({"business_name": "Beta", "model": "m"}))
+        (tmp_path / "tenants.json").write_text(json.dumps([{"phone_number_id": "200", "business_name": "Acme 2"}]))
+        assert await registry.reload()
+        assert registry.resolve("300").business_name == "Beta" and registry.resolve("300").model == "m"
+        old_acme = registry.resolve("200")
+        assert old_acme.business_name == "Acme 2"
+
+        # Un archivo a medio escribir conserva el registro anterior
+        (tmp_path / "tenants.json").write_text("[{")
+        with pytest.raises(ValueError):
+            await registry.reload()
+        assert registry.resolve("200") is old_acme
+
+        # Baja: el número deja de responder
+        (tmp_path / "tenants.json").write_text("[]")
+        await registry.redis.hdel("tenants", "300")
+        assert await registry.reload()
+        assert registry.resolve("200") is None and registry.resolve("300") is None
+        await registry.stop()
+
+    asyncio.run(scenario())
+
+
+def test_message_to_unknown_number_is_dropped(monkeypatch):
+    sent, acked = [], []
+
+    async def send(*args, **kwargs):
+        sent.append(args)
+
+    async def ack():
+        acked.append(1)
+
+    monkeypatch.setattr(pipeline.whatsapp_service, "send_text_message", send)
+    monkeypatch.setattr(pipeline.whatsapp_service, "mark_as_read", send)
+
+    async def scenario():
+        ingested = asyncio.Event()
+        await pipeline.process_message(
+            "573001", {"type": "text", "text": {"body": "hola"}}, "text", "wamid.1",
+            phone_number_id="999", ingested=ingested, ack=ack
+        )
+        assert ingested.is_set()
+
+    asyncio.run(scenario())
+    assert sent == [] and acked == [1]
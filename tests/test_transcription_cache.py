@@ -0,0 +1,88 @@
+"""
+Caché de transcripciones: clave por hash del audio y por media_id, TTL,
+LRU local y una sola transcripción en vuelo por audio
+"""
+import asyncio
+import hashlib
+
+from app.services.transcription_cache_service import CACHE_VERSION, TranscriptionCache
+
+
+async def make_cache(**overrides) -> TranscriptionCache:
+    cache = TranscriptionCache()
+    for name, value in overrides.items():
+        setattr(cache, name, value)
+    await cache.connect()
+    return cache
+
+
+def whisper(calls: list, text: str = "hola, quiero una demo"):
+    async def transcribe() -> str:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return text
+    return transcribe
+
+
+def test_miss_then_hit_by_content_and_media_id():
+    async def scenario():
+        cache = await make_cache(ttl=600)
+        calls, audio = [], b"OggS nota de voz"
+        assert await cache.lookup_media("media-1") is None
+        assert await cache.transcribe(audio, "media-1", whisper(calls)) == "hola, quiero una demo"
+        assert calls == [1]
+
+        # Claves versionadas por modelo e idioma, con TTL
+        digest = hashlib.sha256(audio).hexdigest()
+        s = cache.settings
+        prefix = f"transcript:{CACHE_VERSION}:{s.whisper_model}:{s.whisper_language or 'auto'}"
+        for key in (f"{prefix}:sha256:{digest}", f"{prefix}:media:media-1"):
+            assert await cache.redis.get(key) == "hola, quiero una demo"
+            assert 0 < await cache.redis.ttl(key) <= 600
+
+        # Otro worker (sin L1): el mismo media_id no se descarga, y un reenvío
+        # (otro media_id, mismos bytes) no vuelve a Whisper
+        other = await make_cache()
+        assert await other.lookup_media("media-1") == "hola, quiero una demo"
+        assert await other.transcribe(audio, "media-2", whisper(calls)) == "hola, quiero una demo"
+        assert calls == [1]
+        assert await other.lookup_media("media-2") == "hola, quiero una demo"
+
+        # Otro audio sí se transcribe
+        assert await other.transcribe(b"otro audio", "media-3", whisper(calls, "precios")) == "precios"
+        assert calls == [1, 1]
+        await cache.disconnect()
+        await other.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_copies_share_one_transcription():
+    async def scenario():
+        cache = await make_cache()
+        calls = []
+        texts = await asyncio.gather(*(
+            cache.transcribe(b"audio reenviado", f"media-{n}", whisper(calls)) for n in range(3)
+        ))
+        assert texts == ["hola, quiero una demo"] * 3 and calls == [1]
+        await cache.disconnect()
+
+    asyncio.run(scenario())
+
+
+def test_local_lru_and_redis_down():
+    async def scenario():
+        cache = await make_cache(_local_max=2)
+        calls = []
+        for n in range(3):
+            await cache.transcribe(f"audio {n}".encode(), "", whisper(calls, f"texto {n}"))
+        assert len(cache._local) == 2
+
+        # Sin Redis: sigue transcribiendo y sirve desde el L1
+        await cache.redis.aclose()
+        cache.redis = None
+        assert await cache.transcribe(b"audio 2", "", whisper(calls)) == "texto 2"
+        assert await cache.transcribe(b"audio 9", "", whisper(calls, "nuevo")) == "nuevo"
+        assert len(calls) == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,41 @@
+"""
+Ingesta del webhook: firma de Meta y extracción de mensajes
+"""
+import hashlib
+import hmac
+
+from app.webhook import extract_messages, parse_body, verify_signature
+
+SECRET = "app-secret"
+
+
+def sign(raw: bytes, secret: str = SECRET) -> str:
+    return "sha256=" + hmac.new(secret.encode(), raw, hashlib.sha256).hexdigest()
+
+
+def test_verify_signature():
+    raw = b'{"object":"whatsapp_business_account"}'
+    assert verify_signature(raw, sign(raw), SECRET)
+    assert not verify_signature(raw + b" ", sign(raw), SECRET)
+    assert not verify_signature(raw, sign(raw, "otro"), SECRET)
+    assert not verify_signature(raw, sign(raw).removeprefix("sha256="), SECRET)
+    assert not verify_signature(raw, None, SECRET)
+    assert not verify_signature(raw, "", SECRET)
+
+
+def test_extract_messages_from_every_entry_and_change():
+    first, second = {"phone_number_id": "1"}, {"phone_number_id": "2"}
+    body = {
+        "entry": [
+            {"changes": [
+                {"value": {"metadata": first, "messages": [{"id": "a"}, {"id": "b"}]}},
+                {"value": {"metadata": first, "statuses": [{"id": "a", "status": "read"}]}},
+            ]},
+            {"changes": [{"value": {"metadata": second, "messages": [{"id": "c"}]}}]},
+            {"changes": None},
+            {},
+        ]
+    }
+    assert extract_messages(body) == [({"id": "a"}, first), ({"id": "b"}, first), ({"id": "c"}, second)]
+    assert extract_messages({}) == []
+    assert extract_messages(parse_body(b"[]")) == []